@@ -1,131 +1,357 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
-import sqlite3
-from datetime import datetime, timedelta
+from flask import Flask, render_template, stream_template, request, redirect, url_for, flash, jsonify, abort, Response, stream_with_context, current_app, g
+from flask.cli import AppGroup
+import click
+from functools import wraps
+import heapq
 import os
-
-app = Flask(__name__)
-app.secret_key = 'medicine_stock_management_secret_key'
+import db
+import dashboard
+import export
+import importer
+import stock
+import search_index
+import migrations
+import archive
+import metrics
+import expiry_tiers
+import events
+import shards
+import forecast
+import batches
+import write_queue
+import replica
+import rollups
+import purchasing
+import suggest
+from revisions import etag_cached
+from db import get_db_connection, today_day
+from pagination import fetch_page, get_page_args, page_to_json
 
 # Database setup
 DB_PATH = os.path.join('database', 'medicine_stock.db')
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+DEFAULT_CONFIG = dict(db.DEFAULT_CONFIG,
+                      SECRET_KEY='medicine_stock_management_secret_key',
+                      DB_PATH=DB_PATH,
+                      # Number of rows per page on list views and their JSON variants
+                      PAGE_SIZE=50,
+                      MAX_PAGE_SIZE=500,
+                      # Closed months of transactions are moved to monthly files here
+                      ARCHIVE_DIR=os.path.join('database', 'archive'),
+                      ARCHIVE_KEEP_MONTHS=3,
+                      # Request and SQL timing served at /metrics
+                      METRICS_ENABLED=True,
+                      # List pages are streamed to the browser in chunks of about this many characters
+                      STREAM_CHUNK_SIZE=8192,
+                      # Group commit for stock movements, see write_queue.py
+                      WRITE_QUEUE_ENABLED=False,
+                      WRITE_QUEUE_BATCH_SIZE=256,
+                      WRITE_QUEUE_MAX_DELAY_MS=5,
+                      WRITE_QUEUE_TIMEOUT=30,
+                      WRITE_QUEUE_SYNCHRONOUS='FULL',
+                      # Transaction lists, expiry views and exports read a backup copy
+                      # of the database at most REPLICA_MAX_STALENESS seconds old,
+                      # refreshed every REPLICA_REFRESH_SECONDS (0 for on demand only)
+                      REPLICA_ENABLED=False,
+                      REPLICA_MAX_STALENESS=60,
+                      REPLICA_REFRESH_SECONDS=30,
+                      REPLICA_BACKUP_PAGES=1024,
+                      # Typeahead at /api/suggest from an in-memory index of names and
+                      # manufacturers, see suggest.py. Typos of up to SUGGEST_MAX_DISTANCE
+                      # edits are matched on the first SUGGEST_PREFIX_LENGTH characters,
+                      # completing at most SUGGEST_SCAN terms per near prefix.
+                      SUGGEST_ENABLED=True,
+                      SUGGEST_PREFIX_LENGTH=8,
+                      SUGGEST_MIN_FUZZY=3,
+                      SUGGEST_MAX_DISTANCE=2,
+                      SUGGEST_SCAN=20,
+                      SUGGEST_LIMIT=10,
+                      MAX_SUGGEST_LIMIT=50,
+                      # Date range of /reports pages when none is given
+                      REPORT_DEFAULT_DAYS=30,
+                      # Discount tiers as (days left or fewer, percent off), and how far
+                      # ahead the materialized expiry table looks
+                      DISCOUNT_TIERS=[(5, 50), (10, 30), (15, 15)],
+                      EXPIRY_HORIZON_DAYS=90,
+                      # Rebuild the expiry table at midnight from a background timer
+                      EXPIRY_SCHEDULER_ENABLED=True,
+                      # Live dashboard feed at /events
+                      EVENTS_POLL_SECONDS=15,
+                      EVENTS_BATCH_SIZE=500,
+                      EVENTS_RETRY_MS=3000,
+                      # Chain-wide views fan out over the main database and the STORES
+                      # shards on a thread pool, one worker per database unless
+                      # SHARD_WORKERS is set. SHARD_TIMEOUT counts from when a shard's
+                      # query starts.
+                      SHARD_WORKERS=None,
+                      SHARD_TIMEOUT=5,
+                      # Reorder points from the last FORECAST_WINDOW_DAYS of demand, covering
+                      # REORDER_LEAD_TIME_DAYS of supply at a REORDER_SERVICE_Z service level
+                      FORECAST_WINDOW_DAYS=forecast.FORECAST_WINDOW_DAYS,
+                      REORDER_LEAD_TIME_DAYS=forecast.REORDER_LEAD_TIME_DAYS,
+                      REORDER_SERVICE_Z=forecast.REORDER_SERVICE_Z,
+                      # Reorder points are updated every FORECAST_REFRESH_SECONDS from a
+                      # background timer (0 to only update them with "flask forecast")
+                      FORECAST_REFRESH_SECONDS=300,
+                      # Purchase orders restock low medicines to their reorder point plus
+                      # this many days of forecast demand
+                      ORDER_COVER_DAYS=purchasing.ORDER_COVER_DAYS)
+
+# Routes and CLI commands are collected here and registered by create_app,
+# so importing this module does no I/O
+ROUTES = []
+CHAIN_PREFIX = '/api/chain/'
+cli = AppGroup('medistore')
+
+def route(rule, **options):
+    def decorator(view):
+        ROUTES.append((rule, view, options))
+        return view
+    return decorator
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.from_prefixed_env()
+    if config:
+        app.config.update(config)
     
-    # Create medicines table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS medicines (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        description TEXT,
-        category TEXT,
-        quantity INTEGER NOT NULL,
-        unit TEXT,
-        manufacturer TEXT,
-        batch_number TEXT,
-        purchase_date TEXT,
-        expiry_date TEXT NOT NULL,
-        price REAL,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Create suppliers table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS suppliers (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        contact_person TEXT,
-        phone TEXT,
-        email TEXT,
-        address TEXT,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Create transactions table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS transactions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        medicine_id INTEGER,
-        transaction_type TEXT NOT NULL,
-        quantity INTEGER NOT NULL,
-        transaction_date TEXT DEFAULT CURRENT_TIMESTAMP,
-        notes TEXT,
-        FOREIGN KEY (medicine_id) REFERENCES medicines (id)
-    )
-    ''')
+    for rule, view, options in ROUTES:
+        app.add_url_rule(rule, view_func=view, **options)
+        # Every page and API is also served per branch shard
+        if app.config['STORES'] and not rule.startswith(CHAIN_PREFIX):
+            app.add_url_rule('/stores/<store_id>' + rule, view_func=view, **options)
+    for command in cli.commands.values():
+        app.cli.add_command(command)
     
-    conn.commit()
-    conn.close()
+    app.url_value_preprocessor(pull_store_id)
+    app.url_defaults(add_store_id)
+    app.before_request(check_schema_once)
+    app.register_error_handler(write_queue.WriteTimeout, write_timeout)
+    if app.config['METRICS_ENABLED']:
+        metrics.init_app(app)
+    app.teardown_appcontext(db.close_db_connection)
+    app.teardown_appcontext(replica.close_report_connection)
+    return app
 
-# Initialize database
-if not os.path.exists('database'):
-    os.makedirs('database')
-init_db()
+def pull_store_id(endpoint, values):
+    if values and 'store_id' in values:
+        store = values.pop('store_id')
+        if store not in current_app.config['STORES']:
+            abort(404)
+        g.store_id = store
 
-# Helper functions
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+def add_store_id(endpoint, values):
+    # Links rendered on a branch page stay on that branch
+    store = db.get_store()
+    if store is not None and current_app.url_map.is_endpoint_expecting(endpoint, 'store_id'):
+        values.setdefault('store_id', store)
 
+def write_timeout(error):
+    # The movement was cancelled before it ran, so retrying it is safe
+    return jsonify({'error': str(error)}), 503
+
+def check_schema_once():
+    # Startup check: only the schema version is verified, migrations run through "flask migrate"
+    checked = current_app.extensions.setdefault('schema_checked', set())
+    store = db.get_store()
+    if store not in checked:
+        migrations.check_schema(get_db_connection())
+        checked.add(store)
+        if current_app.config['EXPIRY_SCHEDULER_ENABLED']:
+            expiry_tiers.start_scheduler(current_app._get_current_object())
+        if current_app.config['REPLICA_ENABLED']:
+            replica.start_scheduler(current_app._get_current_object())
+        forecast.start_scheduler(current_app._get_current_object())
+        if current_app.config['SUGGEST_ENABLED']:
+            suggest.start_building(current_app._get_current_object(), store)
+
+# Helper functions
 def get_expiring_medicines(days=30):
-    conn = get_db_connection()
+    # Served from the materialized tier table when it covers the window
+    tiered = expiry_tiers.get_tiered_medicines(days)
+    if tiered is not None:
+        return tiered
+    
+    conn = replica.get_report_connection()
     cursor = conn.cursor()
     
-    today = datetime.now().strftime('%Y-%m-%d')
-    today_date = datetime.now().date()
+    today = today_day()
     
-    # Get medicines expiring within the specified days
+    # Get batches expiring within the specified days
     cursor.execute('''
-    SELECT * FROM medicines 
-    WHERE date(expiry_date) <= date(?, '+' || ? || ' days') 
-    AND quantity > 0
-    ORDER BY expiry_date
-    ''', (today, days))
+    SELECT %s, b.expiry_day - ? AS days_left
+    FROM batches b
+    JOIN medicines m ON m.id = b.medicine_id
+    WHERE b.expiry_day <= ? 
+    AND b.quantity > 0
+    ORDER BY b.expiry_day
+    ''' % batches.BATCH_COLUMNS, (today, today + days))
     
-    medicines = cursor.fetchall()
+    result = [dict(medicine) for medicine in cursor.fetchall()]
     
-    # Convert to list of dictionaries and add days_left
-    result = []
-    for medicine in medicines:
-        med_dict = dict(medicine)
-        try:
-            expiry_date = datetime.strptime(medicine['expiry_date'], '%Y-%m-%d').date()
-            days_left = (expiry_date - today_date).days
-            med_dict['days_left'] = days_left
-        except (ValueError, TypeError):
-            med_dict['days_left'] = None
-        result.append(med_dict)
-    
-    conn.close()
     return result
 
+def update_forecast():
+    # Folds in transactions since the last run, a no-op when there are none
+    config = current_app.config
+    return forecast.update_forecast(get_db_connection(), config['FORECAST_WINDOW_DAYS'],
+                                    config['REORDER_LEAD_TIME_DAYS'], config['REORDER_SERVICE_Z'])
+
+def iter_cursor(cursor, size=500):
+    # Rows are fetched as they are consumed, never all at once
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        yield from rows
+
 def get_low_stock_medicines(threshold=10):
+    return list(iter_low_stock_medicines(threshold))
+
+def iter_low_stock_medicines(threshold=10):
+    # Each medicine is compared with its own reorder point, threshold is the
+    # fallback for medicines without recent demand. Both sets are read in
+    # quantity order from their own index and merged, so only low stock rows
+    # are visited. Nothing runs until the first row is asked for.
     conn = get_db_connection()
-    cursor = conn.cursor()
+    today = today_day()
     
-    cursor.execute('SELECT * FROM medicines WHERE quantity <= ? ORDER BY quantity', (threshold,))
+    with_point = conn.execute('''
+    SELECT m.*, m.expiry_day - ? AS days_left, r.reorder_point, r.daily_demand,
+           ROUND(m.quantity / r.daily_demand, 1) AS days_of_cover
+    FROM reorder_points r
+    JOIN medicines m ON m.id = r.medicine_id
+    WHERE r.quantity <= r.reorder_point ORDER BY r.quantity
+    ''', (today,))
+    without_point = conn.execute('''
+    SELECT m.*, m.expiry_day - ? AS days_left, ? AS reorder_point, NULL AS daily_demand,
+           NULL AS days_of_cover
+    FROM medicines m
+    WHERE m.quantity <= ? AND NOT EXISTS (SELECT 1 FROM reorder_points r WHERE r.medicine_id = m.id)
+    ORDER BY m.quantity
+    ''', (today, threshold, threshold))
     
-    medicines = cursor.fetchall()
-    conn.close()
-    return medicines
+    yield from heapq.merge(iter_cursor(with_point), iter_cursor(without_point),
+                           key=lambda medicine: medicine['quantity'])
 
-# Routes
-@app.route('/')
-def index():
+def get_discount_offers():
+    # Medicines inside the widest discount tier, with the recommended
+    # discount and discounted price precomputed by expiry_tiers
+    days = max([days for days, percent in current_app.config['DISCOUNT_TIERS']] or [0])
+    return expiry_tiers.get_tiered_medicines(days, discounted_only=True)
+
+def stream_page(template_name, **context):
+    # Rendered while it is sent. Lazy row iterators in the context are read
+    # inside the stream, on a connection checked out for it, since the view's
+    # connection goes back to the pool as soon as the view returns.
+    def chunks():
+        size = current_app.config['STREAM_CHUNK_SIZE']
+        buffer, length = [], 0
+        for part in stream_template(template_name, **context):
+            buffer.append(part)
+            length += len(part)
+            if length >= size:
+                yield ''.join(buffer)
+                buffer, length = [], 0
+        if buffer:
+            yield ''.join(buffer)
+    return Response(stream_with_context(chunks()), mimetype='text/html')
+
+def generate_purchase_orders():
+    update_forecast()
+    return write_queue.submit(purchasing.generate_orders, today_day(),
+                              current_app.config['ORDER_COVER_DAYS'])
+
+def get_report_range():
+    # Inclusive start and end days from ?start=&end= (YYYY-MM-DD), the last
+    # REPORT_DEFAULT_DAYS days by default
+    try:
+        end = rollups.parse_day(request.args.get('end'), today_day())
+        start = rollups.parse_day(request.args.get('start'), end - current_app.config['REPORT_DEFAULT_DAYS'] + 1)
+    except ValueError:
+        abort(400)
+    if start > end:
+        abort(400)
+    return start, end
+
+def get_category_report():
+    start, end = get_report_range()
+    return {'start': rollups.format_day(start), 'end': rollups.format_day(end),
+            'categories': rollups.get_category_report(replica.get_report_connection(), start, end)}
+
+def get_medicine_report():
+    start, end = get_report_range()
+    limit = min(request.args.get('limit', 50, type=int), current_app.config['MAX_PAGE_SIZE'])
+    medicines = rollups.get_medicine_report(replica.get_report_connection(), start, end,
+                                            request.args.get('category'), max(limit, 1))
+    return {'start': rollups.format_day(start), 'end': rollups.format_day(end), 'medicines': medicines}
+
+def get_daily_report():
+    start, end = get_report_range()
+    days = rollups.get_daily_report(replica.get_report_connection(), start, end, request.args.get('category'))
+    return {'start': rollups.format_day(start), 'end': rollups.format_day(end), 'days': days}
+
+def search_medicines(query, limit=20):
     conn = get_db_connection()
+    today = today_day()
     
-    # Get total medicine count
-    total_medicines = conn.execute('SELECT COUNT(*) FROM medicines').fetchone()[0]
+    match = search_index.build_match_query(query)
+    if match and search_index.has_search_index(conn):
+        select, params = search_index.ranked_search_select(today)
+        rows = conn.execute(select + ' ORDER BY score, id LIMIT ?', params + [match, limit])
+    else:
+        rows = conn.execute('''
+        SELECT *, expiry_day - ? AS days_left, NULL AS score FROM medicines
+        WHERE name LIKE ? OR description LIKE ? OR category LIKE ? OR manufacturer LIKE ?
+        ORDER BY name, id LIMIT ?
+        ''', [today] + [f'%{query}%'] * 4 + [limit])
+    return [dict(row) for row in rows]
+
+def get_archive_dir():
+    # Each branch archives into its own subdirectory
+    store = db.get_store()
+    archive_dir = current_app.config['ARCHIVE_DIR']
+    return archive_dir if store is None else os.path.join(archive_dir, store)
+
+def get_medicines_page(query=None):
+    after, before, page_size = get_page_args()
+    conn = get_db_connection()
+    
+    # Ranked full-text search when FTS5 is available
+    match = search_index.build_match_query(query) if query else ''
+    if match and search_index.has_search_index(conn):
+        select, params = search_index.ranked_search_select(today_day())
+        params.append(match)
+        return fetch_page(conn, select, [], params, [('score', 'score'), ('id', 'id')],
+                          after=after, before=before, page_size=page_size)
+    
+    where, params = [], [today_day()]
+    if query:
+        where.append('name LIKE ? OR description LIKE ? OR category LIKE ? OR manufacturer LIKE ?')
+        params.extend([f'%{query}%'] * 4)
+    
+    return fetch_page(conn, 'SELECT *, expiry_day - ? AS days_left FROM medicines',
+                      where, params, [('name', 'name'), ('id', 'id')],
+                      after=after, before=before, page_size=page_size)
+
+def get_transactions_page():
+    after, before, page_size = get_page_args()
     
-    # Get expiring medicines count (within 90 days)
-    expiring_medicines = len(get_expiring_medicines(90))
+    return fetch_page(replica.get_report_connection(), '''
+    SELECT t.*, m.name as medicine_name 
+    FROM transactions t 
+    JOIN medicines m ON t.medicine_id = m.id
+    ''', [], [], [('t.transaction_date', 'transaction_date'), ('t.id', 'id')],
+                      descending=True, after=after, before=before, page_size=page_size)
+
+# Routes
+@route('/')
+def index():
+    conn = get_db_connection()
     
-    # Get low stock medicines count
-    low_stock_medicines = len(get_low_stock_medicines())
+    # Counters are maintained incrementally by the dashboard summary tables
+    summary = dashboard.get_dashboard_summary(conn, 90)
     
     # Get recent transactions
     recent_transactions = conn.execute('''
@@ -138,37 +364,31 @@ def index():
     # Get expiring soon medicines
     expiring_soon = get_expiring_medicines(30)
     
-    conn.close()
+    # The page subscribes to /events from here and applies changes in place
+    last_event_id = events.get_last_transaction_id(conn)
     
     return render_template('index.html', 
-                          total_medicines=total_medicines,
-                          expiring_medicines=expiring_medicines,
-                          low_stock_medicines=low_stock_medicines,
+                          total_medicines=summary['total_medicines'],
+                          expiring_medicines=summary['expiring_medicines'],
+                          low_stock_medicines=summary['low_stock_medicines'],
+                          stock_value=summary['stock_value'],
                           recent_transactions=recent_transactions,
-                          expiring_soon=expiring_soon)
+                          expiring_soon=expiring_soon,
+                          last_event_id=last_event_id)
 
-@app.route('/medicines')
+@route('/medicines')
 def medicines():
-    conn = get_db_connection()
-    medicines_data = conn.execute('SELECT * FROM medicines ORDER BY name').fetchall()
-    conn.close()
-    
-    # Calculate days left for each medicine
-    today_date = datetime.now().date()
-    medicines = []
-    for medicine in medicines_data:
-        med_dict = dict(medicine)
-        try:
-            expiry_date = datetime.strptime(medicine['expiry_date'], '%Y-%m-%d').date()
-            days_left = (expiry_date - today_date).days
-            med_dict['days_left'] = days_left
-        except (ValueError, TypeError):
-            med_dict['days_left'] = None
-        medicines.append(med_dict)
+    page = get_medicines_page()
     
-    return render_template('medicines.html', medicines=medicines)
+    return stream_page('medicines.html', medicines=page['items'],
+                       next_cursor=page['next_cursor'], prev_cursor=page['prev_cursor'])
 
-@app.route('/add_medicine', methods=['GET', 'POST'])
+@route('/api/medicines')
+@etag_cached
+def api_medicines():
+    return jsonify(page_to_json(get_medicines_page()))
+
+@route('/add_medicine', methods=['GET', 'POST'])
 def add_medicine():
     if request.method == 'POST':
         name = request.form['name']
@@ -202,17 +422,20 @@ def add_medicine():
         ''', (medicine_id, 'add', quantity, f'Initial stock of {name}'))
         
         conn.commit()
-        conn.close()
+        events.publish()
+        suggest.medicines_added()
         
         flash('Medicine added successfully!', 'success')
         return redirect(url_for('medicines'))
     
     return render_template('add_medicine.html')
 
-@app.route('/edit_medicine/<int:id>', methods=['GET', 'POST'])
+@route('/edit_medicine/<int:id>', methods=['GET', 'POST'])
 def edit_medicine(id):
     conn = get_db_connection()
     medicine = conn.execute('SELECT * FROM medicines WHERE id = ?', (id,)).fetchone()
+    if medicine is None:
+        abort(404)
     
     if request.method == 'POST':
         name = request.form['name']
@@ -225,6 +448,8 @@ def edit_medicine(id):
         purchase_date = request.form['purchase_date']
         expiry_date = request.form['expiry_date']
         price = request.form['price']
+        # The lot the form was rendered with, the current lot may have moved since
+        batch_id = request.form.get('batch_id', type=int)
         
         if not name or not quantity or not expiry_date:
             flash('Name, quantity, and expiry date are required fields!', 'danger')
@@ -235,32 +460,52 @@ def edit_medicine(id):
         new_quantity = int(quantity)
         quantity_diff = new_quantity - old_quantity
         
+        # Product fields live on the medicine, lot fields on the batch shown in the form
         conn.execute('''
         UPDATE medicines
         SET name = ?, description = ?, category = ?, quantity = ?, unit = ?, 
-            manufacturer = ?, batch_number = ?, purchase_date = ?, expiry_date = ?, price = ?
+            manufacturer = ?, price = ?
         WHERE id = ?
-        ''', (name, description, category, quantity, unit, manufacturer, 
-              batch_number, purchase_date, expiry_date, price, id))
+        ''', (name, description, category, quantity, unit, manufacturer, price, id))
+        updated = conn.execute('''
+        UPDATE batches SET batch_number = ?, purchase_date = ?, expiry_date = ? WHERE id = ? AND medicine_id = ?
+        ''', (batch_number, purchase_date, expiry_date, batch_id, id)).rowcount
+        if not updated:
+            conn.rollback()
+            flash('The batch being edited no longer exists, please try again.', 'danger')
+            return redirect(url_for('edit_medicine', id=id))
         
-        # Add transaction record if quantity changed
+        # Added stock joins the current lot, removed stock leaves first-expiry-first-out
+        try:
+            if quantity_diff > 0:
+                conn.execute('UPDATE batches SET quantity = quantity + ? WHERE id = ?',
+                             (quantity_diff, batches.get_current_batch(conn, id)['id']))
+            elif quantity_diff < 0:
+                batches.allocate_fefo(conn, id, -quantity_diff)
+        except ValueError as e:
+            conn.rollback()
+            flash(str(e), 'danger')
+            return redirect(url_for('edit_medicine', id=id))
+        
+        # A quantity edit corrects the count, it is neither a receipt nor
+        # demand, so it is posted as a signed 'correction'
         if quantity_diff != 0:
-            transaction_type = 'add' if quantity_diff > 0 else 'remove'
             conn.execute('''
             INSERT INTO transactions (medicine_id, transaction_type, quantity, notes)
-            VALUES (?, ?, ?, ?)
-            ''', (id, transaction_type, abs(quantity_diff), f'Updated stock of {name}'))
+            VALUES (?, 'correction', ?, ?)
+            ''', (id, quantity_diff, f'Updated stock of {name}'))
         
         conn.commit()
-        conn.close()
+        events.publish()
+        suggest.medicines_changed([medicine['name'], name], [medicine['manufacturer'], manufacturer])
         
         flash('Medicine updated successfully!', 'success')
         return redirect(url_for('medicines'))
     
-    conn.close()
-    return render_template('edit_medicine.html', medicine=medicine)
+    # batch.id goes back as the hidden batch_id field
+    return render_template('edit_medicine.html', medicine=medicine, batch=batches.get_current_batch(conn, id))
 
-@app.route('/delete_medicine/<int:id>', methods=['POST'])
+@route('/delete_medicine/<int:id>', methods=['POST'])
 def delete_medicine(id):
     conn = get_db_connection()
     medicine = conn.execute('SELECT * FROM medicines WHERE id = ?', (id,)).fetchone()
@@ -268,15 +513,17 @@ def delete_medicine(id):
     if medicine:
         conn.execute('DELETE FROM medicines WHERE id = ?', (id,))
         conn.execute('DELETE FROM transactions WHERE medicine_id = ?', (id,))
+        archive.forget_medicine(conn, id)
         conn.commit()
+        events.publish()
+        suggest.medicines_changed([medicine['name']], [medicine['manufacturer']])
         flash('Medicine deleted successfully!', 'success')
     else:
         flash('Medicine not found!', 'danger')
     
-    conn.close()
     return redirect(url_for('medicines'))
 
-@app.route('/update_stock/<int:id>', methods=['GET', 'POST'])
+@route('/update_stock/<int:id>', methods=['GET', 'POST'])
 def update_stock(id):
     conn = get_db_connection()
     medicine = conn.execute('SELECT * FROM medicines WHERE id = ?', (id,)).fetchone()
@@ -285,79 +532,77 @@ def update_stock(id):
         quantity_change = int(request.form['quantity_change'])
         transaction_type = request.form['transaction_type']
         notes = request.form['notes']
+        # Stock received with a batch number and expiry date opens a new lot
+        batch = {field: request.form.get(field) for field in batches.BATCH_FIELDS}
         
-        if transaction_type == 'remove' and quantity_change > medicine['quantity']:
-            flash('Cannot remove more than available stock!', 'danger')
-            conn.close()
+        # The stock check happens in the UPDATE itself so concurrent removals can't oversell
+        try:
+            write_queue.submit(stock.adjust_stock, id, transaction_type, quantity_change, notes, batch)
+        except stock.InsufficientStock:
+            flash('Cannot remove more than available stock! Expired lots can only be written off.', 'danger')
             return redirect(url_for('update_stock', id=id))
-        
-        # Update medicine quantity
-        new_quantity = medicine['quantity'] + quantity_change if transaction_type == 'add' else medicine['quantity'] - quantity_change
-        
-        conn.execute('UPDATE medicines SET quantity = ? WHERE id = ?', (new_quantity, id))
-        
-        # Add transaction record
-        conn.execute('''
-        INSERT INTO transactions (medicine_id, transaction_type, quantity, notes)
-        VALUES (?, ?, ?, ?)
-        ''', (id, transaction_type, quantity_change, notes))
-        
-        conn.commit()
-        conn.close()
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('update_stock', id=id))
+        events.publish()
         
         flash('Stock updated successfully!', 'success')
         return redirect(url_for('medicines'))
     
-    conn.close()
-    return render_template('update_stock.html', medicine=medicine)
+    medicine_batches = conn.execute('''
+    SELECT *, expiry_day - ? AS days_left FROM batches
+    WHERE medicine_id = ? AND quantity > 0 ORDER BY expiry_day, id
+    ''', (today_day(), id)).fetchall()
+    return render_template('update_stock.html', medicine=medicine, batches=medicine_batches)
+
+@route('/write_off_expired/<int:id>', methods=['POST'])
+def write_off_expired(id):
+    quantity = write_queue.submit(stock.write_off_expired, id, request.form.get('notes'))
+    if quantity:
+        events.publish()
+        flash(f'{quantity} expired units written off.', 'success')
+    else:
+        flash('No expired stock to write off.', 'warning')
+    return redirect(url_for('update_stock', id=id))
 
-@app.route('/transactions')
+@route('/transactions')
 def transactions():
-    conn = get_db_connection()
-    transactions = conn.execute('''
-    SELECT t.*, m.name as medicine_name 
-    FROM transactions t 
-    JOIN medicines m ON t.medicine_id = m.id 
-    ORDER BY t.transaction_date DESC
-    ''').fetchall()
-    conn.close()
-    return render_template('transactions.html', transactions=transactions)
+    page = get_transactions_page()
+    return stream_page('transactions.html', transactions=page['items'],
+                       next_cursor=page['next_cursor'], prev_cursor=page['prev_cursor'])
 
-@app.route('/expiring')
+@route('/api/transactions')
+@etag_cached(get_connection=replica.get_report_connection)
+def api_transactions():
+    return jsonify(page_to_json(get_transactions_page()))
+
+@route('/expiring')
 def expiring():
     days = request.args.get('days', 90, type=int)
     expiring_medicines = get_expiring_medicines(days)
     
     return render_template('expiring.html', medicines=expiring_medicines, days=days)
 
-@app.route('/low_stock')
+@route('/low_stock')
 def low_stock():
     threshold = request.args.get('threshold', 10, type=int)
-    low_stock_medicines = get_low_stock_medicines(threshold)
+    medicines = iter_low_stock_medicines(threshold)
     
-    # Calculate days left for each medicine
-    today_date = datetime.now().date()
-    medicines = []
-    for medicine in low_stock_medicines:
-        med_dict = dict(medicine)
-        try:
-            expiry_date = datetime.strptime(medicine['expiry_date'], '%Y-%m-%d').date()
-            days_left = (expiry_date - today_date).days
-            med_dict['days_left'] = days_left
-        except (ValueError, TypeError):
-            med_dict['days_left'] = None
-        medicines.append(med_dict)
-    
-    return render_template('low_stock.html', medicines=medicines, threshold=threshold)
+    return stream_page('low_stock.html', medicines=medicines, threshold=threshold)
+
+@route('/api/low_stock')
+@etag_cached
+def api_low_stock():
+    threshold = request.args.get('threshold', 10, type=int)
+    return jsonify([dict(medicine) for medicine in get_low_stock_medicines(threshold)])
 
-@app.route('/suppliers')
+@route('/suppliers')
 def suppliers():
     conn = get_db_connection()
     suppliers = conn.execute('SELECT * FROM suppliers ORDER BY name').fetchall()
-    conn.close()
     return render_template('suppliers.html', suppliers=suppliers)
 
-@app.route('/add_supplier', methods=['GET', 'POST'])
+@route('/add_supplier', methods=['GET', 'POST'])
 def add_supplier():
     if request.method == 'POST':
         name = request.form['name']
@@ -377,14 +622,13 @@ def add_supplier():
         ''', (name, contact_person, phone, email, address))
         
         conn.commit()
-        conn.close()
         
         flash('Supplier added successfully!', 'success')
         return redirect(url_for('suppliers'))
     
     return render_template('add_supplier.html')
 
-@app.route('/edit_supplier/<int:id>', methods=['GET', 'POST'])
+@route('/edit_supplier/<int:id>', methods=['GET', 'POST'])
 def edit_supplier(id):
     conn = get_db_connection()
     supplier = conn.execute('SELECT * FROM suppliers WHERE id = ?', (id,)).fetchone()
@@ -407,15 +651,13 @@ def edit_supplier(id):
         ''', (name, contact_person, phone, email, address, id))
         
         conn.commit()
-        conn.close()
         
         flash('Supplier updated successfully!', 'success')
         return redirect(url_for('suppliers'))
     
-    conn.close()
     return render_template('edit_supplier.html', supplier=supplier)
 
-@app.route('/delete_supplier/<int:id>', methods=['POST'])
+@route('/delete_supplier/<int:id>', methods=['POST'])
 def delete_supplier(id):
     conn = get_db_connection()
     supplier = conn.execute('SELECT * FROM suppliers WHERE id = ?', (id,)).fetchone()
@@ -427,40 +669,144 @@ def delete_supplier(id):
     else:
         flash('Supplier not found!', 'danger')
     
-    conn.close()
     return redirect(url_for('suppliers'))
 
-@app.route('/search')
+@route('/suppliers/<int:id>/catalogue', methods=['GET', 'POST'])
+def supplier_catalogue(id):
+    conn = get_db_connection()
+    supplier = conn.execute('SELECT * FROM suppliers WHERE id = ?', (id,)).fetchone()
+    if supplier is None:
+        abort(404)
+    
+    if request.method == 'POST':
+        try:
+            entry = purchasing.parse_catalogue_entry(request.form)
+            write_queue.submit(purchasing.save_catalogue_entry, id, *entry)
+        except ValueError as e:
+            flash(str(e), 'danger')
+        else:
+            flash('Catalogue updated successfully!', 'success')
+        return redirect(url_for('supplier_catalogue', id=id))
+    
+    return render_template('supplier_catalogue.html', supplier=supplier,
+                           catalogue=purchasing.get_catalogue(conn, id))
+
+@route('/suppliers/<int:id>/catalogue/<int:medicine_id>/delete', methods=['POST'])
+def delete_catalogue_entry(id, medicine_id):
+    conn = get_db_connection()
+    conn.execute('DELETE FROM supplier_medicines WHERE supplier_id = ? AND medicine_id = ?', (id, medicine_id))
+    conn.commit()
+    flash('Catalogue entry removed!', 'success')
+    return redirect(url_for('supplier_catalogue', id=id))
+
+@route('/api/suppliers/<int:id>/catalogue')
+def api_supplier_catalogue(id):
+    return jsonify(purchasing.get_catalogue(get_db_connection(), id))
+
+@route('/purchase_orders')
+def purchase_orders():
+    status = request.args.get('status')
+    orders = purchasing.get_orders(get_db_connection(), status)
+    return render_template('purchase_orders.html', orders=orders, status=status)
+
+@route('/api/purchase_orders')
+def api_purchase_orders():
+    return jsonify(purchasing.get_orders(get_db_connection(), request.args.get('status')))
+
+@route('/purchase_orders/generate', methods=['POST'])
+def generate_orders():
+    result = generate_purchase_orders()
+    flash(f"Created {len(result['orders'])} draft purchase orders.", 'success')
+    if result['unassigned']:
+        flash(f"{result['unassigned']} low stock medicines have no supplier in any catalogue.", 'warning')
+    return redirect(url_for('purchase_orders', status='draft'))
+
+@route('/api/purchase_orders/generate', methods=['POST'])
+def api_generate_orders():
+    return jsonify(generate_purchase_orders())
+
+@route('/purchase_orders/<int:id>')
+def purchase_order(id):
+    order = purchasing.get_order(get_db_connection(), id)
+    if order is None:
+        abort(404)
+    return render_template('purchase_order.html', order=order)
+
+@route('/api/purchase_orders/<int:id>')
+def api_purchase_order(id):
+    order = purchasing.get_order(get_db_connection(), id)
+    if order is None:
+        abort(404)
+    return jsonify(order)
+
+@route('/purchase_orders/<int:id>/receive', methods=['POST'])
+def receive_purchase_order(id):
+    try:
+        write_queue.submit(purchasing.receive_order, id, purchasing.parse_receipt_form(request.form),
+                           request.form.get('notes'))
+    except ValueError as e:
+        flash(str(e), 'danger')
+    else:
+        events.publish()
+        flash('Purchase order received, stock updated!', 'success')
+    return redirect(url_for('purchase_order', id=id))
+
+@route('/api/purchase_orders/<int:id>/receive', methods=['POST'])
+def api_receive_purchase_order(id):
+    payload = request.get_json(silent=True) or {}
+    try:
+        lots = purchasing.parse_receipt(payload.get('lines', []))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        write_queue.submit(purchasing.receive_order, id, lots, payload.get('notes'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    events.publish()
+    return jsonify(purchasing.get_order(get_db_connection(), id))
+
+@route('/purchase_orders/<int:id>/delete', methods=['POST'])
+def delete_purchase_order(id):
+    try:
+        write_queue.submit(purchasing.delete_order, id)
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('purchase_order', id=id))
+    flash('Draft purchase order deleted!', 'success')
+    return redirect(url_for('purchase_orders'))
+
+@route('/search')
 def search():
     query = request.args.get('query', '')
     if not query:
         return redirect(url_for('medicines'))
     
-    conn = get_db_connection()
-    medicines_data = conn.execute('''
-    SELECT * FROM medicines 
-    WHERE name LIKE ? OR description LIKE ? OR category LIKE ? OR manufacturer LIKE ?
-    ORDER BY name
-    ''', (f'%{query}%', f'%{query}%', f'%{query}%', f'%{query}%')).fetchall()
-    
-    conn.close()
-    
-    # Calculate days left for each medicine
-    today_date = datetime.now().date()
-    medicines = []
-    for medicine in medicines_data:
-        med_dict = dict(medicine)
-        try:
-            expiry_date = datetime.strptime(medicine['expiry_date'], '%Y-%m-%d').date()
-            days_left = (expiry_date - today_date).days
-            med_dict['days_left'] = days_left
-        except (ValueError, TypeError):
-            med_dict['days_left'] = None
-        medicines.append(med_dict)
+    page = get_medicines_page(query)
+    
+    return stream_page('search_results.html', medicines=page['items'], query=query,
+                       next_cursor=page['next_cursor'], prev_cursor=page['prev_cursor'])
+
+@route('/api/search')
+@etag_cached
+def api_search():
+    query = request.args.get('query', '')
+    if not query:
+        return jsonify({'items': [], 'next_cursor': None, 'prev_cursor': None})
     
-    return render_template('search_results.html', medicines=medicines, query=query)
+    return jsonify(page_to_json(get_medicines_page(query)))
 
-@app.route('/api/expiring_medicines')
+@route('/api/suggest')
+def api_suggest():
+    # Answered from memory, so not worth an ETag round trip
+    if not current_app.config['SUGGEST_ENABLED']:
+        abort(404)
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', current_app.config['SUGGEST_LIMIT'], type=int)
+    limit = max(1, min(limit, current_app.config['MAX_SUGGEST_LIMIT']))
+    return jsonify(suggest.get_index(store=db.get_store()).suggest(query, limit))
+
+@route('/api/expiring_medicines')
+@etag_cached(get_connection=replica.get_report_connection)
 def api_expiring_medicines():
     days = request.args.get('days', 90, type=int)
     expiring_medicines = get_expiring_medicines(days)
@@ -477,37 +823,281 @@ def api_expiring_medicines():
     
     return jsonify(result)
 
-@app.route('/discount_offers')
+@route('/api/dispense', methods=['POST'])
+def api_dispense():
+    payload = request.get_json(silent=True)
+    try:
+        lines = stock.parse_basket(payload)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        write_queue.submit(stock.dispense_basket, lines, payload.get('notes'))
+    except stock.InsufficientStock as e:
+        return jsonify({'error': 'Insufficient stock', 'shortages': e.shortages}), 409
+    events.publish()
+    
+    return jsonify({'dispensed': [{'medicine_id': medicine_id, 'quantity': quantity}
+                                  for medicine_id, quantity in lines]})
+
+@route('/discount_offers')
 def discount_offers():
-    # Get medicines expiring within 15 days
-    expiring_medicines = get_expiring_medicines(15)
+    return render_template('discount_offers.html', medicines=get_discount_offers())
+
+@route('/api/discount_offers')
+@etag_cached(get_connection=replica.get_report_connection)
+def api_discount_offers():
+    return jsonify(get_discount_offers())
+
+@route('/reports/categories')
+def report_categories():
+    return render_template('report_categories.html', **get_category_report())
+
+@route('/api/reports/categories')
+@etag_cached(get_connection=replica.get_report_connection)
+def api_report_categories():
+    return jsonify(get_category_report())
+
+@route('/reports/medicines')
+def report_medicines():
+    return render_template('report_medicines.html', **get_medicine_report())
+
+@route('/api/reports/medicines')
+@etag_cached(get_connection=replica.get_report_connection)
+def api_report_medicines():
+    return jsonify(get_medicine_report())
+
+@route('/reports/daily')
+def report_daily():
+    return render_template('report_daily.html', **get_daily_report())
+
+@route('/api/reports/daily')
+@etag_cached(get_connection=replica.get_report_connection)
+def api_report_daily():
+    return jsonify(get_daily_report())
+
+@route('/events')
+def event_stream():
+    # Last-Event-ID is sent by EventSource on reconnect, the query string
+    # lets a freshly loaded page resume from the id it was rendered with
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        abort(400)
     
-    # Calculate recommended discount based on days left
-    for medicine in expiring_medicines:
-        days_left = medicine.get('days_left', 0)
-        if days_left <= 5:
-            # 50% discount for medicines expiring in 5 days or less
-            medicine['recommended_discount'] = 50
-        elif days_left <= 10:
-            # 30% discount for medicines expiring in 6-10 days
-            medicine['recommended_discount'] = 30
-        else:
-            # 15% discount for medicines expiring in 11-15 days
-            medicine['recommended_discount'] = 15
-            
-        # Calculate discounted price
+    stream = events.stream_changes(current_app._get_current_object(), last_event_id, db.get_store())
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@route(CHAIN_PREFIX + 'summary')
+def api_chain_summary():
+    outcome = shards.fan_out(lambda: dashboard.get_dashboard_summary(get_db_connection(), 90))
+    
+    totals = {'total_medicines': 0, 'low_stock_medicines': 0, 'expiring_medicines': 0, 'stock_value': 0}
+    for summary in outcome['results'].values():
+        for key in totals:
+            totals[key] += summary[key]
+    totals['stock_value'] = round(totals['stock_value'], 2)
+    
+    by_store = {shards.store_key(store): summary for store, summary in outcome['results'].items()}
+    return jsonify(shards.outcome_to_json(outcome, totals=totals, by_store=by_store))
+
+@route(CHAIN_PREFIX + 'low_stock')
+def api_chain_low_stock():
+    threshold = request.args.get('threshold', 10, type=int)
+    outcome = shards.fan_out(get_low_stock_medicines, threshold)
+    items = shards.merge_rows(outcome, lambda row: (row['quantity'], row['name']))
+    return jsonify(shards.outcome_to_json(outcome, items=items))
+
+@route(CHAIN_PREFIX + 'expiring')
+def api_chain_expiring():
+    days = request.args.get('days', 30, type=int)
+    outcome = shards.fan_out(get_expiring_medicines, days)
+    items = shards.merge_rows(outcome, lambda row: (row['expiry_day'], row['name']))
+    return jsonify(shards.outcome_to_json(outcome, items=items))
+
+@route(CHAIN_PREFIX + 'search')
+def api_chain_search():
+    query = request.args.get('q', '')
+    if not query:
+        return jsonify({'error': 'Missing search query'}), 400
+    limit = min(request.args.get('limit', current_app.config['PAGE_SIZE'], type=int),
+                current_app.config['MAX_PAGE_SIZE'])
+    
+    # bm25 scores are comparable enough across shards of the same catalogue
+    outcome = shards.fan_out(search_medicines, query, limit)
+    items = shards.merge_rows(outcome, lambda row: (row['score'] is None, row['score'] or 0, row['name']),
+                              limit=limit)
+    return jsonify(shards.outcome_to_json(outcome, items=items))
+
+@route('/metrics')
+def metrics_endpoint():
+    if not current_app.config['METRICS_ENABLED']:
+        abort(404)
+    return Response(metrics.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@route('/export/<table>')
+def export_table(table):
+    fmt = request.args.get('format', 'csv')
+    if table not in export.EXPORT_TABLES:
+        abort(404)
+    if fmt not in export.EXPORT_FORMATS:
+        abort(400)
+    
+    compress = request.args.get('gzip', type=int) == 1
+    
+    # The export runs while the body is sent, so it checks out its own
+    # connection inside the stream
+    def chunks():
+        yield from export.generate_export(replica.get_report_connection(), table, fmt,
+                                          start=request.args.get('start'),
+                                          end=request.args.get('end'),
+                                          medicine_id=request.args.get('medicine_id', type=int),
+                                          compress=compress,
+                                          archive_dir=get_archive_dir())
+    
+    filename = f'{table}.{fmt}' + ('.gz' if compress else '')
+    mimetype = 'application/gzip' if compress else export.EXPORT_FORMATS[fmt]
+    return Response(stream_with_context(chunks()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@route('/import/medicines', methods=['POST'])
+def import_medicines():
+    # Accepts a multipart upload in 'file' or the CSV/JSON document as the request body
+    upload = request.files.get('file')
+    if upload:
+        stream, filename, mimetype = upload.stream, upload.filename or '', upload.mimetype
+    else:
+        stream, filename, mimetype = request.stream, '', request.mimetype
+    
+    fmt = request.args.get('format')
+    if not fmt:
+        is_json = filename.endswith(('.json', '.ndjson')) or mimetype in ('application/json', 'application/x-ndjson')
+        fmt = 'json' if is_json else 'csv'
+    
+    try:
+        result = importer.import_file(get_db_connection(), stream, fmt,
+                                      strict=request.args.get('strict', type=int) == 1)
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({'imported': 0, 'errors': [{'row': None, 'error': str(e)}]}), 400
+    if result['imported']:
+        events.publish()
+        suggest.medicines_added()
+    
+    return jsonify(result), (200 if result['imported'] or not result['errors'] else 400)
+
+def store_option(command):
+    # CLI commands act on the main database unless --store names a branch shard
+    @click.option('--store', help='Branch shard to use instead of the main database.')
+    @wraps(command)
+    def wrapper(*args, store=None, **kwargs):
+        if store is not None:
+            if store not in current_app.config['STORES']:
+                raise click.BadParameter(f'Unknown store {store}', param_hint='--store')
+            g.store_id = store
+        return command(*args, **kwargs)
+    return wrapper
+
+@cli.command('import-medicines')
+@click.argument('file', type=click.File('rb'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'json']))
+@click.option('--strict', is_flag=True, help='Import nothing if any row is invalid.')
+@store_option
+def import_medicines_command(file, fmt, strict):
+    fmt = fmt or ('json' if file.name.endswith(('.json', '.ndjson')) else 'csv')
+    result = importer.import_file(get_db_connection(), file, fmt, strict=strict)
+    for error in result['errors']:
+        print(f"Row {error['row']}: {error['error']}")
+    print(f"Imported {result['imported']} medicines.")
+
+@cli.command('export')
+@click.argument('table', type=click.Choice(list(export.EXPORT_TABLES)))
+@click.option('--format', 'fmt', type=click.Choice(list(export.EXPORT_FORMATS)), default='csv')
+@click.option('--start', help='First transaction date to include (YYYY-MM-DD).')
+@click.option('--end', help='Last transaction date to include (YYYY-MM-DD).')
+@click.option('--medicine-id', type=int)
+@click.option('--gzip', 'compress', is_flag=True)
+@click.option('--output', type=click.File('wb'), default='-')
+@store_option
+def export_command(table, fmt, start, end, medicine_id, compress, output):
+    for chunk in export.generate_export(replica.get_report_connection(), table, fmt, start=start, end=end,
+                                        medicine_id=medicine_id, compress=compress,
+                                        archive_dir=get_archive_dir()):
+        output.write(chunk)
+
+@cli.command('migrate')
+def migrate_command():
+    # The main database and every branch shard
+    for store in [None] + list(current_app.config['STORES']):
+        db_dir = os.path.dirname(db.get_db_path(current_app, store))
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        
+        pool = db.get_pool(store=store)
+        conn = pool.acquire()
         try:
-            if medicine['price']:
-                original_price = float(medicine['price'])
-                discount_percent = medicine['recommended_discount']
-                medicine['discounted_price'] = round(original_price * (1 - discount_percent/100), 2)
-            else:
-                medicine['discounted_price'] = None
-        except (ValueError, TypeError):
-            # Handle any conversion errors
-            medicine['discounted_price'] = None
-    
-    return render_template('discount_offers.html', medicines=expiring_medicines)
+            applied = migrations.migrate(conn)
+        finally:
+            pool.release(conn)
+        
+        prefix = f'[{store}] ' if store is not None else ''
+        for name in applied:
+            print(f'{prefix}Applied {name}')
+        print(f'{prefix}Database schema is at version {migrations.SCHEMA_VERSION}.')
+
+@cli.command('archive-transactions')
+@click.option('--keep-months', type=int, help='Most recent months to keep in the main database.')
+@store_option
+def archive_transactions_command(keep_months):
+    keep_months = keep_months or current_app.config['ARCHIVE_KEEP_MONTHS']
+    archived = archive.archive_closed_months(get_db_connection(), get_archive_dir(),
+                                             max(1, keep_months))
+    for month, moved in archived:
+        print(f'Archived {moved} transactions from {month}')
+    print(f'{len(archived)} months archived.')
+
+@cli.command('forecast')
+@store_option
+def forecast_command():
+    updated = update_forecast()
+    if updated is None:
+        print('Reorder points are up to date.')
+    else:
+        print(f'Recomputed reorder points for {updated} medicines.')
+
+@cli.command('generate-orders')
+@store_option
+def generate_orders_command():
+    result = generate_purchase_orders()
+    for order in result['orders']:
+        print(f"Purchase order {order['id']}: {order['lines']} lines from {order['supplier_name']}")
+    print(f"{len(result['orders'])} draft purchase orders created.")
+    if result['unassigned']:
+        print(f"{result['unassigned']} low stock medicines have no supplier.")
+
+@cli.command('write-off-expired')
+@store_option
+def write_off_expired_command():
+    written_off = write_queue.submit(stock.write_off_all_expired)
+    for medicine_id, quantity in written_off:
+        print(f'Medicine {medicine_id}: {quantity} expired units written off')
+    print(f'Expired stock written off for {len(written_off)} medicines.')
+
+@cli.command('rebuild-dashboard')
+@store_option
+def rebuild_dashboard_command():
+    conn = get_db_connection()
+    dashboard.rebuild_summary(conn)
+    conn.commit()
+    print('Dashboard summary rebuilt.')
+
+@cli.command('refresh-replica')
+@store_option
+def refresh_replica_command():
+    target = replica.get_replica(store=db.get_store())
+    target.refresh()
+    print(f'Report replica written to {target.path}.')
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
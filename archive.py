@@ -0,0 +1,165 @@
+import os
+from datetime import date
+from db import utc_today
+
+# Closed months of the transactions ledger are moved out of the hot database
+# into one SQLite file per month (transactions_YYYY_MM.db). Each file also
+# holds the per-medicine opening balance at the start of its month, and the
+# hot database keeps the running total of everything archived in
+# archived_balances, so for every medicine:
+#   archived_balances.quantity + net hot transactions = current stock
+# Partition files are only ATTACHed while a query needs their month.
+ARCHIVE_ALIAS = 'archive_part'
+
+def create_archive_tables(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS archive_partitions (
+        month TEXT PRIMARY KEY,
+        filename TEXT NOT NULL,
+        transactions INTEGER NOT NULL,
+        archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS archived_balances (
+        medicine_id INTEGER PRIMARY KEY,
+        quantity INTEGER NOT NULL
+    )
+    ''')
+
+def month_start(year, month):
+    return date(year, month, 1)
+
+def next_month(day):
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+def partition_filename(month):
+    return 'transactions_%s.db' % month.strftime('%Y_%m')
+
+def archive_cutoff(keep_months, today=None):
+    # First day of the oldest month that stays in the hot database
+    today = today or utc_today()
+    index = today.year * 12 + today.month - 1 - (keep_months - 1)
+    return month_start(index // 12, index % 12 + 1)
+
+def archive_closed_months(conn, archive_dir, keep_months):
+    cutoff = archive_cutoff(keep_months)
+    archived = []
+    
+    while True:
+        oldest = conn.execute('SELECT MIN(transaction_date) FROM transactions').fetchone()[0]
+        if oldest is None:
+            break
+        month = month_start(int(oldest[:4]), int(oldest[5:7]))
+        if month >= cutoff:
+            break
+        archived.append((month.strftime('%Y-%m'), archive_month(conn, archive_dir, month)))
+    
+    return archived
+
+def archive_month(conn, archive_dir, month):
+    os.makedirs(archive_dir, exist_ok=True)
+    filename = partition_filename(month)
+    path = os.path.join(archive_dir, filename)
+    start, end = month.isoformat(), next_month(month).isoformat()
+    
+    # A file without a catalog entry is left over from an interrupted run
+    known = conn.execute('SELECT 1 FROM archive_partitions WHERE month = ?',
+                         (month.strftime('%Y-%m'),)).fetchone()
+    if known:
+        raise RuntimeError(f'{month:%Y-%m} is already archived but still has transactions')
+    if os.path.exists(path):
+        os.remove(path)
+    
+    conn.execute('ATTACH DATABASE ? AS %s' % ARCHIVE_ALIAS, (path,))
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('''
+            CREATE TABLE %s.transactions (
+                id INTEGER PRIMARY KEY,
+                medicine_id INTEGER,
+                transaction_type TEXT NOT NULL,
+                quantity INTEGER NOT NULL,
+                transaction_date TEXT,
+                notes TEXT
+            )
+            ''' % ARCHIVE_ALIAS)
+            conn.execute('CREATE INDEX %s.idx_transactions_date ON transactions (transaction_date)' % ARCHIVE_ALIAS)
+            conn.execute('''
+            CREATE TABLE %s.opening_balances (
+                medicine_id INTEGER PRIMARY KEY,
+                quantity INTEGER NOT NULL
+            )
+            ''' % ARCHIVE_ALIAS)
+            
+            # Opening balance of this month is everything archived before it
+            conn.execute('''
+            INSERT INTO %s.opening_balances (medicine_id, quantity)
+            SELECT medicine_id, quantity FROM main.archived_balances
+            ''' % ARCHIVE_ALIAS)
+            
+            moved = conn.execute('''
+            INSERT INTO %s.transactions (id, medicine_id, transaction_type, quantity, transaction_date, notes)
+            SELECT id, medicine_id, transaction_type, quantity, transaction_date, notes
+            FROM main.transactions
+            WHERE transaction_date >= ? AND transaction_date < ?
+            ''' % ARCHIVE_ALIAS, (start, end)).rowcount
+            
+            conn.execute('''
+            INSERT INTO main.archived_balances (medicine_id, quantity)
+            SELECT medicine_id,
+                   SUM(CASE WHEN transaction_type IN ('remove', 'write_off') THEN -quantity ELSE quantity END)
+            FROM %s.transactions
+            GROUP BY medicine_id
+            ON CONFLICT (medicine_id) DO UPDATE SET quantity = quantity + excluded.quantity
+            ''' % ARCHIVE_ALIAS)
+            
+            conn.execute('''
+            DELETE FROM main.transactions WHERE transaction_date >= ? AND transaction_date < ?
+            ''', (start, end))
+            conn.execute('''
+            INSERT INTO main.archive_partitions (month, filename, transactions) VALUES (?, ?, ?)
+            ''', (month.strftime('%Y-%m'), filename, moved))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    finally:
+        conn.execute('DETACH DATABASE %s' % ARCHIVE_ALIAS)
+    
+    return moved
+
+def find_partitions(conn, start=None, end=None):
+    # Months are 'YYYY-MM', dates 'YYYY-MM-DD', so both compare as strings
+    conditions, params = [], []
+    if start:
+        conditions.append('month >= substr(?, 1, 7)')
+        params.append(start)
+    if end:
+        conditions.append('month <= substr(?, 1, 7)')
+        params.append(end)
+    
+    sql = 'SELECT month, filename FROM archive_partitions'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY month'
+    return conn.execute(sql, params).fetchall()
+
+def iter_partitions(conn, archive_dir, start=None, end=None):
+    # Attach one partition at a time and yield the table name to query;
+    # the caller must finish its statement before asking for the next one
+    for partition in find_partitions(conn, start, end):
+        path = os.path.join(archive_dir, partition['filename'])
+        if not os.path.exists(path):
+            raise RuntimeError(f"Archive partition {partition['filename']} is missing")
+        
+        conn.execute('ATTACH DATABASE ? AS %s' % ARCHIVE_ALIAS, (path,))
+        try:
+            yield '%s.transactions' % ARCHIVE_ALIAS
+        finally:
+            conn.execute('DETACH DATABASE %s' % ARCHIVE_ALIAS)
+
+def forget_medicine(conn, medicine_id):
+    # Archived history stays in the partition files for auditing
+    conn.execute('DELETE FROM archived_balances WHERE medicine_id = ?', (medicine_id,))
@@ -0,0 +1,191 @@
+from datetime import date
+from db import EPOCH, EXPIRY_DAY_SQL, today_day
+
+# Stock is held in batches (lots), each with its own batch number, expiry
+# and quantity. medicines.quantity stays the total over all batches, and the
+# medicine's batch_number, expiry_date and purchase_date mirror its current
+# lot: the earliest-expiring batch still in stock. Removals are allocated
+# first-expiry-first-out through the (medicine_id, expiry_day) index, and
+# stock past its expiry day is never dispensed, only written off.
+
+BATCH_FIELDS = ['batch_number', 'expiry_date', 'purchase_date']
+
+# Per-batch rows: the medicine's fields with the lot's own batch number,
+# expiry and quantity (medicines m, batches b)
+BATCH_COLUMNS = '''m.id, m.name, m.description, m.category, m.unit, m.manufacturer, m.price,
+       m.created_at, m.quantity AS total_quantity, b.id AS batch_id, b.batch_number,
+       b.quantity, b.expiry_date, b.expiry_day, b.purchase_date'''
+
+def create_batches_table(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS batches (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        medicine_id INTEGER NOT NULL,
+        batch_number TEXT,
+        quantity INTEGER NOT NULL,
+        expiry_date TEXT NOT NULL,
+        expiry_day INTEGER,
+        purchase_date TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (medicine_id) REFERENCES medicines (id)
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_batches_medicine_expiry ON batches (medicine_id, expiry_day)')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_batches_expiry_day
+    ON batches (expiry_day) WHERE quantity > 0
+    ''')
+    
+    # Every existing medicine row becomes its first batch
+    backfill_batches(cursor)
+    
+    # New medicines arrive with their opening lot
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS batches_medicines_insert
+    AFTER INSERT ON medicines
+    BEGIN
+        INSERT INTO batches (medicine_id, batch_number, quantity, expiry_date, expiry_day, purchase_date)
+        VALUES (NEW.id, NEW.batch_number, NEW.quantity, NEW.expiry_date, %s, NEW.purchase_date);
+    END
+    ''' % EXPIRY_DAY_SQL.format('NEW.expiry_date'))
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS batches_medicines_delete
+    AFTER DELETE ON medicines
+    BEGIN
+        DELETE FROM batches WHERE medicine_id = OLD.id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS batches_expiry_day_update
+    AFTER UPDATE OF expiry_date ON batches
+    BEGIN
+        UPDATE batches SET expiry_day = %s WHERE id = NEW.id;
+    END
+    ''' % EXPIRY_DAY_SQL.format('NEW.expiry_date'))
+    
+    # Keep the medicine's lot fields on its current batch
+    for event, row in [('insert', 'NEW'), ('update', 'NEW'), ('delete', 'OLD')]:
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS batches_current_lot_%(event)s
+        AFTER %(trigger_event)s ON batches
+        BEGIN
+            UPDATE medicines
+            SET batch_number = lot.batch_number, expiry_date = lot.expiry_date,
+                purchase_date = lot.purchase_date
+            FROM (SELECT batch_number, expiry_date, purchase_date FROM batches
+                  WHERE medicine_id = %(row)s.medicine_id AND quantity > 0
+                  ORDER BY expiry_day, id LIMIT 1) AS lot
+            WHERE medicines.id = %(row)s.medicine_id
+            AND (medicines.batch_number IS NOT lot.batch_number
+                 OR medicines.expiry_date IS NOT lot.expiry_date
+                 OR medicines.purchase_date IS NOT lot.purchase_date);
+        END
+        ''' % {'event': event, 'row': row,
+               'trigger_event': 'UPDATE OF quantity, expiry_day, batch_number, purchase_date'
+               if event == 'update' else event.upper()})
+
+def backfill_batches(cursor):
+    # Medicines loaded with triggers off (bulk loads) have no batch yet
+    cursor.execute('''
+    INSERT INTO batches (medicine_id, batch_number, quantity, expiry_date, expiry_day, purchase_date)
+    SELECT id, batch_number, quantity, expiry_date, %s, purchase_date FROM medicines
+    WHERE NOT EXISTS (SELECT 1 FROM batches WHERE batches.medicine_id = medicines.id)
+    ''' % EXPIRY_DAY_SQL.format('expiry_date'))
+
+def get_current_batch(conn, medicine_id, today=None):
+    # The lot the medicine row mirrors, or its newest batch when none is in
+    # stock. With today, lots that expired before it are skipped.
+    where, params = 'medicine_id = ?', [medicine_id]
+    if today is not None:
+        where += ' AND expiry_day >= ?'
+        params.append(today)
+    batch = conn.execute('''
+    SELECT * FROM batches WHERE %s AND quantity > 0 ORDER BY expiry_day, id LIMIT 1
+    ''' % where, params).fetchone()
+    if batch is None:
+        batch = conn.execute('''
+        SELECT * FROM batches WHERE %s ORDER BY id DESC LIMIT 1
+        ''' % where, params).fetchone()
+    return batch
+
+def check_expiry_date(expiry_date, today):
+    # ValueError unless expiry_date is a YYYY-MM-DD string, today or later
+    if not isinstance(expiry_date, str):
+        raise ValueError('Expiry date must be a date string (YYYY-MM-DD)')
+    try:
+        expired = (date.fromisoformat(expiry_date) - EPOCH).days < today
+    except ValueError:
+        raise ValueError('Expiry date %s is not a valid date (YYYY-MM-DD)' % expiry_date)
+    if expired:
+        raise ValueError('Expiry date %s has already passed' % expiry_date)
+
+def receive(conn, medicine_id, quantity, batch_number=None, expiry_date=None, purchase_date=None):
+    # Adds to the lot with the same batch number and expiry, or opens a new
+    # one. Without an expiry the stock goes onto the current unexpired lot,
+    # received stock never joins a lot that has expired.
+    today = today_day()
+    if expiry_date:
+        check_expiry_date(expiry_date, today)
+        row = conn.execute('''
+        SELECT id FROM batches WHERE medicine_id = ? AND expiry_date = ? AND batch_number IS ?
+        ''', (medicine_id, expiry_date, batch_number or None)).fetchone()
+        if row is None:
+            conn.execute('''
+            INSERT INTO batches (medicine_id, batch_number, quantity, expiry_date, expiry_day, purchase_date)
+            VALUES (?, ?, ?, ?, %s, ?)
+            ''' % EXPIRY_DAY_SQL.format('?'),
+                         (medicine_id, batch_number or None, quantity, expiry_date, expiry_date, purchase_date or None))
+            return
+        batch_id = row['id']
+    else:
+        batch = get_current_batch(conn, medicine_id, today)
+        if batch is None:
+            raise ValueError('Medicine %d has no unexpired batch, an expiry date is needed to receive it'
+                             % medicine_id)
+        batch_id = batch['id']
+    conn.execute('UPDATE batches SET quantity = quantity + ? WHERE id = ?', (quantity, batch_id))
+
+def allocate_fefo(conn, medicine_id, quantity, today=None):
+    # Takes quantity from the earliest-expiring lots, reading them in index
+    # order and stopping as soon as the quantity is covered. With today, lots
+    # that expired before it are skipped. Returns the (batch_id, quantity)
+    # pairs taken, or None when the lots hold less and nothing was taken.
+    # The caller owns the transaction.
+    where, params = 'medicine_id = ? AND quantity > 0', [medicine_id]
+    if today is not None:
+        where += ' AND expiry_day >= ?'
+        params.append(today)
+    allocation = []
+    remaining = quantity
+    for batch_id, available in conn.execute('''
+    SELECT id, quantity FROM batches WHERE %s
+    ORDER BY expiry_day, id
+    ''' % where, params):
+        take = min(available, remaining)
+        allocation.append((batch_id, take))
+        remaining -= take
+        if remaining == 0:
+            break
+    if remaining:
+        if today is None:
+            raise ValueError('Batches of medicine %d hold less than its stock level' % medicine_id)
+        return None
+    
+    conn.executemany('UPDATE batches SET quantity = quantity - ? WHERE id = ?',
+                     [(take, batch_id) for batch_id, take in allocation])
+    return allocation
+
+def get_sellable_quantity(conn, medicine_id, today):
+    return conn.execute('''
+    SELECT COALESCE(SUM(quantity), 0) FROM batches
+    WHERE medicine_id = ? AND quantity > 0 AND expiry_day >= ?
+    ''', (medicine_id, today)).fetchone()[0]
+
+def take_expired(conn, medicine_id, today):
+    # Empties the medicine's lots that expired before today, returns the
+    # quantity they held
+    expired = conn.execute('''
+    SELECT id, quantity FROM batches WHERE medicine_id = ? AND quantity > 0 AND expiry_day < ?
+    ''', (medicine_id, today)).fetchall()
+    conn.executemany('UPDATE batches SET quantity = 0 WHERE id = ?', [(row[0],) for row in expired])
+    return sum(row[1] for row in expired)
@@ -0,0 +1,290 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import tempfile
+import time
+import tracemalloc
+from datetime import timedelta
+import app as medistore
+import dashboard
+import db
+import importer
+import migrations
+import purchasing
+import sample_data
+
+# Benchmarks every route through the Flask test client, plus the helpers the
+# routes are built on, against a generated dataset. Results are written as
+# JSON so a run can be compared with an earlier baseline:
+#   python benchmark.py --scale 10k --output bench.json
+#   python benchmark.py --scale 10k --baseline bench.json
+
+MEDICINE_FORM = {
+    'name': 'Benchmark Tablet', 'description': 'Benchmark write', 'category': 'Tablet',
+    'quantity': '100', 'unit': 'Tablet', 'manufacturer': 'Benchmark Labs',
+    'batch_number': 'BENCH-1', 'purchase_date': '{today}', 'expiry_date': '2099-12-31', 'price': '1.50',
+}
+
+IMPORT_CSV = ','.join(importer.MEDICINE_FIELDS) + '\n' + ''.join(
+    f'Imported Tablet {i},Benchmark import,Tablet,50,Tablet,Benchmark Labs,IMP-{i},{{today}},2099-12-31,2.00\n'
+    for i in range(100))
+
+# (method, url, request options), {placeholders} are filled in by fill().
+# Writes run last and are repeated on every run: the stock added to
+# {medicine_id} is dispensed again, each run adds a medicine and the
+# imported ones, and generating orders only tops up the drafts. Receiving
+# and deleting an order can only run once and are left out, so is /events,
+# which streams until the client goes away.
+ROUTES = [
+    ('GET', '/', None),
+    ('GET', '/medicines', None),
+    ('GET', '/api/medicines', None),
+    ('GET', '/api/medicines?limit=500', None),
+    ('GET', '/search?query=amox', None),
+    ('GET', '/api/search?query=amox', None),
+    ('GET', '/api/search?query=pa', None),
+    ('GET', '/transactions', None),
+    ('GET', '/api/transactions', None),
+    ('GET', '/expiring', None),
+    ('GET', '/api/expiring_medicines', None),
+    ('GET', '/api/expiring_medicines?days=30', None),
+    ('GET', '/low_stock', None),
+    ('GET', '/api/low_stock', None),
+    ('GET', '/discount_offers', None),
+    ('GET', '/api/discount_offers', None),
+    ('GET', '/suppliers', None),
+    ('GET', '/suppliers/{supplier_id}/catalogue', None),
+    ('GET', '/api/suppliers/{supplier_id}/catalogue', None),
+    ('GET', '/add_medicine', None),
+    ('GET', '/add_supplier', None),
+    ('GET', '/edit_supplier/{supplier_id}', None),
+    ('GET', '/export/transactions?format=ndjson&start={month_ago}', None),
+    ('GET', '/export/medicines?format=csv', None),
+    ('GET', '/edit_medicine/{medicine_id}', None),
+    ('GET', '/update_stock/{medicine_id}', None),
+    ('GET', '/reports/categories', None),
+    ('GET', '/reports/medicines', None),
+    ('GET', '/reports/daily?category=Tablet', None),
+    ('GET', '/api/reports/categories', None),
+    ('GET', '/api/reports/medicines', None),
+    ('GET', '/api/reports/daily?category=Tablet', None),
+    ('GET', '/purchase_orders', None),
+    ('GET', '/purchase_orders/{order_id}', None),
+    ('GET', '/api/purchase_orders?status=draft', None),
+    ('GET', '/api/purchase_orders/{order_id}', None),
+    ('GET', '/api/suggest?q=amoxcilin', None),
+    ('GET', '/api/chain/summary', None),
+    ('GET', '/api/chain/low_stock', None),
+    ('GET', '/api/chain/expiring', None),
+    ('GET', '/api/chain/search?q=amox', None),
+    ('GET', '/metrics', None),
+    ('POST', '/add_medicine', {'data': MEDICINE_FORM}),
+    ('POST', '/edit_medicine/{medicine_id}', {'data': dict(MEDICINE_FORM, batch_id='{batch_id}')}),
+    ('POST', '/update_stock/{medicine_id}', {'data': {'quantity_change': '1', 'transaction_type': 'add',
+                                                      'notes': 'Benchmark'}}),
+    ('POST', '/api/dispense', {'json': {'lines': [{'medicine_id': '{medicine_id}', 'quantity': 1}]}}),
+    ('POST', '/import/medicines?format=csv', {'data': IMPORT_CSV, 'content_type': 'text/csv'}),
+    ('POST', '/api/purchase_orders/generate', None),
+]
+
+HELPERS = {
+    'get_expiring_medicines(90)': lambda: medistore.get_expiring_medicines(90),
+    'get_expiring_medicines(30)': lambda: medistore.get_expiring_medicines(30),
+    'get_low_stock_medicines()': lambda: medistore.get_low_stock_medicines(),
+    'get_discount_offers()': lambda: medistore.get_discount_offers(),
+    'get_dashboard_summary()': lambda: dashboard.get_dashboard_summary(db.get_db_connection()),
+}
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(timings, queries, peak, status=None):
+    result = {
+        'runs': len(timings),
+        'mean_ms': round(statistics.mean(timings) * 1000, 3),
+        'p50_ms': round(percentile(timings, 0.5) * 1000, 3),
+        'p90_ms': round(percentile(timings, 0.9) * 1000, 3),
+        'p99_ms': round(percentile(timings, 0.99) * 1000, 3),
+        'queries': queries,
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
+    if status is not None:
+        result['status'] = status
+    return result
+
+class QueryCounter:
+    # The DB_TRACE callback, counts statements on every connection the app
+    # opens: the request pool, the report replica, the write queue and shards
+    def __init__(self):
+        self.count = 0
+    
+    def __call__(self, statement):
+        # Statements run by triggers are reported with a leading comment, skip them
+        if not statement.startswith('--'):
+            self.count += 1
+
+def fill(value, params):
+    # Formats the placeholders in a URL or request body
+    if isinstance(value, str):
+        formatted = value.format(**params)
+        return int(formatted) if formatted.isdigit() and value != formatted else formatted
+    if isinstance(value, dict):
+        return {key: fill(item, params) for key, item in value.items()}
+    if isinstance(value, list):
+        return [fill(item, params) for item in value]
+    return value
+
+def get_route_params(path):
+    conn = sqlite3.connect(path)
+    try:
+        medicine_id = conn.execute('SELECT MAX(id) FROM medicines WHERE quantity > 1').fetchone()[0]
+        return {
+            'today': db.utc_today().isoformat(),
+            'month_ago': (db.utc_today() - timedelta(days=30)).isoformat(),
+            'medicine_id': medicine_id,
+            # The lot the edit form writes its batch fields to
+            'batch_id': conn.execute('SELECT MAX(id) FROM batches WHERE medicine_id = ?',
+                                     (medicine_id,)).fetchone()[0],
+            'supplier_id': conn.execute('SELECT MIN(id) FROM suppliers').fetchone()[0],
+            'order_id': conn.execute('SELECT MAX(id) FROM purchase_orders').fetchone()[0],
+        }
+    finally:
+        conn.close()
+
+def get_route_name(method, url):
+    # GET routes keep their bare URL so older baselines still compare
+    return url if method == 'GET' else f'{method} {url}'
+
+def bench_route(client, counter, method, url, options, runs):
+    timings = []
+    status = None
+    for _ in range(runs):
+        counter.count = 0
+        started = time.perf_counter()
+        response = client.open(url, method=method, **(options or {}))
+        response.get_data()
+        timings.append(time.perf_counter() - started)
+        status = response.status_code
+    queries = counter.count
+    
+    tracemalloc.start()
+    client.open(url, method=method, **(options or {})).get_data()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    
+    return summarize(timings, queries, peak, status)
+
+def bench_helper(app, counter, helper, runs):
+    with app.test_request_context():
+        timings = []
+        for _ in range(runs):
+            counter.count = 0
+            started = time.perf_counter()
+            helper()
+            timings.append(time.perf_counter() - started)
+        queries = counter.count
+        
+        tracemalloc.start()
+        helper()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return summarize(timings, queries, peak)
+
+def prepare_database(path, scale, seed, medicines=None, transactions=None):
+    if os.path.exists(path):
+        print(f'Reusing {path}')
+        return
+    
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    migrations.migrate(conn)
+    conn.close()
+    
+    medicine_count, transaction_count = sample_data.SCALES[scale]
+    started = time.perf_counter()
+    sample_data.generate_dataset(path, medicines or medicine_count, transactions or transaction_count, seed=seed)
+    
+    # Draft orders for the purchase order pages
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    try:
+        purchasing.generate_orders(conn, db.today_day())
+        conn.commit()
+    finally:
+        conn.close()
+    print(f'Generated {scale} dataset in {time.perf_counter() - started:.1f}s')
+
+def run(args):
+    path = args.db or os.path.join(tempfile.gettempdir(), f'medistore_bench_{args.scale}_{args.seed}.db')
+    prepare_database(path, args.scale, args.seed, args.medicines, args.transactions)
+    
+    counter = QueryCounter()
+    # The forecast timer would write in the middle of a run
+    app = medistore.create_app({'DB_PATH': path, 'DB_TRACE': counter, 'FORECAST_REFRESH_SECONDS': 0})
+    client = app.test_client()
+    params = get_route_params(path)
+    
+    results = {'routes': {}, 'helpers': {}}
+    for method, route, options in ROUTES:
+        name = get_route_name(method, route)
+        results['routes'][name] = bench_route(client, counter, method, fill(route, params),
+                                              fill(options, params), args.runs)
+        print(f"{name:60} p50 {results['routes'][name]['p50_ms']:>10} ms")
+    for name, helper in HELPERS.items():
+        results['helpers'][name] = bench_helper(app, counter, helper, args.runs)
+        print(f"{name:60} p50 {results['helpers'][name]['p50_ms']:>10} ms")
+    
+    return {
+        'scale': args.scale,
+        'seed': args.seed,
+        'runs': args.runs,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'results': results,
+    }
+
+def compare(report, baseline, tolerance):
+    # Returns the benchmarks whose p50 grew by more than the tolerance
+    regressions = []
+    for group, entries in report['results'].items():
+        for name, result in entries.items():
+            previous = baseline.get('results', {}).get(group, {}).get(name)
+            if not previous or not previous['p50_ms']:
+                continue
+            ratio = result['p50_ms'] / previous['p50_ms']
+            print(f"{name:60} {previous['p50_ms']:>10} -> {result['p50_ms']:>10} ms  x{ratio:.2f}")
+            if ratio > tolerance:
+                regressions.append(name)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark MediStore routes and helpers.')
+    parser.add_argument('--scale', choices=sorted(sample_data.SCALES), default='10k')
+    parser.add_argument('--medicines', type=int)
+    parser.add_argument('--transactions', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--db', help='Database to benchmark, generated if it does not exist. '
+                                     'Writes are applied to it.')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare against the results in this JSON file.')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='Fail when a p50 grows by more than this factor over the baseline.')
+    args = parser.parse_args()
+    
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} benchmarks regressed: ' + ', '.join(regressions))
+            raise SystemExit(1)
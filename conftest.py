@@ -0,0 +1,38 @@
+import sqlite3
+import pytest
+import app as medistore
+import migrations
+
+@pytest.fixture
+def db_path(tmp_path):
+    # An empty database at the current schema version
+    path = str(tmp_path / 'medicine_stock.db')
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    migrations.migrate(conn)
+    conn.close()
+    return path
+
+@pytest.fixture
+def conn(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    yield conn
+    conn.close()
+
+@pytest.fixture
+def app(db_path):
+    return medistore.create_app({'DB_PATH': db_path, 'EXPIRY_SCHEDULER_ENABLED': False,
+                                'FORECAST_REFRESH_SECONDS': 0})
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+def add_medicine(conn, name, quantity=10, expiry_date='2030-01-01', **fields):
+    # Inserts a medicine with its opening batch and commits
+    fields = dict(fields, name=name, quantity=quantity, expiry_date=expiry_date)
+    cursor = conn.execute('INSERT INTO medicines (%s) VALUES (%s)' % (', '.join(fields), ', '.join('?' * len(fields))),
+                          list(fields.values()))
+    conn.commit()
+    return cursor.lastrowid
@@ -0,0 +1,127 @@
+from db import today_day
+
+# Dashboard counters are kept in two small tables maintained by triggers on
+# medicines, so the dashboard never has to count the whole catalogue:
+#   dashboard_summary - total SKUs, low stock count and stock value
+#   dashboard_expiry  - number of in-stock medicines per expiry day
+LOW_STOCK_THRESHOLD = 10
+
+LOW_STOCK_THRESHOLD_SQL = "(SELECT value FROM dashboard_summary WHERE key = 'low_stock_threshold')"
+
+# When a medicine counts as low stock, formatted with the row and threshold
+LOW_STOCK_SQL = '({row}.quantity <= {threshold})'
+# With forecasting, a medicine is low once it falls to its own reorder point
+REORDER_LOW_STOCK_SQL = '''({row}.quantity <= COALESCE(
+    (SELECT reorder_point FROM reorder_points WHERE medicine_id = {row}.id), {threshold}))'''
+
+def create_summary_tables(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS dashboard_summary (
+        key TEXT PRIMARY KEY,
+        value REAL NOT NULL DEFAULT 0
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS dashboard_expiry (
+        expiry_day INTEGER PRIMARY KEY,
+        medicines INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    
+    # Seed the counters the first time the tables are created
+    if cursor.execute('SELECT COUNT(*) FROM dashboard_summary').fetchone()[0] == 0:
+        rebuild_summary(cursor, low_stock=LOW_STOCK_SQL)
+    
+    create_summary_triggers(cursor, LOW_STOCK_SQL)
+
+def drop_summary_triggers(cursor):
+    for event in ['insert', 'update', 'delete']:
+        cursor.execute('DROP TRIGGER IF EXISTS dashboard_medicines_%s' % event)
+
+def create_summary_triggers(cursor, low_stock):
+    low = {row: low_stock.format(row=row, threshold=LOW_STOCK_THRESHOLD_SQL) for row in ['NEW', 'OLD']}
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS dashboard_medicines_insert
+    AFTER INSERT ON medicines
+    BEGIN
+        UPDATE dashboard_summary SET value = value + 1 WHERE key = 'total_medicines';
+        UPDATE dashboard_summary SET value = value + %(new_low)s
+        WHERE key = 'low_stock_medicines';
+        UPDATE dashboard_summary SET value = value + NEW.quantity * COALESCE(NEW.price, 0)
+        WHERE key = 'stock_value';
+        INSERT INTO dashboard_expiry (expiry_day, medicines)
+        SELECT NEW.expiry_day, 1 WHERE NEW.expiry_day IS NOT NULL AND NEW.quantity > 0
+        ON CONFLICT (expiry_day) DO UPDATE SET medicines = medicines + 1;
+    END
+    ''' % {'new_low': low['NEW']})
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS dashboard_medicines_update
+    AFTER UPDATE OF quantity, price, expiry_day ON medicines
+    BEGIN
+        UPDATE dashboard_summary
+        SET value = value + %(new_low)s - %(old_low)s
+        WHERE key = 'low_stock_medicines';
+        UPDATE dashboard_summary
+        SET value = value + NEW.quantity * COALESCE(NEW.price, 0) - OLD.quantity * COALESCE(OLD.price, 0)
+        WHERE key = 'stock_value';
+        UPDATE dashboard_expiry SET medicines = medicines - 1
+        WHERE expiry_day = OLD.expiry_day AND OLD.quantity > 0;
+        INSERT INTO dashboard_expiry (expiry_day, medicines)
+        SELECT NEW.expiry_day, 1 WHERE NEW.expiry_day IS NOT NULL AND NEW.quantity > 0
+        ON CONFLICT (expiry_day) DO UPDATE SET medicines = medicines + 1;
+    END
+    ''' % {'new_low': low['NEW'], 'old_low': low['OLD']})
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS dashboard_medicines_delete
+    AFTER DELETE ON medicines
+    BEGIN
+        UPDATE dashboard_summary SET value = value - 1 WHERE key = 'total_medicines';
+        UPDATE dashboard_summary SET value = value - %(old_low)s
+        WHERE key = 'low_stock_medicines';
+        UPDATE dashboard_summary SET value = value - OLD.quantity * COALESCE(OLD.price, 0)
+        WHERE key = 'stock_value';
+        UPDATE dashboard_expiry SET medicines = medicines - 1
+        WHERE expiry_day = OLD.expiry_day AND OLD.quantity > 0;
+    END
+    ''' % {'old_low': low['OLD']})
+
+def rebuild_summary(cursor, threshold=LOW_STOCK_THRESHOLD, low_stock=REORDER_LOW_STOCK_SQL):
+    # Recompute every counter from the medicines table
+    cursor.execute('DELETE FROM dashboard_summary')
+    cursor.execute('DELETE FROM dashboard_expiry')
+    cursor.execute('''
+    INSERT INTO dashboard_summary (key, value)
+    SELECT 'total_medicines', COUNT(*) FROM medicines
+    UNION ALL
+    SELECT 'low_stock_medicines', COUNT(*) FROM medicines WHERE %s
+    UNION ALL
+    SELECT 'stock_value', COALESCE(SUM(quantity * COALESCE(price, 0)), 0) FROM medicines
+    UNION ALL
+    SELECT 'low_stock_threshold', ?
+    ''' % low_stock.format(row='medicines', threshold='?'), (threshold, threshold))
+    cursor.execute('''
+    INSERT INTO dashboard_expiry (expiry_day, medicines)
+    SELECT expiry_day, COUNT(*) FROM medicines
+    WHERE expiry_day IS NOT NULL AND quantity > 0
+    GROUP BY expiry_day
+    ''')
+
+def count_low_stock(cursor, where='1', params=()):
+    return cursor.execute('SELECT COUNT(*) FROM medicines WHERE %s AND %s' % (
+        REORDER_LOW_STOCK_SQL.format(row='medicines', threshold=LOW_STOCK_THRESHOLD_SQL), where),
+        params).fetchone()[0]
+
+def get_dashboard_summary(conn, days=90):
+    summary = {row['key']: row['value'] for row in conn.execute('SELECT key, value FROM dashboard_summary')}
+    
+    # Range sum over the per-day buckets, bounded by the number of distinct expiry dates
+    expiring = conn.execute('''
+    SELECT COALESCE(SUM(medicines), 0) FROM dashboard_expiry WHERE expiry_day <= ?
+    ''', (today_day() + days,)).fetchone()[0]
+    
+    return {
+        'total_medicines': int(summary.get('total_medicines', 0)),
+        'low_stock_medicines': int(summary.get('low_stock_medicines', 0)),
+        'expiring_medicines': expiring,
+        'stock_value': round(summary.get('stock_value', 0), 2),
+    }
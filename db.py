@@ -0,0 +1,157 @@
+import sqlite3
+import threading
+import os
+import queue
+from datetime import datetime, date, timezone
+from urllib.request import pathname2url
+from flask import g, current_app
+import metrics
+
+# Expiry dates are also kept as a day number (days since 1970-01-01) in
+# medicines.expiry_day so expiry filters can use an index
+EPOCH = date(1970, 1, 1)
+EXPIRY_DAY_SQL = "CAST(julianday({}) - 2440587.5 AS INTEGER)"
+
+# Defaults for the database settings read from app.config
+DEFAULT_CONFIG = {
+    'DB_POOL_SIZE': 8,
+    'DB_POOL_TIMEOUT': 10,
+    'DB_JOURNAL_MODE': 'WAL',
+    'DB_SYNCHRONOUS': 'NORMAL',
+    'DB_CACHE_SIZE': -16000,
+    'DB_MMAP_SIZE': 256 * 1024 * 1024,
+    'DB_BUSY_TIMEOUT': 5000,
+    # Time every statement for /metrics and log those slower than DB_SLOW_QUERY_MS
+    'DB_INSTRUMENT': True,
+    'DB_SLOW_QUERY_MS': 100,
+    # Branch id -> shard database path, requests under /stores/<id>/ use that shard
+    'STORES': {},
+    # Called with every statement run on any connection (pool, replica, write
+    # queue), used by query_plans.py and benchmark.py
+    'DB_TRACE': None,
+}
+
+# Days are UTC, the clock SQLite uses for CURRENT_TIMESTAMP and 'now', so
+# transaction dates, rollup days and today_day() always agree
+def utc_today():
+    return datetime.now(timezone.utc).date()
+
+def today_day():
+    return (utc_today() - EPOCH).days
+
+def connect(path, config, immutable=False):
+    factory = metrics.InstrumentedConnection if config['DB_INSTRUMENT'] else sqlite3.Connection
+    if immutable:
+        # Read-only and never changed while open, so SQLite takes no locks and
+        # never looks for a journal or WAL file
+        path = 'file:%s?mode=ro&immutable=1' % pathname2url(os.path.abspath(path))
+    conn = sqlite3.connect(path, timeout=config['DB_BUSY_TIMEOUT'] / 1000,
+                           check_same_thread=False, factory=factory, uri=immutable)
+    conn.row_factory = sqlite3.Row
+    if config['DB_INSTRUMENT']:
+        conn.slow_query_ms = config['DB_SLOW_QUERY_MS']
+    if config['DB_TRACE'] is not None:
+        conn.set_trace_callback(config['DB_TRACE'])
+    if immutable:
+        conn.execute('PRAGMA cache_size = %d' % int(config['DB_CACHE_SIZE']))
+        conn.execute('PRAGMA mmap_size = %d' % int(config['DB_MMAP_SIZE']))
+        return conn
+    
+    # WAL lets dashboard reads run while a stock update is being written
+    conn.execute('PRAGMA journal_mode = %s' % config['DB_JOURNAL_MODE'])
+    conn.execute('PRAGMA synchronous = %s' % config['DB_SYNCHRONOUS'])
+    conn.execute('PRAGMA cache_size = %d' % int(config['DB_CACHE_SIZE']))
+    conn.execute('PRAGMA mmap_size = %d' % int(config['DB_MMAP_SIZE']))
+    conn.execute('PRAGMA busy_timeout = %d' % int(config['DB_BUSY_TIMEOUT']))
+    return conn
+
+class ConnectionPool:
+    def __init__(self, path, config, immutable=False):
+        self.path = path
+        self.config = config
+        self.immutable = immutable
+        self.closed = False
+        self.timeout = config['DB_POOL_TIMEOUT']
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(config['DB_POOL_SIZE'])
+    
+    def acquire(self):
+        # At most DB_POOL_SIZE connections are handed out at once
+        if not self._slots.acquire(timeout=self.timeout):
+            raise RuntimeError('Timed out waiting for a database connection')
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        else:
+            # Statement stats are per checkout
+            if isinstance(conn, metrics.InstrumentedConnection):
+                conn.reset_stats()
+            return conn
+        try:
+            return connect(self.path, self.config, self.immutable)
+        except Exception:
+            self._slots.release()
+            raise
+    
+    def release(self, conn):
+        # Never hand out a connection with a half-finished transaction, and
+        # connections returned after close() are closed rather than kept
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            self._slots.release()
+            return
+        if self.closed:
+            conn.close()
+        else:
+            self._idle.put(conn)
+        self._slots.release()
+    
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_pool_lock = threading.Lock()
+
+def get_db_path(app, store=None):
+    if store is None:
+        return app.config['DB_PATH']
+    return app.config['STORES'][store]
+
+def get_pool(app=None, store=None):
+    # One pool per shard, DB_PATH is the pool for store None
+    app = app or current_app._get_current_object()
+    pool = app.extensions.get('db_pools', {}).get(store)
+    if pool is None:
+        with _pool_lock:
+            pools = app.extensions.setdefault('db_pools', {})
+            pool = pools.get(store)
+            if pool is None:
+                config = dict(DEFAULT_CONFIG)
+                config.update({key: app.config[key] for key in DEFAULT_CONFIG if key in app.config})
+                pool = ConnectionPool(get_db_path(app, store), config)
+                pools[store] = pool
+    return pool
+
+def get_store():
+    return g.get('store_id')
+
+def get_db_connection():
+    # One connection per request (or app context) on the request's shard,
+    # returned to the pool on teardown
+    if 'db' not in g:
+        g.db_pool = get_pool(store=get_store())
+        g.db = g.db_pool.acquire()
+    return g.db
+
+def close_db_connection(exception=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        g.pop('db_pool').release(conn)
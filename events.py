@@ -0,0 +1,99 @@
+import json
+import threading
+from flask import current_app
+import dashboard
+from db import get_pool, get_store
+from revisions import get_revision
+
+# Live feed of stock changes for the dashboard, served as Server-Sent Events.
+# Write routes call publish() after they commit, which wakes every open
+# stream. Streams then read what changed from the database, so the feed is
+# keyed on transactions.id and a client resuming with Last-Event-ID gets
+# exactly the transactions it missed. Each stream also wakes every
+# EVENTS_POLL_SECONDS on its own, which keeps proxies from closing idle
+# connections and picks up writes made by other processes.
+#   event: transaction - one new transaction, id is transactions.id
+#   event: summary     - the dashboard counters, sent on connect and after any change
+
+class ChangeBus:
+    def __init__(self):
+        self._changed = threading.Condition()
+        self.version = 0
+    
+    def publish(self):
+        with self._changed:
+            self.version += 1
+            self._changed.notify_all()
+    
+    def wait(self, version, timeout):
+        # Returns the current version once it differs from the one given, or on timeout
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+_bus_lock = threading.Lock()
+
+def get_bus(app=None, store=None):
+    # One bus per shard
+    app = app or current_app._get_current_object()
+    with _bus_lock:
+        return app.extensions.setdefault('change_bus', {}).setdefault(store, ChangeBus())
+
+def publish():
+    get_bus(store=get_store()).publish()
+
+def get_last_transaction_id(conn):
+    return conn.execute('SELECT COALESCE(MAX(id), 0) FROM transactions').fetchone()[0]
+
+def format_event(event, data, event_id=None):
+    lines = ['event: %s' % event]
+    if event_id is not None:
+        lines.append('id: %d' % event_id)
+    lines.append('data: %s' % json.dumps(data, default=str))
+    return '\n'.join(lines) + '\n\n'
+
+def read_changes(conn, after_id, limit):
+    return conn.execute('''
+    SELECT t.*, m.name AS medicine_name, m.quantity AS medicine_quantity
+    FROM transactions t
+    LEFT JOIN medicines m ON t.medicine_id = m.id
+    WHERE t.id > ?
+    ORDER BY t.id LIMIT ?
+    ''', (after_id, limit)).fetchall()
+
+def stream_changes(app, last_event_id=None, store=None):
+    # Runs outside the request, so connections are borrowed per wake-up
+    # instead of holding a pool slot for the lifetime of the stream
+    bus = get_bus(app, store)
+    pool = get_pool(app, store)
+    poll_seconds = app.config['EVENTS_POLL_SECONDS']
+    batch_size = app.config['EVENTS_BATCH_SIZE']
+    version = bus.version
+    revision = None
+    
+    yield 'retry: %d\n\n' % (app.config['EVENTS_RETRY_MS'])
+    while True:
+        conn = pool.acquire()
+        try:
+            if last_event_id is None:
+                last_event_id = get_last_transaction_id(conn)
+            current = get_revision(conn)
+            events = []
+            if current != revision:
+                rows = read_changes(conn, last_event_id, batch_size)
+                for row in rows:
+                    events.append(format_event('transaction', dict(row), row['id']))
+                    last_event_id = row['id']
+                events.append(format_event('summary', dashboard.get_dashboard_summary(conn, 90)))
+                # A full batch means more are waiting, so go round again without waiting
+                revision = None if len(rows) == batch_size else current
+        finally:
+            pool.release(conn)
+        
+        if events:
+            yield ''.join(events)
+            if revision is None:
+                continue
+        else:
+            yield ': keepalive\n\n'
+        version = bus.wait(version, poll_seconds)
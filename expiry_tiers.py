@@ -0,0 +1,230 @@
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from flask import current_app, g
+import replica
+from batches import BATCH_COLUMNS
+from db import get_db_connection, today_day
+
+# Materialized expiry tiers: every in-stock batch expiring within the
+# horizon, with its recommended discount and discounted price. Rows are kept
+# up to date by triggers on batches and medicines, relative to the day the
+# table was last rebuilt. Tiers move with the calendar, so the table is rebuilt at midnight
+# by an in-process timer and, failing that, on the first read of a new day or
+# after DISCOUNT_TIERS / EXPIRY_HORIZON_DAYS change.
+#   expiry_tiers       - one row per batch inside the horizon
+#   discount_tiers     - the configured (max_days, percent) rules
+#   expiry_tiers_state - the day and rules the table was built for
+
+# Medicine-level rows, as first built by create_expiry_tier_tables
+TIER_INSERT_SQL = '''
+INSERT INTO expiry_tiers (medicine_id, expiry_day, recommended_discount, discounted_price)
+SELECT {row}.id, {row}.expiry_day, t.percent,
+       CASE WHEN {row}.price THEN ROUND({row}.price * (1 - t.percent / 100.0), 2) END
+FROM expiry_tiers_state s
+LEFT JOIN discount_tiers t ON t.max_days = (
+    SELECT MIN(max_days) FROM discount_tiers WHERE max_days >= {row}.expiry_day - s.refreshed_day)
+WHERE {row}.quantity > 0 AND {row}.expiry_day <= s.refreshed_day + s.horizon
+'''
+
+# Batches matching {where} that belong in the table, priced with the tightest matching tier
+BATCH_TIER_INSERT_SQL = '''
+INSERT INTO expiry_tiers (batch_id, medicine_id, expiry_day, recommended_discount, discounted_price)
+SELECT b.id, b.medicine_id, b.expiry_day, t.percent,
+       CASE WHEN m.price THEN ROUND(m.price * (1 - t.percent / 100.0), 2) END
+FROM batches b
+JOIN medicines m ON m.id = b.medicine_id
+JOIN expiry_tiers_state s
+LEFT JOIN discount_tiers t ON t.max_days = (
+    SELECT MIN(max_days) FROM discount_tiers WHERE max_days >= b.expiry_day - s.refreshed_day)
+WHERE b.quantity > 0 AND b.expiry_day <= s.refreshed_day + s.horizon AND {where}
+'''
+
+def create_expiry_tier_tables(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS expiry_tiers (
+        medicine_id INTEGER PRIMARY KEY,
+        expiry_day INTEGER NOT NULL,
+        recommended_discount INTEGER,
+        discounted_price REAL
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_expiry_tiers_expiry_day ON expiry_tiers (expiry_day)')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS discount_tiers (
+        max_days INTEGER PRIMARY KEY,
+        percent INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS expiry_tiers_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        refreshed_day INTEGER NOT NULL,
+        horizon INTEGER NOT NULL,
+        rules TEXT NOT NULL
+    )
+    ''')
+    
+    # The table stays empty until the first rebuild writes expiry_tiers_state
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS expiry_tiers_medicines_insert
+    AFTER INSERT ON medicines
+    BEGIN
+        %s;
+    END
+    ''' % TIER_INSERT_SQL.format(row='NEW'))
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS expiry_tiers_medicines_update
+    AFTER UPDATE OF quantity, price, expiry_day ON medicines
+    BEGIN
+        DELETE FROM expiry_tiers WHERE medicine_id = OLD.id;
+        %s;
+    END
+    ''' % TIER_INSERT_SQL.format(row='NEW'))
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS expiry_tiers_medicines_delete
+    AFTER DELETE ON medicines
+    BEGIN
+        DELETE FROM expiry_tiers WHERE medicine_id = OLD.id;
+    END
+    ''')
+
+def track_batches(cursor):
+    # Tiers move from medicines to their batches, the next read rebuilds them
+    for event in ['insert', 'update', 'delete']:
+        cursor.execute('DROP TRIGGER IF EXISTS expiry_tiers_medicines_%s' % event)
+    cursor.execute('DROP TABLE IF EXISTS expiry_tiers')
+    cursor.execute('DELETE FROM expiry_tiers_state')
+    cursor.execute('''
+    CREATE TABLE expiry_tiers (
+        batch_id INTEGER PRIMARY KEY,
+        medicine_id INTEGER NOT NULL,
+        expiry_day INTEGER NOT NULL,
+        recommended_discount INTEGER,
+        discounted_price REAL
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_expiry_tiers_expiry_day ON expiry_tiers (expiry_day)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_expiry_tiers_medicine ON expiry_tiers (medicine_id)')
+    
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS expiry_tiers_batches_insert
+    AFTER INSERT ON batches
+    BEGIN
+        %s;
+    END
+    ''' % BATCH_TIER_INSERT_SQL.format(where='b.id = NEW.id'))
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS expiry_tiers_batches_update
+    AFTER UPDATE OF quantity, expiry_day ON batches
+    BEGIN
+        DELETE FROM expiry_tiers WHERE batch_id = OLD.id;
+        %s;
+    END
+    ''' % BATCH_TIER_INSERT_SQL.format(where='b.id = NEW.id'))
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS expiry_tiers_batches_delete
+    AFTER DELETE ON batches
+    BEGIN
+        DELETE FROM expiry_tiers WHERE batch_id = OLD.id;
+    END
+    ''')
+    # Discounted prices follow the medicine's price
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS expiry_tiers_medicines_price
+    AFTER UPDATE OF price ON medicines
+    BEGIN
+        DELETE FROM expiry_tiers WHERE medicine_id = OLD.id;
+        %s;
+    END
+    ''' % BATCH_TIER_INSERT_SQL.format(where='b.medicine_id = NEW.id'))
+
+def get_rules():
+    config = current_app.config
+    tiers = sorted([int(days), int(percent)] for days, percent in config['DISCOUNT_TIERS'])
+    # The table always reaches at least as far as the widest tier
+    horizon = max([int(config['EXPIRY_HORIZON_DAYS'])] + [days for days, percent in tiers])
+    return {'horizon': horizon, 'tiers': tiers}
+
+def rebuild_tiers(cursor, rules, today):
+    cursor.execute('DELETE FROM discount_tiers')
+    cursor.executemany('INSERT INTO discount_tiers (max_days, percent) VALUES (?, ?)', rules['tiers'])
+    cursor.execute('''
+    INSERT INTO expiry_tiers_state (id, refreshed_day, horizon, rules) VALUES (1, ?, ?, ?)
+    ON CONFLICT (id) DO UPDATE SET refreshed_day = excluded.refreshed_day,
+        horizon = excluded.horizon, rules = excluded.rules
+    ''', (today, rules['horizon'], json.dumps(rules)))
+    cursor.execute('DELETE FROM expiry_tiers')
+    cursor.execute(BATCH_TIER_INSERT_SQL.format(where='1'))
+
+def is_fresh(conn, rules, today):
+    state = conn.execute('SELECT refreshed_day, rules FROM expiry_tiers_state').fetchone()
+    return bool(state) and state['refreshed_day'] == today and state['rules'] == json.dumps(rules)
+
+def ensure_fresh(conn):
+    rules = get_rules()
+    today = today_day()
+    if is_fresh(conn, rules, today):
+        return
+    
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        rebuild_tiers(conn, rules, today)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def get_tiered_medicines(days, discounted_only=False):
+    # None when the window reaches past the table's horizon
+    rules = get_rules()
+    if days > rules['horizon']:
+        return None
+    
+    conn = get_db_connection()
+    ensure_fresh(conn)
+    today = today_day()
+    # Read from the report replica unless its copy predates today's rebuild
+    report = replica.get_report_connection()
+    if is_fresh(report, rules, today):
+        conn = report
+    rows = conn.execute('''
+    SELECT %s, e.expiry_day - ? AS days_left, e.recommended_discount, e.discounted_price
+    FROM expiry_tiers e
+    JOIN batches b ON b.id = e.batch_id
+    JOIN medicines m ON m.id = e.medicine_id
+    WHERE e.expiry_day <= ? %s
+    ORDER BY e.expiry_day
+    ''' % (BATCH_COLUMNS, 'AND e.recommended_discount IS NOT NULL' if discounted_only else ''),
+                        (today, today + days)).fetchall()
+    return [dict(row) for row in rows]
+
+def seconds_until_midnight():
+    # UTC midnight, when today_day() moves on
+    now = datetime.now(timezone.utc)
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=5, microsecond=0)
+    return (midnight - now).total_seconds()
+
+def start_scheduler(app):
+    # One daemon timer per app, re-armed after every run
+    if app.extensions.get('expiry_tiers_timer'):
+        return
+    
+    def run():
+        # The main database and every branch shard
+        for store in [None] + list(app.config['STORES']):
+            try:
+                with app.app_context():
+                    g.store_id = store
+                    ensure_fresh(get_db_connection())
+            except Exception:
+                app.logger.exception('Scheduled expiry tier rebuild failed for store %s', store)
+        schedule()
+    
+    def schedule():
+        timer = threading.Timer(seconds_until_midnight(), run)
+        timer.daemon = True
+        timer.start()
+        app.extensions['expiry_tiers_timer'] = timer
+    
+    schedule()
@@ -0,0 +1,106 @@
+import csv
+import io
+import itertools
+import json
+import zlib
+import archive
+
+# Rows are pulled from the cursor EXPORT_CHUNK_SIZE at a time and written
+# out as they arrive, so an export never holds more than one chunk in memory
+EXPORT_CHUNK_SIZE = 1000
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+# Filterable columns for each exportable table
+EXPORT_TABLES = {
+    'transactions': {'date_column': 'transaction_date', 'medicine_column': 'medicine_id'},
+    'medicines': {'date_column': 'created_at', 'medicine_column': 'id'},
+}
+
+def build_export_query(table, start=None, end=None, medicine_id=None, source=None):
+    spec = EXPORT_TABLES[table]
+    conditions, params = [], []
+    
+    if start:
+        conditions.append('%s >= date(?)' % spec['date_column'])
+        params.append(start)
+    if end:
+        # The end date is inclusive
+        conditions.append("%s < date(?, '+1 day')" % spec['date_column'])
+        params.append(end)
+    if medicine_id is not None:
+        conditions.append('%s = ?' % spec['medicine_column'])
+        params.append(medicine_id)
+    
+    sql = 'SELECT * FROM %s' % (source or table)
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    
+    # Follow the date index for range exports, otherwise rowid order
+    if start or end:
+        sql += ' ORDER BY %s, id' % spec['date_column']
+    else:
+        sql += ' ORDER BY id'
+    return sql, params
+
+def iter_chunks(conn, sql, params, chunk_size=EXPORT_CHUNK_SIZE):
+    cursor = conn.execute(sql, params)
+    columns = [column[0] for column in cursor.description]
+    yield columns
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+def iter_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(next(chunks))
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def iter_ndjson(chunks):
+    columns = next(chunks)
+    for rows in chunks:
+        yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+
+def iter_gzip(parts):
+    compressor = zlib.compressobj(wbits=31)
+    for part in parts:
+        data = compressor.compress(part.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def iter_transaction_chunks(conn, archive_dir, start=None, end=None, medicine_id=None):
+    # Archived months first, in month order, then the hot ledger
+    header = True
+    for source in itertools.chain(archive.iter_partitions(conn, archive_dir, start, end), [None]):
+        sql, params = build_export_query('transactions', start, end, medicine_id, source=source)
+        chunks = iter_chunks(conn, sql, params)
+        columns = next(chunks)
+        if header:
+            yield columns
+            header = False
+        yield from chunks
+
+def generate_export(conn, table, fmt, start=None, end=None, medicine_id=None, compress=False,
+                    archive_dir=None):
+    if table == 'transactions' and archive_dir:
+        chunks = iter_transaction_chunks(conn, archive_dir, start, end, medicine_id)
+    else:
+        sql, params = build_export_query(table, start, end, medicine_id)
+        chunks = iter_chunks(conn, sql, params)
+    parts = iter_csv(chunks) if fmt == 'csv' else iter_ndjson(chunks)
+    if compress:
+        return iter_gzip(parts)
+    return (part.encode('utf-8') for part in parts)
@@ -0,0 +1,201 @@
+import math
+import threading
+from flask import g
+import dashboard
+from db import EXPIRY_DAY_SQL, get_db_connection, today_day
+
+# Demand forecasting and per-medicine reorder points. Dispensed quantities
+# ('remove' transactions, not write-offs or edit corrections, which have
+# their own types) are folded into daily buckets in demand_daily,
+# reading only transactions above the last processed id. Reorder points are
+# then derived from the buckets inside a trailing window:
+#   reorder_point = daily_demand * lead_time + z * demand_std * sqrt(lead_time)
+# and a medicine is low on stock once it falls to its reorder point. Medicines
+# with no demand in the window keep the fixed dashboard threshold. The
+# update is a write, so it runs from a background timer and "flask forecast",
+# never from the pages that read reorder_points.
+FORECAST_WINDOW_DAYS = 90
+REORDER_LEAD_TIME_DAYS = 7
+# 1.65 standard deviations covers demand on about 95% of days
+REORDER_SERVICE_Z = 1.65
+
+def create_forecast_tables(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS demand_daily (
+        medicine_id INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        PRIMARY KEY (medicine_id, day)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_demand_daily_day ON demand_daily (day)')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS reorder_points (
+        medicine_id INTEGER PRIMARY KEY,
+        daily_demand REAL NOT NULL,
+        demand_std REAL NOT NULL,
+        reorder_point INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS forecast_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        last_transaction_id INTEGER NOT NULL,
+        computed_day INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS forecast_medicines_delete
+    AFTER DELETE ON medicines
+    BEGIN
+        DELETE FROM demand_daily WHERE medicine_id = OLD.id;
+        DELETE FROM reorder_points WHERE medicine_id = OLD.id;
+    END
+    ''')
+    
+    # The low stock counter now compares each medicine with its reorder point
+    dashboard.drop_summary_triggers(cursor)
+    dashboard.create_summary_triggers(cursor, dashboard.REORDER_LOW_STOCK_SQL)
+
+def index_low_stock(cursor):
+    # Low stock lists read reorder_points through a partial index holding
+    # only the medicines at or below their reorder point, which needs each
+    # point's current quantity on its own row
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(reorder_points)')]
+    if 'quantity' not in columns:
+        cursor.execute('ALTER TABLE reorder_points ADD COLUMN quantity INTEGER')
+    cursor.execute('''
+    UPDATE reorder_points SET quantity = (SELECT quantity FROM medicines WHERE id = reorder_points.medicine_id)
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS forecast_reorder_points_insert
+    AFTER INSERT ON reorder_points
+    BEGIN
+        UPDATE reorder_points SET quantity = (SELECT quantity FROM medicines WHERE id = NEW.medicine_id)
+        WHERE medicine_id = NEW.medicine_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS forecast_medicines_quantity
+    AFTER UPDATE OF quantity ON medicines
+    BEGIN
+        UPDATE reorder_points SET quantity = NEW.quantity WHERE medicine_id = NEW.id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_reorder_points_low
+    ON reorder_points (quantity) WHERE quantity <= reorder_point
+    ''')
+    # Medicines without a reorder point are low at a threshold given per request
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_medicines_quantity ON medicines (quantity)')
+
+def ingest_demand(conn, after_id):
+    conn.execute('''
+    INSERT INTO demand_daily (medicine_id, day, quantity)
+    SELECT medicine_id, %s AS day, SUM(quantity) FROM transactions
+    WHERE id > ? AND transaction_type = 'remove' AND medicine_id IS NOT NULL
+    GROUP BY medicine_id, day
+    ON CONFLICT (medicine_id, day) DO UPDATE SET quantity = quantity + excluded.quantity
+    ''' % EXPIRY_DAY_SQL.format('transaction_date'), (after_id,))
+
+def compute_reorder_points(rows, window, lead_time, z):
+    # rows are (medicine_id, total, sum of squares) over the window, days
+    # without demand count as zero
+    points = []
+    for medicine_id, total, squares in rows:
+        mean = total / window
+        std = math.sqrt(max(squares / window - mean * mean, 0))
+        reorder_point = math.ceil(mean * lead_time + z * std * math.sqrt(lead_time))
+        points.append((medicine_id, round(mean, 4), round(std, 4), reorder_point))
+    return points
+
+def get_progress(conn):
+    state = conn.execute('SELECT last_transaction_id, computed_day FROM forecast_state').fetchone()
+    last_id, computed_day = tuple(state) if state else (0, None)
+    newest_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM transactions').fetchone()[0]
+    return last_id, computed_day, newest_id
+
+def update_forecast(conn, window=FORECAST_WINDOW_DAYS, lead_time=REORDER_LEAD_TIME_DAYS, z=REORDER_SERVICE_Z):
+    # Returns the number of medicines whose reorder point was recomputed, or
+    # None when nothing changed since the last run
+    today = today_day()
+    last_id, computed_day, newest_id = get_progress(conn)
+    if newest_id == last_id and computed_day == today:
+        return None
+    
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Another writer may have got here first
+        last_id, computed_day, newest_id = get_progress(conn)
+        if newest_id == last_id and computed_day == today:
+            conn.rollback()
+            return None
+        
+        ingest_demand(conn, last_id)
+        
+        # The window moves every day, so the first run of a day recomputes every
+        # medicine, later runs only those with new demand
+        if computed_day == today:
+            scope = '''{column} IN (SELECT medicine_id FROM transactions
+                                 WHERE id > ? AND transaction_type = 'remove')'''
+            scope_params = (last_id,)
+        else:
+            scope, scope_params = '1', ()
+        
+        rows = conn.execute('''
+        SELECT medicine_id, SUM(quantity), SUM(quantity * quantity) FROM demand_daily
+        WHERE day > ? AND day <= ? AND %s
+        GROUP BY medicine_id
+        ''' % scope.format(column='medicine_id'), (today - window, today) + scope_params).fetchall()
+        points = compute_reorder_points(rows, window, lead_time, z)
+        
+        # Keep the dashboard's low stock counter in step with the new points
+        low_before = dashboard.count_low_stock(conn, scope.format(column='id'), scope_params)
+        conn.execute('DELETE FROM reorder_points WHERE %s' % scope.format(column='medicine_id'), scope_params)
+        conn.executemany('''
+        INSERT INTO reorder_points (medicine_id, daily_demand, demand_std, reorder_point)
+        VALUES (?, ?, ?, ?)
+        ''', points)
+        low_after = dashboard.count_low_stock(conn, scope.format(column='id'), scope_params)
+        conn.execute('''
+        UPDATE dashboard_summary SET value = value + ? WHERE key = 'low_stock_medicines'
+        ''', (low_after - low_before,))
+        # Low stock responses are tagged with the data revision, and the points
+        # now change outside the request that reads them
+        conn.execute('UPDATE data_revision SET revision = revision + 1 WHERE id = 1')
+        
+        conn.execute('''
+        INSERT INTO forecast_state (id, last_transaction_id, computed_day) VALUES (1, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET last_transaction_id = excluded.last_transaction_id,
+            computed_day = excluded.computed_day
+        ''', (newest_id, today))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    return len(points)
+
+def start_scheduler(app):
+    # One daemon timer per app updating every shard's reorder points, re-armed after every run
+    if app.extensions.get('forecast_timer') or not app.config['FORECAST_REFRESH_SECONDS']:
+        return
+    
+    def run():
+        for store in [None] + list(app.config['STORES']):
+            try:
+                with app.app_context():
+                    g.store_id = store
+                    update_forecast(get_db_connection(), app.config['FORECAST_WINDOW_DAYS'],
+                                    app.config['REORDER_LEAD_TIME_DAYS'], app.config['REORDER_SERVICE_Z'])
+            except Exception:
+                app.logger.exception('Scheduled forecast update failed for store %s', store)
+        schedule()
+    
+    def schedule():
+        timer = threading.Timer(app.config['FORECAST_REFRESH_SECONDS'], run)
+        timer.daemon = True
+        timer.start()
+        app.extensions['forecast_timer'] = timer
+    
+    schedule()
@@ -0,0 +1,210 @@
+import csv
+import io
+import json
+import re
+from datetime import datetime
+
+# Bulk import of medicines with their opening stock. Records are validated
+# as they are read and inserted with executemany in batches, all inside one
+# transaction, followed by a single INSERT ... SELECT for the opening
+# 'add' transactions. JSON arrays are decoded one element at a time from
+# buffered chunks, so a large file is never held in memory whole. Records
+# that are not valid JSON are yielded as their decode error and reported
+# against their row like any other invalid record.
+IMPORT_BATCH_SIZE = 5000
+JSON_CHUNK_SIZE = 64 * 1024
+# An array element still open after this many characters ends the import
+JSON_MAX_RECORD_SIZE = 1024 * 1024
+
+# Strings and the characters that nest or end an array element. A lone '"'
+# is a string that goes on past the end of the buffer.
+JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|["\[\]{},]')
+
+MEDICINE_FIELDS = ['name', 'description', 'category', 'quantity', 'unit', 'manufacturer',
+                   'batch_number', 'purchase_date', 'expiry_date', 'price']
+
+def open_text(stream):
+    if isinstance(stream, io.TextIOBase):
+        return stream
+    return io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+
+def iter_csv_records(stream):
+    return csv.DictReader(open_text(stream))
+
+def iter_json_records(stream):
+    # Either a JSON array of objects or one object per line (NDJSON)
+    text = open_text(stream)
+    first = text.read(1)
+    while first and first.isspace():
+        first = text.read(1)
+    
+    if first == '[':
+        yield from iter_json_array(text)
+        return
+    
+    line = first + text.readline()
+    while line:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                # Reported against this record by validate_record
+                yield e
+        line = text.readline()
+
+def iter_json_array(text):
+    # The elements of a JSON array whose opening bracket was already read.
+    # Each element is delimited first, by scanning for the ',' or ']' that
+    # ends it outside strings and brackets, and then decoded once, so a
+    # malformed element is reported and reading resumes at the next one.
+    buffer, position = '', 0
+    # How far the current element has been scanned, and how deeply nested it is there
+    scan, depth = 0, 0
+    expect_value, first = True, True
+    while True:
+        while position < len(buffer) and buffer[position].isspace():
+            position += 1
+        if position == len(buffer):
+            chunk = text.read(JSON_CHUNK_SIZE)
+            if not chunk:
+                raise ValueError('Unterminated JSON array')
+            buffer, position, scan = chunk, 0, 0
+            continue
+        
+        if not expect_value or (first and buffer[position] == ']'):
+            if buffer[position] == ']':
+                return
+            if buffer[position] != ',':
+                raise ValueError(f"Expected ',' or ']' in JSON array, found {buffer[position]!r}")
+            position += 1
+            expect_value = True
+            continue
+        
+        end = None
+        scan = max(scan, position)
+        for match in JSON_TOKEN.finditer(buffer, scan):
+            token = match.group()
+            if token == '"':
+                break
+            if token in ('[', '{'):
+                depth += 1
+            elif depth and token in (']', '}'):
+                depth -= 1
+            elif not depth and token in (',', ']'):
+                end = match.start()
+                break
+            scan = match.end()
+        else:
+            scan = len(buffer)
+        
+        # An element cut off by the end of the buffer is scanned on with more text
+        if end is None:
+            if len(buffer) - position > JSON_MAX_RECORD_SIZE:
+                raise ValueError(f'JSON array element longer than {JSON_MAX_RECORD_SIZE} characters')
+            chunk = text.read(JSON_CHUNK_SIZE)
+            if not chunk:
+                raise ValueError('Unterminated JSON array')
+            buffer, scan, position = buffer[position:] + chunk, scan - position, 0
+            continue
+        
+        try:
+            yield json.loads(buffer[position:end])
+        except ValueError as e:
+            # Reported against this record by validate_record
+            yield e
+        position, depth = end, 0
+        expect_value, first = False, False
+
+def parse_date(value, field):
+    try:
+        return datetime.strptime(value.strip(), '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f'{field} must be a date in YYYY-MM-DD format')
+
+def validate_record(record):
+    # A record that could not be decoded comes as its decode error
+    if isinstance(record, ValueError):
+        raise ValueError(f'Invalid JSON: {record}')
+    if not isinstance(record, dict):
+        raise ValueError('Record must be a JSON object')
+    
+    values = {field: record.get(field) for field in MEDICINE_FIELDS}
+    for field, value in values.items():
+        if isinstance(value, str):
+            values[field] = value.strip() or None
+    
+    if not values['name'] or not values['expiry_date'] or values['quantity'] is None:
+        raise ValueError('Name, quantity, and expiry date are required fields!')
+    
+    try:
+        values['quantity'] = int(values['quantity'])
+    except (ValueError, TypeError):
+        raise ValueError('quantity must be a whole number')
+    if values['quantity'] < 0:
+        raise ValueError('quantity cannot be negative')
+    
+    values['expiry_date'] = parse_date(str(values['expiry_date']), 'expiry_date')
+    if values['purchase_date']:
+        values['purchase_date'] = parse_date(str(values['purchase_date']), 'purchase_date')
+    
+    if values['price'] is not None:
+        try:
+            values['price'] = float(values['price'])
+        except (ValueError, TypeError):
+            raise ValueError('price must be a number')
+        if values['price'] < 0:
+            raise ValueError('price cannot be negative')
+    
+    return tuple(values[field] for field in MEDICINE_FIELDS)
+
+def import_medicines(conn, records, strict=False, first_row=1):
+    imported = 0
+    errors = []
+    batch = []
+    
+    # Hold the write lock for the whole import so the new ids are contiguous
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        first_new_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM medicines').fetchone()[0]
+        
+        insert_sql = 'INSERT INTO medicines (%s) VALUES (%s)' % (
+            ', '.join(MEDICINE_FIELDS), ', '.join(['?'] * len(MEDICINE_FIELDS)))
+        
+        for row_number, record in enumerate(records, start=first_row):
+            try:
+                batch.append(validate_record(record))
+            except ValueError as e:
+                errors.append({'row': row_number, 'error': str(e)})
+                continue
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                conn.executemany(insert_sql, batch)
+                imported += len(batch)
+                batch = []
+        if batch:
+            conn.executemany(insert_sql, batch)
+            imported += len(batch)
+        
+        if strict and errors:
+            conn.rollback()
+            return {'imported': 0, 'errors': errors}
+        
+        # Opening stock for every new medicine in one statement
+        conn.execute('''
+        INSERT INTO transactions (medicine_id, transaction_type, quantity, notes)
+        SELECT id, 'add', quantity, 'Initial stock of ' || name
+        FROM medicines WHERE id > ?
+        ''', (first_new_id,))
+        
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    return {'imported': imported, 'errors': errors}
+
+def import_file(conn, stream, fmt, strict=False):
+    if fmt == 'json':
+        return import_medicines(conn, iter_json_records(stream), strict=strict)
+    
+    # Row numbers count the header line so they match the CSV file
+    return import_medicines(conn, iter_csv_records(stream), strict=strict, first_row=2)
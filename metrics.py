@@ -0,0 +1,238 @@
+import logging
+import re
+import sqlite3
+import threading
+from functools import lru_cache, partial
+from time import perf_counter
+from flask import g, request, before_render_template, template_rendered
+
+# Lightweight in-process instrumentation exposed in Prometheus text format.
+# Statement timing comes from the connection and cursor classes below, which
+# db.connect uses when DB_INSTRUMENT is on; request timing is split into DB
+# (the request's connection and its report replica connection), template
+# and remaining Python time by the hooks in init_app. A request is recorded
+# when its response is closed, after a streamed body has been generated.
+# Metrics are per process, so scrape every worker.
+
+slow_query_log = logging.getLogger('medistore.slow_queries')
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+class Counter:
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+    
+    def inc(self, label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+    
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s counter' % self.name]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append('%s%s %s' % (self.name, format_labels(self.labels, label_values), value))
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+    
+    def observe(self, label_values, value):
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                # Per-bucket counts, made cumulative when rendered, plus sum and count
+                series = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+    
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            for label_values, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket%s %d' % (self.name, format_labels(self.labels + ('le',), label_values + (repr(bound),)), cumulative))
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(self.labels + ('le',), label_values + ('+Inf',)), count))
+                lines.append('%s_sum%s %f' % (self.name, format_labels(self.labels, label_values), total))
+                lines.append('%s_count%s %d' % (self.name, format_labels(self.labels, label_values), count))
+        return lines
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{%s}' % ','.join('%s="%s"' % (name, value) for name, value in zip(names, escaped))
+
+REQUESTS = Counter('medistore_requests_total', 'HTTP requests handled.', ('endpoint', 'method', 'status'))
+REQUEST_SECONDS = Histogram('medistore_request_duration_seconds',
+                            'Request latency split into total, db, template and python time.',
+                            ('endpoint', 'phase'))
+REQUEST_QUERIES = Counter('medistore_request_queries_total', 'SQL statements executed by requests.', ('endpoint',))
+QUERY_SECONDS = Histogram('medistore_db_query_duration_seconds', 'SQL statement latency, including row fetching.', ())
+SLOW_QUERIES = Counter('medistore_db_slow_queries_total', 'SQL statements slower than DB_SLOW_QUERY_MS.', ('statement',))
+
+REGISTRY = [REQUESTS, REQUEST_SECONDS, REQUEST_QUERIES, QUERY_SECONDS, SLOW_QUERIES]
+
+@lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    # Collapse whitespace and literals so one statement shape is one log key
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(\.\d+)?\b', '?', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # Time spent in execute and fetch calls is charged to the current statement
+    def _start(self, sql):
+        self._sql = sql
+        self._elapsed = 0.0
+        self._logged = False
+        self.connection.statements += 1
+    
+    def _record(self, elapsed):
+        conn = self.connection
+        conn.db_time += elapsed
+        self._elapsed += elapsed
+        if not self._logged and self._elapsed * 1000 >= conn.slow_query_ms:
+            self._logged = True
+            statement = normalize_sql(self._sql)
+            SLOW_QUERIES.inc((statement,))
+            slow_query_log.warning('Slow query (%.1f ms): %s', self._elapsed * 1000, statement)
+    
+    def _finish(self):
+        if getattr(self, '_sql', None) is not None:
+            QUERY_SECONDS.observe((), self._elapsed)
+            self._sql = None
+    
+    def execute(self, sql, parameters=()):
+        self._finish()
+        self._start(sql)
+        started = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record(perf_counter() - started)
+    
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        self._start(sql)
+        started = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._record(perf_counter() - started)
+    
+    def fetchone(self):
+        started = perf_counter()
+        row = super().fetchone()
+        self._record(perf_counter() - started)
+        if row is None:
+            self._finish()
+        return row
+    
+    def fetchmany(self, size=None):
+        started = perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._record(perf_counter() - started)
+        if not rows:
+            self._finish()
+        return rows
+    
+    def fetchall(self):
+        started = perf_counter()
+        rows = super().fetchall()
+        self._record(perf_counter() - started)
+        self._finish()
+        return rows
+
+class InstrumentedConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slow_query_ms = 100
+        self.reset_stats()
+    
+    def reset_stats(self):
+        self.db_time = 0.0
+        self.statements = 0
+    
+    def cursor(self, factory=None):
+        return super().cursor(factory or InstrumentedCursor)
+    
+    # Connection.execute would bypass cursor(), so route it through explicitly
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def start_request():
+    g.metrics_started = perf_counter()
+    g.template_time = 0.0
+
+def start_template(sender, template, context, **extra):
+    g.template_started = perf_counter()
+
+def finish_template(sender, template, context, **extra):
+    started = g.pop('template_started', None)
+    if started is not None:
+        g.template_time = g.get('template_time', 0.0) + perf_counter() - started
+
+def collect_connections(exception=None):
+    # Connections go back to their pools on teardown, which runs again at the
+    # end of a streamed body, so their stats are added up on g first. The
+    # replica connection is counted when it is not the primary one.
+    connections = [g.get('db')]
+    if g.get('report_pool') is not None:
+        connections.append(g.get('report_db'))
+    for conn in connections:
+        if hasattr(conn, 'statements'):
+            g.db_time = g.get('db_time', 0.0) + conn.db_time
+            g.db_statements = g.get('db_statements', 0) + conn.statements
+            conn.reset_stats()
+
+def finish_request(response):
+    if 'metrics_started' in g:
+        response.call_on_close(partial(record_request, g._get_current_object(), request.endpoint or 'unknown',
+                                       request.method, response.status_code))
+    return response
+
+def record_request(stats, endpoint, method, status):
+    # stats is the request's g, its app context may already be gone
+    total = perf_counter() - stats.metrics_started
+    template = stats.get('template_time', 0.0)
+    db_time = stats.get('db_time', 0.0)
+    
+    REQUESTS.inc((endpoint, method, str(status)))
+    REQUEST_SECONDS.observe((endpoint, 'total'), total)
+    REQUEST_SECONDS.observe((endpoint, 'db'), db_time)
+    REQUEST_SECONDS.observe((endpoint, 'template'), template)
+    REQUEST_SECONDS.observe((endpoint, 'python'), max(0.0, total - db_time - template))
+    if 'db_statements' in stats:
+        REQUEST_QUERIES.inc((endpoint,), stats.db_statements)
+
+def init_app(app):
+    app.before_request_funcs.setdefault(None, []).insert(0, start_request)
+    app.after_request(finish_request)
+    app.teardown_request(collect_connections)
+    before_render_template.connect(start_template, app, weak=False)
+    template_rendered.connect(finish_template, app, weak=False)
+
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,169 @@
+import dashboard
+import search_index
+import revisions
+import archive
+import expiry_tiers
+import forecast
+import batches
+import rollups
+import purchasing
+from db import EXPIRY_DAY_SQL
+
+# Schema migrations, applied in order. The schema version is stored in
+# PRAGMA user_version and equals the number of migrations applied. Never
+# edit or reorder a released migration, append a new one instead.
+
+def create_tables(cursor):
+    # Create medicines table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS medicines (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        description TEXT,
+        category TEXT,
+        quantity INTEGER NOT NULL,
+        unit TEXT,
+        manufacturer TEXT,
+        batch_number TEXT,
+        purchase_date TEXT,
+        expiry_date TEXT NOT NULL,
+        price REAL,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    
+    # Create suppliers table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS suppliers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        contact_person TEXT,
+        phone TEXT,
+        email TEXT,
+        address TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    
+    # Create transactions table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        medicine_id INTEGER,
+        transaction_type TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        transaction_date TEXT DEFAULT CURRENT_TIMESTAMP,
+        notes TEXT,
+        FOREIGN KEY (medicine_id) REFERENCES medicines (id)
+    )
+    ''')
+
+def add_expiry_day(cursor):
+    # Add and backfill the expiry_day column on databases created before it existed
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(medicines)')]
+    if 'expiry_day' not in columns:
+        cursor.execute('ALTER TABLE medicines ADD COLUMN expiry_day INTEGER')
+        cursor.execute('UPDATE medicines SET expiry_day = ' + EXPIRY_DAY_SQL.format('expiry_date'))
+    
+    # Keep expiry_day in sync with expiry_date on every write
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS medicines_expiry_day_insert
+    AFTER INSERT ON medicines
+    BEGIN
+        UPDATE medicines SET expiry_day = %s WHERE id = NEW.id;
+    END
+    ''' % EXPIRY_DAY_SQL.format('NEW.expiry_date'))
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS medicines_expiry_day_update
+    AFTER UPDATE OF expiry_date ON medicines
+    BEGIN
+        UPDATE medicines SET expiry_day = %s WHERE id = NEW.id;
+    END
+    ''' % EXPIRY_DAY_SQL.format('NEW.expiry_date'))
+    
+    # Only medicines still in stock show up in expiry views
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_medicines_expiry_day
+    ON medicines (expiry_day) WHERE quantity > 0
+    ''')
+
+def add_pagination_indexes(cursor):
+    # Indexes backing keyset pagination on (name, id) and (transaction_date, id)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_medicines_name ON medicines (name)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions (transaction_date)')
+
+def add_transaction_indexes(cursor):
+    # Per-medicine history and deletes, and per-type reports over a date range.
+    # (transaction_date) alone is covered by add_pagination_indexes.
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_transactions_medicine_date
+    ON transactions (medicine_id, transaction_date)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_transactions_type_date
+    ON transactions (transaction_type, transaction_date)
+    ''')
+
+def add_manufacturer_index(cursor):
+    # The typeahead index checks whether a manufacturer is still in use after edits
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_medicines_manufacturer ON medicines (manufacturer)')
+
+def drop_medicines_expiry_index(cursor):
+    # Expiry views read batches and expiry_tiers since stock moved into lots,
+    # the old index on medicines only slowed down every stock write
+    cursor.execute('DROP INDEX IF EXISTS idx_medicines_expiry_day')
+
+# The first five steps were previously run by init_db on every start, so
+# they stay idempotent for databases created before versioning existed
+MIGRATIONS = [
+    create_tables,
+    add_expiry_day,
+    add_pagination_indexes,
+    dashboard.create_summary_tables,
+    search_index.create_search_index,
+    revisions.create_revision_table,
+    archive.create_archive_tables,
+    expiry_tiers.create_expiry_tier_tables,
+    forecast.create_forecast_tables,
+    batches.create_batches_table,
+    expiry_tiers.track_batches,
+    add_transaction_indexes,
+    rollups.create_rollup_tables,
+    purchasing.create_purchasing_tables,
+    add_manufacturer_index,
+    rollups.track_stock_adjustments,
+    drop_medicines_expiry_index,
+    rollups.track_transaction_types,
+    forecast.index_low_stock,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn):
+    # BEGIN IMMEDIATE serializes concurrent runs, the version is re-read under the lock
+    applied = []
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = get_schema_version(conn)
+            if version >= SCHEMA_VERSION:
+                conn.rollback()
+                return applied
+            
+            migration = MIGRATIONS[version]
+            migration(conn.cursor())
+            conn.execute('PRAGMA user_version = %d' % (version + 1))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(migration.__name__)
+
+def check_schema(conn):
+    version = get_schema_version(conn)
+    if version != SCHEMA_VERSION:
+        raise RuntimeError(f'Database schema is at version {version}, expected {SCHEMA_VERSION}. '
+                           f'Run "flask migrate" to upgrade it.')
@@ -0,0 +1,81 @@
+import base64
+import json
+from flask import current_app, request
+
+# Keyset (cursor) pagination: each page continues from the sort key of the
+# last row shown instead of using OFFSET, so every page costs one index range
+# read no matter how deep into the list it is
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) else None
+
+def get_page_args():
+    page_size = request.args.get('limit', current_app.config['PAGE_SIZE'], type=int)
+    page_size = max(1, min(page_size, current_app.config['MAX_PAGE_SIZE']))
+    after = decode_cursor(request.args.get('after'))
+    before = decode_cursor(request.args.get('before'))
+    return after, before, page_size
+
+def fetch_page(conn, select, where, params, keys, descending=False,
+               after=None, before=None, page_size=50):
+    # keys is a list of (column expression, result column) pairs, ending in a unique column
+    columns = [column for column, _ in keys]
+    conditions = ['(%s)' % condition for condition in where]
+    params = list(params)
+    
+    # Walking backwards flips both the comparison and the sort order
+    backwards = before is not None and after is None
+    cursor = before if backwards else after
+    ascending = descending == backwards
+    if cursor is not None and len(cursor) == len(keys):
+        conditions.append('(%s) %s (%s)' % (', '.join(columns), '>' if ascending else '<',
+                                            ', '.join(['?'] * len(keys))))
+        params.extend(cursor)
+    else:
+        cursor = None
+        backwards = False
+        ascending = not descending
+    
+    sql = select
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY ' + ', '.join('%s %s' % (column, 'ASC' if ascending else 'DESC') for column in columns)
+    sql += ' LIMIT ?'
+    params.append(page_size + 1)
+    
+    rows = conn.execute(sql, params).fetchall()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+    
+    def row_cursor(row):
+        return encode_cursor([row[key] for _, key in keys])
+    
+    next_cursor = prev_cursor = None
+    if rows:
+        if backwards:
+            next_cursor = row_cursor(rows[-1])
+            prev_cursor = row_cursor(rows[0]) if has_more else None
+        else:
+            next_cursor = row_cursor(rows[-1]) if has_more else None
+            prev_cursor = row_cursor(rows[0]) if cursor is not None else None
+    
+    return {'items': rows, 'next_cursor': next_cursor, 'prev_cursor': prev_cursor}
+
+def page_to_json(page):
+    return {
+        'items': [dict(row) for row in page['items']],
+        'next_cursor': page['next_cursor'],
+        'prev_cursor': page['prev_cursor'],
+    }
@@ -0,0 +1,304 @@
+import json
+import batches
+from dashboard import LOW_STOCK_THRESHOLD
+from db import EXPIRY_DAY_SQL, today_day, utc_today
+
+# Supplier catalogue and purchase orders. supplier_medicines says which
+# suppliers carry a medicine, in what pack size, at what unit cost and lead
+# time. Orders are generated for every low-stock medicine in one set-based
+# pass: each medicine is ordered from its cheapest supplier (then shortest
+# lead time), up to its reorder point plus ORDER_COVER_DAYS of forecast
+# demand, less what is already on draft orders, rounded up to whole packs.
+# The lines are grouped into one draft order per supplier. Receiving an
+# order puts every line onto a lot in one upsert: the lot with the batch
+# number and expiry given at receipt, a new one when there is none, or
+# without an expiry the medicine's current unexpired lot. The 'add'
+# transactions are posted in bulk. Like stock movements, both run inside a
+# transaction owned by the caller (see write_queue).
+ORDER_COVER_DAYS = 30
+
+# The lines of order :order_id with the lot each goes onto (lot_id, NULL for
+# a new lot), :lots being the receipt as {medicine_id: [batch_number, expiry_date]}
+RECEIPT_SQL = '''
+WITH receipt AS (
+    SELECT l.medicine_id, l.quantity, json_extract(j.value, '$[0]') AS batch_number,
+           json_extract(j.value, '$[1]') AS expiry_date
+    FROM purchase_order_lines l
+    LEFT JOIN json_each(:lots) j ON j.key = CAST(l.medicine_id AS TEXT)
+    WHERE l.purchase_order_id = :order_id
+),
+placed AS (
+    SELECT r.*, CASE WHEN r.expiry_date IS NULL THEN COALESCE(
+        (SELECT id FROM batches b WHERE b.medicine_id = r.medicine_id AND b.quantity > 0
+         AND b.expiry_day >= :today ORDER BY b.expiry_day, b.id LIMIT 1),
+        (SELECT MAX(id) FROM batches b WHERE b.medicine_id = r.medicine_id AND b.expiry_day >= :today))
+    ELSE (SELECT id FROM batches b WHERE b.medicine_id = r.medicine_id AND b.expiry_date = r.expiry_date
+          AND b.batch_number IS r.batch_number) END AS lot_id
+    FROM receipt r
+)
+'''
+
+def create_purchasing_tables(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS supplier_medicines (
+        medicine_id INTEGER NOT NULL,
+        supplier_id INTEGER NOT NULL,
+        lead_time_days INTEGER NOT NULL DEFAULT 7,
+        pack_size INTEGER NOT NULL DEFAULT 1 CHECK (pack_size > 0),
+        unit_cost REAL,
+        PRIMARY KEY (medicine_id, supplier_id),
+        FOREIGN KEY (medicine_id) REFERENCES medicines (id),
+        FOREIGN KEY (supplier_id) REFERENCES suppliers (id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_supplier_medicines_supplier ON supplier_medicines (supplier_id)')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS purchase_orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        supplier_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'draft',
+        expected_day INTEGER,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        received_at TEXT,
+        FOREIGN KEY (supplier_id) REFERENCES suppliers (id)
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_purchase_orders_status ON purchase_orders (status, id)')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS purchase_order_lines (
+        purchase_order_id INTEGER NOT NULL,
+        medicine_id INTEGER NOT NULL,
+        packs INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        unit_cost REAL,
+        PRIMARY KEY (purchase_order_id, medicine_id),
+        FOREIGN KEY (purchase_order_id) REFERENCES purchase_orders (id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_purchase_order_lines_medicine ON purchase_order_lines (medicine_id)')
+    
+    # Catalogue entries and draft lines go with their medicine or supplier,
+    # received orders stay as history
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS purchasing_medicines_delete
+    AFTER DELETE ON medicines
+    BEGIN
+        DELETE FROM supplier_medicines WHERE medicine_id = OLD.id;
+        DELETE FROM purchase_order_lines WHERE medicine_id = OLD.id AND purchase_order_id IN (
+            SELECT id FROM purchase_orders WHERE status = 'draft');
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS purchasing_suppliers_delete
+    AFTER DELETE ON suppliers
+    BEGIN
+        DELETE FROM supplier_medicines WHERE supplier_id = OLD.id;
+        DELETE FROM purchase_order_lines WHERE purchase_order_id IN (
+            SELECT id FROM purchase_orders WHERE supplier_id = OLD.id AND status = 'draft');
+        DELETE FROM purchase_orders WHERE supplier_id = OLD.id AND status = 'draft';
+    END
+    ''')
+
+def parse_catalogue_entry(form):
+    try:
+        medicine_id = int(form['medicine_id'])
+        lead_time_days = int(form.get('lead_time_days') or 7)
+        pack_size = int(form.get('pack_size') or 1)
+        unit_cost = float(form['unit_cost']) if form.get('unit_cost') else None
+    except (KeyError, ValueError, TypeError):
+        raise ValueError('Medicine, lead time and pack size must be whole numbers and unit cost a number')
+    if lead_time_days < 0 or pack_size < 1 or (unit_cost is not None and unit_cost < 0):
+        raise ValueError('Lead time and unit cost cannot be negative and pack size must be at least 1')
+    return medicine_id, lead_time_days, pack_size, unit_cost
+
+def save_catalogue_entry(conn, supplier_id, medicine_id, lead_time_days, pack_size, unit_cost):
+    if conn.execute('SELECT 1 FROM medicines WHERE id = ?', (medicine_id,)).fetchone() is None:
+        raise ValueError('Medicine %d not found' % medicine_id)
+    conn.execute('''
+    INSERT INTO supplier_medicines (medicine_id, supplier_id, lead_time_days, pack_size, unit_cost)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (medicine_id, supplier_id) DO UPDATE SET lead_time_days = excluded.lead_time_days,
+        pack_size = excluded.pack_size, unit_cost = excluded.unit_cost
+    ''', (medicine_id, supplier_id, lead_time_days, pack_size, unit_cost))
+
+def get_catalogue(conn, supplier_id):
+    rows = conn.execute('''
+    SELECT s.medicine_id, m.name, m.category, m.quantity, s.lead_time_days, s.pack_size, s.unit_cost
+    FROM supplier_medicines s
+    JOIN medicines m ON m.id = s.medicine_id
+    WHERE s.supplier_id = ?
+    ORDER BY m.name, s.medicine_id
+    ''', (supplier_id,))
+    return [dict(row) for row in rows]
+
+# ceil() for the non-negative demand figures, without the math extension
+CEIL_SQL = '(CAST({0} AS INTEGER) + ({0} > CAST({0} AS INTEGER)))'
+
+def generate_orders(conn, today, cover_days=ORDER_COVER_DAYS, threshold=LOW_STOCK_THRESHOLD):
+    # Returns the new draft orders and the number of low-stock medicines no
+    # supplier carries
+    conn.execute('DROP TABLE IF EXISTS temp.order_plan')
+    conn.execute('''
+    CREATE TEMP TABLE order_plan AS
+    WITH low AS (
+        SELECT m.id AS medicine_id,
+               COALESCE(r.reorder_point, :threshold) + 1
+               + %s
+               - m.quantity
+               - COALESCE((SELECT SUM(l.quantity) FROM purchase_order_lines l
+                           JOIN purchase_orders o ON o.id = l.purchase_order_id
+                           WHERE l.medicine_id = m.id AND o.status = 'draft'), 0) AS needed
+        FROM medicines m
+        LEFT JOIN reorder_points r ON r.medicine_id = m.id
+        WHERE m.quantity <= COALESCE(r.reorder_point, :threshold)
+    ),
+    ranked AS (
+        SELECT low.medicine_id, low.needed, s.supplier_id, s.pack_size, s.unit_cost, s.lead_time_days,
+               ROW_NUMBER() OVER (PARTITION BY low.medicine_id
+                                  ORDER BY s.unit_cost IS NULL, s.unit_cost, s.lead_time_days, s.supplier_id) AS rank
+        FROM low
+        LEFT JOIN supplier_medicines s ON s.medicine_id = low.medicine_id
+        WHERE low.needed > 0
+    )
+    SELECT supplier_id, medicine_id, (needed + pack_size - 1) / pack_size AS packs, pack_size,
+           unit_cost, lead_time_days
+    FROM ranked WHERE rank = 1
+    ''' % CEIL_SQL.format('COALESCE(r.daily_demand, 0) * :cover_days'),
+                 {'threshold': threshold, 'cover_days': cover_days})
+    
+    last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM purchase_orders').fetchone()[0]
+    conn.execute('''
+    INSERT INTO purchase_orders (supplier_id, expected_day)
+    SELECT supplier_id, ? + MAX(lead_time_days) FROM temp.order_plan
+    WHERE supplier_id IS NOT NULL
+    GROUP BY supplier_id ORDER BY supplier_id
+    ''', (today,))
+    conn.execute('''
+    INSERT INTO purchase_order_lines (purchase_order_id, medicine_id, packs, quantity, unit_cost)
+    SELECT o.id, p.medicine_id, p.packs, p.packs * p.pack_size, p.unit_cost
+    FROM temp.order_plan p
+    JOIN purchase_orders o ON o.supplier_id = p.supplier_id AND o.id > ?
+    ''', (last_id,))
+    unassigned = conn.execute('SELECT COUNT(*) FROM temp.order_plan WHERE supplier_id IS NULL').fetchone()[0]
+    conn.execute('DROP TABLE temp.order_plan')
+    
+    return {'orders': get_orders(conn, after_id=last_id), 'unassigned': unassigned}
+
+def get_orders(conn, status=None, after_id=0):
+    where, params = ['o.id > ?'], [after_id]
+    if status:
+        where.append('o.status = ?')
+        params.append(status)
+    rows = conn.execute('''
+    SELECT o.*, s.name AS supplier_name,
+           (SELECT COUNT(*) FROM purchase_order_lines l WHERE l.purchase_order_id = o.id) AS lines,
+           (SELECT ROUND(SUM(l.quantity * COALESCE(l.unit_cost, 0)), 2)
+            FROM purchase_order_lines l WHERE l.purchase_order_id = o.id) AS total_cost
+    FROM purchase_orders o
+    LEFT JOIN suppliers s ON s.id = o.supplier_id
+    WHERE %s
+    ORDER BY o.id DESC
+    ''' % ' AND '.join(where), params)
+    return [dict(row) for row in rows]
+
+def get_order(conn, order_id):
+    # The order with its lines, None when there is no such order
+    orders = conn.execute('''
+    SELECT o.*, s.name AS supplier_name FROM purchase_orders o
+    LEFT JOIN suppliers s ON s.id = o.supplier_id
+    WHERE o.id = ?
+    ''', (order_id,)).fetchall()
+    if not orders:
+        return None
+    order = dict(orders[0])
+    order['lines'] = [dict(row) for row in conn.execute('''
+    SELECT l.*, m.name, m.quantity AS in_stock FROM purchase_order_lines l
+    LEFT JOIN medicines m ON m.id = l.medicine_id
+    WHERE l.purchase_order_id = ?
+    ORDER BY m.name, l.medicine_id
+    ''', (order_id,))]
+    return order
+
+def check_draft(conn, order_id):
+    row = conn.execute('SELECT status FROM purchase_orders WHERE id = ?', (order_id,)).fetchone()
+    if row is None:
+        raise ValueError('Purchase order %d not found' % order_id)
+    if row['status'] != 'draft':
+        raise ValueError('Purchase order %d has already been %s' % (order_id, row['status']))
+
+def parse_receipt(lines):
+    # [{'medicine_id', 'batch_number', 'expiry_date'}] sent with a receipt
+    # -> {medicine_id: (batch_number, expiry_date)}
+    if not isinstance(lines, list):
+        raise ValueError('Received lines must be a list')
+    today = today_day()
+    lots = {}
+    for line in lines:
+        try:
+            medicine_id = int(line['medicine_id'])
+        except (KeyError, ValueError, TypeError):
+            raise ValueError('Each received line needs an integer medicine_id')
+        batch_number, expiry_date = line.get('batch_number') or None, line.get('expiry_date') or None
+        if batch_number is not None and not isinstance(batch_number, str):
+            raise ValueError('Batch number of medicine %d must be a string' % medicine_id)
+        if expiry_date is not None:
+            batches.check_expiry_date(expiry_date, today)
+        lots[medicine_id] = (batch_number, expiry_date)
+    return lots
+
+def parse_receipt_form(form):
+    # Form fields expiry_date_<medicine_id> and batch_number_<medicine_id>
+    prefix = 'expiry_date_'
+    return parse_receipt([{'medicine_id': key[len(prefix):], 'expiry_date': form[key],
+                           'batch_number': form.get('batch_number_' + key[len(prefix):])}
+                          for key in form if key.startswith(prefix)])
+
+def receive_order(conn, order_id, lots=None, notes=None):
+    # lots maps medicine ids to the (batch_number, expiry_date) they arrived
+    # with, checked by parse_receipt
+    check_draft(conn, order_id)
+    lots = lots or {}
+    ordered = {row[0] for row in conn.execute('''
+    SELECT medicine_id FROM purchase_order_lines WHERE purchase_order_id = ?
+    ''', (order_id,))}
+    unknown = set(lots) - ordered
+    if unknown:
+        raise ValueError('Medicine %d is not on purchase order %d' % (min(unknown), order_id))
+    
+    params = {'order_id': order_id, 'today': today_day(), 'purchase_date': utc_today().isoformat(),
+              'lots': json.dumps({str(medicine_id): list(lot) for medicine_id, lot in lots.items()})}
+    # Received stock never joins a lot that has expired
+    missing = [row[0] for row in conn.execute(RECEIPT_SQL + '''
+    SELECT medicine_id FROM placed WHERE expiry_date IS NULL AND lot_id IS NULL ORDER BY medicine_id
+    ''', params)]
+    if missing:
+        raise ValueError('Medicine %s has no unexpired batch, an expiry date is needed to receive it'
+                         % ', '.join(map(str, missing)))
+    
+    conn.execute(RECEIPT_SQL + '''
+    INSERT INTO batches (id, medicine_id, batch_number, quantity, expiry_date, expiry_day, purchase_date)
+    SELECT p.lot_id, p.medicine_id, p.batch_number, p.quantity, COALESCE(p.expiry_date, lot.expiry_date),
+           %s, :purchase_date
+    FROM placed p
+    LEFT JOIN batches lot ON lot.id = p.lot_id
+    WHERE true
+    ON CONFLICT (id) DO UPDATE SET quantity = quantity + excluded.quantity
+    ''' % EXPIRY_DAY_SQL.format('COALESCE(p.expiry_date, lot.expiry_date)'), params)
+    conn.execute('''
+    UPDATE medicines SET quantity = medicines.quantity + l.quantity
+    FROM purchase_order_lines l
+    WHERE l.purchase_order_id = ? AND medicines.id = l.medicine_id
+    ''', (order_id,))
+    conn.execute('''
+    INSERT INTO transactions (medicine_id, transaction_type, quantity, notes)
+    SELECT medicine_id, 'add', quantity, ? FROM purchase_order_lines WHERE purchase_order_id = ?
+    ''', (notes or 'Received purchase order %d' % order_id, order_id))
+    conn.execute('''
+    UPDATE purchase_orders SET status = 'received', received_at = CURRENT_TIMESTAMP WHERE id = ?
+    ''', (order_id,))
+
+def delete_order(conn, order_id):
+    # Only drafts can be discarded
+    check_draft(conn, order_id)
+    conn.execute('DELETE FROM purchase_order_lines WHERE purchase_order_id = ?', (order_id,))
+    conn.execute('DELETE FROM purchase_orders WHERE id = ?', (order_id,))
@@ -0,0 +1,286 @@
+import argparse
+import collections.abc
+import os
+import re
+import sqlite3
+import tempfile
+import jinja2
+import app as medistore
+import benchmark
+import replica
+from metrics import normalize_sql
+
+# Query plan checks: every route is requested against a generated dataset,
+# each statement it runs on any connection (request, replica, write queue)
+# is captured through DB_TRACE and EXPLAIN QUERY PLAN is run on it. Trigger
+# bodies are checked from the schema, with NEW and OLD columns as
+# parameters. A statement that scans a whole table without an index or
+# sorts through a temporary B-tree fails the check unless it is listed in
+# ALLOWED, word for word (as normalized by metrics.normalize_sql), with the
+# reason why. Walking an index in order is fine, that is how LIMIT queries
+# stop early. Routes that fan out to shards run the same helpers on other
+# connections and are not listed. test_query_plans.py runs the check.
+#   python query_plans.py --scale 10k
+
+# Benchmarked routes plus the writes the benchmark leaves out. CLI entries
+# run a flask command instead: the forecast job's full recompute (its
+# incremental update runs when purchase orders are generated). Receiving
+# the order and delete_medicine run last, they can only run once.
+REQUESTS = [('CLI', 'forecast', None)] + benchmark.ROUTES + [
+    ('POST', '/api/purchase_orders/{order_id}/receive', None),
+    ('POST', '/delete_medicine/{medicine_id}', None),
+]
+
+# Statement, as normalized by metrics.normalize_sql -> why a scan or sort is expected there
+ALLOWED = {normalize_sql(statement): reason for statement, reason in [
+    ('INSERT INTO expiry_tiers (batch_id, medicine_id, expiry_day, recommended_discount, discounted_price)'
+     ' SELECT b.id, b.medicine_id, b.expiry_day, t.percent, CASE WHEN m.price THEN ROUND(m.price * (? - '
+     't.percent / ?), ?) END FROM batches b JOIN medicines m ON m.id = b.medicine_id JOIN '
+     'expiry_tiers_state s LEFT JOIN discount_tiers t ON t.max_days = ( SELECT MIN(max_days) FROM '
+     'discount_tiers WHERE max_days >= b.expiry_day - s.refreshed_day) WHERE b.quantity > ? AND '
+     'b.expiry_day <= s.refreshed_day + s.horizon AND b.id = :new_id',
+     'expiry tiers for one new batch, expiry_tiers_state is a single row'),
+    ('INSERT INTO expiry_tiers (batch_id, medicine_id, expiry_day, recommended_discount, discounted_price)'
+     ' SELECT b.id, b.medicine_id, b.expiry_day, t.percent, CASE WHEN m.price THEN ROUND(m.price * (? - '
+     't.percent / ?), ?) END FROM batches b JOIN medicines m ON m.id = b.medicine_id JOIN '
+     'expiry_tiers_state s LEFT JOIN discount_tiers t ON t.max_days = ( SELECT MIN(max_days) FROM '
+     'discount_tiers WHERE max_days >= b.expiry_day - s.refreshed_day) WHERE b.quantity > ? AND '
+     'b.expiry_day <= s.refreshed_day + s.horizon AND b.medicine_id = :new_id',
+     'expiry tiers for one medicine after a price change, expiry_tiers_state is a single row'),
+    ('SELECT last_transaction_id, computed_day FROM forecast_state',
+     'single row'),
+    ('INSERT INTO demand_daily (medicine_id, day, quantity) SELECT medicine_id, '
+     'CAST(julianday(transaction_date) - ? AS INTEGER) AS day, SUM(quantity) FROM transactions WHERE id > '
+     '? AND transaction_type = ? AND medicine_id IS NOT NULL GROUP BY medicine_id, day ON CONFLICT '
+     '(medicine_id, day) DO UPDATE SET quantity = quantity + excluded.quantity',
+     'forecast batch job, reads only new transactions'),
+    ('SELECT medicine_id, SUM(quantity), SUM(quantity * quantity) FROM demand_daily WHERE day > ? AND day '
+     '<= ? AND ? GROUP BY medicine_id',
+     'forecast batch job, groups the window once per run'),
+    ('SELECT COUNT(*) FROM medicines WHERE (medicines.quantity <= COALESCE( (SELECT reorder_point FROM '
+     'reorder_points WHERE medicine_id = medicines.id), (SELECT value FROM dashboard_summary WHERE key = '
+     '?))) AND ?',
+     'forecast full recompute, counts low stock over every medicine once a day'),
+    ('DELETE FROM reorder_points WHERE ?',
+     'forecast full recompute'),
+    ('SELECT key, value FROM dashboard_summary',
+     'a handful of counters'),
+    ('SELECT refreshed_day, rules FROM expiry_tiers_state',
+     'single row'),
+    ('INSERT INTO expiry_tiers (batch_id, medicine_id, expiry_day, recommended_discount, discounted_price)'
+     ' SELECT b.id, b.medicine_id, b.expiry_day, t.percent, CASE WHEN m.price THEN ROUND(m.price * (? - '
+     't.percent / ?), ?) END FROM batches b JOIN medicines m ON m.id = b.medicine_id JOIN '
+     'expiry_tiers_state s LEFT JOIN discount_tiers t ON t.max_days = ( SELECT MIN(max_days) FROM '
+     'discount_tiers WHERE max_days >= b.expiry_day - s.refreshed_day) WHERE b.quantity > ? AND '
+     'b.expiry_day <= s.refreshed_day + s.horizon AND ?',
+     'daily rebuild of the expiry table, expiry_tiers_state is a single row'),
+    ('SELECT COUNT(*) FROM sqlite_master WHERE type = ? AND name = ?',
+     'schema lookup, cached per app'),
+    ('SELECT k, v FROM ?.?',
+     'SQLite internals (FTS5 configuration)'),
+    ('SELECT * FROM ( SELECT m.*, m.expiry_day - ? AS days_left, bm25(medicines_fts, ?, ?, ?, ?) AS score '
+     'FROM medicines_fts JOIN medicines m ON m.id = medicines_fts.rowid WHERE medicines_fts MATCH ? ) '
+     'ORDER BY score ASC, id ASC LIMIT ?',
+     'ranked search sorts only the matching rows'),
+    ('SELECT * FROM ( SELECT m.*, m.expiry_day - ? AS days_left, bm25(medicines_fts, ?, ?, ?, ?) AS score '
+     'FROM medicines_fts JOIN medicines m ON m.id = medicines_fts.rowid WHERE medicines_fts MATCH ? ) '
+     'ORDER BY score, id LIMIT ?',
+     'ranked search sorts only the matching rows (chain search runs it on every shard)'),
+    ('SELECT l.*, m.name, m.quantity AS in_stock FROM purchase_order_lines l LEFT JOIN medicines m ON '
+     'm.id = l.medicine_id WHERE l.purchase_order_id = ? ORDER BY m.name, l.medicine_id',
+     "sorts the lines of one order, read by the order's primary key prefix"),
+    ('SELECT s.medicine_id, m.name, m.category, m.quantity, s.lead_time_days, s.pack_size, s.unit_cost FROM '
+     'supplier_medicines s JOIN medicines m ON m.id = s.medicine_id WHERE s.supplier_id = ? ORDER BY m.name, '
+     's.medicine_id',
+     "the catalogue page lists one supplier's catalogue whole, read through idx_supplier_medicines_supplier"),
+    ('SELECT * FROM suppliers ORDER BY name',
+     'small table listed whole'),
+    ('SELECT * FROM medicines ORDER BY id',
+     'medicines export streams the whole catalogue in rowid order'),
+    ('SELECT category, SUM(added_quantity) AS added_quantity, SUM(added_value) AS added_value, '
+     'SUM(removed_quantity) AS removed_quantity, SUM(removed_value) AS removed_value, '
+     'SUM(written_off_quantity) AS written_off_quantity, SUM(written_off_value) AS written_off_value, '
+     'SUM(adjusted_value) AS adjusted_value FROM rollup_category_daily WHERE day BETWEEN ? AND ? GROUP BY '
+     'category',
+     'category report groups the rollup rows in the range, one per day and category'),
+    ('SELECT category, SUM(added_value - removed_value - written_off_value + adjusted_value) AS net FROM '
+     'rollup_category_daily WHERE day > ? GROUP BY category',
+     'closing values group the rollup rows after the range, one per day and category'),
+    ('SELECT category, value FROM rollup_category_stock',
+     'one row per category'),
+    ('SELECT r.medicine_id, m.name, m.category, SUM(r.added_quantity) AS added_quantity, '
+     'SUM(r.added_value) AS added_value, SUM(r.removed_quantity) AS removed_quantity, SUM(r.removed_value)'
+     ' AS removed_value, SUM(r.written_off_quantity) AS written_off_quantity, SUM(r.written_off_value) AS '
+     'written_off_value FROM rollup_medicine_daily r LEFT JOIN medicines m ON m.id = r.medicine_id WHERE '
+     'r.day BETWEEN ? AND ? GROUP BY r.medicine_id ORDER BY SUM(r.removed_value) DESC, r.medicine_id '
+     'LIMIT ?',
+     'medicine report ranks the medicines active in the range'),
+    ('CREATE TEMP TABLE order_plan AS WITH low AS ( SELECT m.id AS medicine_id, COALESCE(r.reorder_point, '
+     '?) + ? + (CAST(COALESCE(r.daily_demand, ?) * ? AS INTEGER) + (COALESCE(r.daily_demand, ?) * ? > '
+     'CAST(COALESCE(r.daily_demand, ?) * ? AS INTEGER))) - m.quantity - COALESCE((SELECT SUM(l.quantity) '
+     'FROM purchase_order_lines l JOIN purchase_orders o ON o.id = l.purchase_order_id WHERE l.medicine_id'
+     ' = m.id AND o.status = ?), ?) AS needed FROM medicines m LEFT JOIN reorder_points r ON r.medicine_id'
+     ' = m.id WHERE m.quantity <= COALESCE(r.reorder_point, ?) ), ranked AS ( SELECT low.medicine_id, '
+     'low.needed, s.supplier_id, s.pack_size, s.unit_cost, s.lead_time_days, ROW_NUMBER() OVER (PARTITION '
+     'BY low.medicine_id ORDER BY s.unit_cost IS NULL, s.unit_cost, s.lead_time_days, s.supplier_id) AS '
+     'rank FROM low LEFT JOIN supplier_medicines s ON s.medicine_id = low.medicine_id WHERE low.needed > ?'
+     ' ) SELECT supplier_id, medicine_id, (needed + pack_size - ?) / pack_size AS packs, pack_size, '
+     'unit_cost, lead_time_days FROM ranked WHERE rank = ?',
+     'purchase order plan over every low-stock medicine, once per generation'),
+    ('INSERT INTO purchase_orders (supplier_id, expected_day) SELECT supplier_id, ? + MAX(lead_time_days) '
+     'FROM temp.order_plan WHERE supplier_id IS NOT NULL GROUP BY supplier_id ORDER BY supplier_id',
+     'purchase order plan, a temporary table of a few rows'),
+    ('SELECT COUNT(*) FROM temp.order_plan WHERE supplier_id IS NULL',
+     'purchase order plan, a temporary table of a few rows'),
+]}
+
+def get_bad_steps(details):
+    # Scans of a subquery or CTE (run as a co-routine or materialized) read
+    # its result rather than a table
+    derived = {match.group(1) for match in (re.match(r'(?:CO-ROUTINE|MATERIALIZE) (.+)', detail)
+                                             for detail in details) if match}
+    bad = []
+    for detail in details:
+        if detail.startswith('SCAN '):
+            if not ('USING' in detail or 'VIRTUAL TABLE' in detail or detail == 'SCAN CONSTANT ROW'
+                    or detail[len('SCAN '):] in derived):
+                bad.append(detail)
+        elif 'USE TEMP B-TREE' in detail:
+            bad.append(detail)
+    return bad
+
+def explain(conn, statement, params=()):
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + statement, params)]
+
+def is_checked(statement):
+    return statement.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT', 'CREATE TEMP'))
+
+def is_temp_table_change(statement):
+    # Temporary tables only exist on the connection that made them, the
+    # checker makes its own copy so later statements can be explained
+    return re.match(r'\s*(CREATE TEMP|DROP TABLE IF EXISTS temp\.)', statement, re.IGNORECASE) is not None
+
+class StatementLog:
+    # The DB_TRACE callback. Streamed responses run their queries after the
+    # request is torn down, so capturing stops once the body has been read.
+    def __init__(self):
+        self.statements = None
+    
+    def __call__(self, statement):
+        statements = self.statements
+        if statements is not None:
+            statements.append(statement)
+    
+    def capture(self, client, method, url, options):
+        self.statements = []
+        try:
+            if method == 'CLI':
+                status = client.application.test_cli_runner().invoke(args=url.split()).exit_code
+            else:
+                response = client.open(url, method=method, **(options or {}))
+                response.get_data()
+                status = response.status_code
+        finally:
+            statements, self.statements = self.statements, None
+        return status, statements
+
+def stub_templates(app):
+    # Renders every page with a stub that reads the lazy row iterators in
+    # its context, so pages run their queries without the real templates
+    @jinja2.pass_context
+    def read_rows(context):
+        for value in context.get_all().values():
+            if isinstance(value, collections.abc.Iterator):
+                for _ in value:
+                    pass
+        return ''
+    app.jinja_env.globals['read_rows'] = read_rows
+    app.jinja_env.loader = jinja2.FunctionLoader(lambda name: '{{ read_rows() }}')
+
+def get_trigger_statements(conn):
+    # (trigger name, statement, parameters) for every statement in every
+    # trigger body, NEW.x and OLD.x become the parameters :new_x and :old_x
+    reference = re.compile(r'\b(NEW|OLD)\.(\w+)', re.IGNORECASE)
+    triggers = []
+    for name, sql in conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' ORDER BY name"):
+        body = sql[re.search(r'\bBEGIN\b', sql, re.IGNORECASE).end():sql.upper().rindex('END')]
+        current = ''
+        for part in body.split(';'):
+            current += part + ';'
+            if not sqlite3.complete_statement(current):
+                continue
+            statement = current.strip().rstrip(';').strip()
+            current = ''
+            if statement:
+                statement = reference.sub(lambda match: ':%s_%s' % (match.group(1).lower(), match.group(2)),
+                                          statement)
+                params = {key: None for key in re.findall(r':(\w+)', statement)}
+                triggers.append((name, statement, params))
+    return triggers
+
+def get_failures(conn, source, statement, params=(), seen=None):
+    # [(source, normalized statement, bad plan steps)] for a statement not in ALLOWED
+    normalized = normalize_sql(statement)
+    if seen is not None:
+        if normalized in seen:
+            return []
+        seen.add(normalized)
+    if normalized in ALLOWED:
+        return []
+    bad = get_bad_steps(explain(conn, statement, params))
+    return [(source, normalized, bad)] if bad else []
+
+def run(path, scale='10k', seed=0, medicines=None, transactions=None, stub=False):
+    # Returns the failures, every statement checked once. stub renders the
+    # pages with stub_templates.
+    benchmark.prepare_database(path, scale, seed, medicines, transactions)
+    log = StatementLog()
+    app = medistore.create_app({'DB_PATH': path, 'EXPIRY_SCHEDULER_ENABLED': False, 'DB_TRACE': log,
+                                'FORECAST_REFRESH_SECONDS': 0,
+                                'REPLICA_ENABLED': True, 'REPLICA_REFRESH_SECONDS': 0,
+                                'WRITE_QUEUE_ENABLED': True})
+    if stub:
+        stub_templates(app)
+    # Reads that can go to the replica do, so its statements are captured too
+    with app.app_context():
+        replica.get_replica(app).refresh()
+    client = app.test_client()
+    
+    conn = sqlite3.connect(path)
+    params = benchmark.get_route_params(path)
+    
+    failures = []
+    seen = set()
+    for name, statement, trigger_params in get_trigger_statements(conn):
+        failures.extend(get_failures(conn, 'trigger ' + name, statement, trigger_params, seen))
+    for method, url, options in REQUESTS:
+        status, statements = log.capture(client, method, benchmark.fill(url, params),
+                                         benchmark.fill(options, params))
+        print(f'{method:4} {url:60} {status}  {len(statements)} statements')
+        for statement in statements:
+            if is_checked(statement):
+                failures.extend(get_failures(conn, url, statement, seen=seen))
+            if is_temp_table_change(statement):
+                conn.execute(statement)
+    conn.close()
+    
+    for source, statement, bad in failures:
+        print(f'\n{source}\n    {statement}\n    -> ' + '; '.join(bad))
+    return failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the query plans of every MediStore route.')
+    parser.add_argument('--scale', choices=sorted(benchmark.sample_data.SCALES), default='10k')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', help='Database to check against, generated if it does not exist. '
+                                     'Writes are applied to it.')
+    parser.add_argument('--stub-templates', action='store_true',
+                        help='Render pages with stub templates, for a checkout without them.')
+    args = parser.parse_args()
+    
+    path = args.db or os.path.join(tempfile.gettempdir(), f'medistore_plans_{args.scale}_{args.seed}.db')
+    failures = run(path, args.scale, args.seed, stub=args.stub_templates)
+    if failures:
+        print(f'\n{len(failures)} statements scan a table or sort in a temporary B-tree.')
+        raise SystemExit(1)
+    print('All query plans use indexes.')
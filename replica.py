@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import threading
+import time
+from flask import current_app, g
+import db
+
+# Report replica. With REPLICA_ENABLED, heavy reads (transaction lists, expiry
+# views, exports) are served from a read-only copy of the shard made with the
+# online backup API, so reporting never holds locks on the primary. A refresh
+# copies REPLICA_BACKUP_PAGES pages per step into a temporary file while a read
+# transaction on the source pins one WAL snapshot, then renames the copy over
+# the replica. Replica connections open the file immutable and mmap-ed; since
+# the file is replaced rather than changed, connections already open keep
+# reading their own snapshot and the next checkout gets the new one. A replica
+# older than REPLICA_MAX_STALENESS seconds is refreshed in the background and
+# reads go to the primary meanwhile.
+
+def get_replica_path(app, store=None):
+    base, ext = os.path.splitext(db.get_db_path(app, store))
+    return base + '.replica' + (ext or '.db')
+
+class Replica:
+    def __init__(self, app, store=None):
+        self.app = app
+        self.store = store
+        self.source_path = db.get_db_path(app, store)
+        self.path = get_replica_path(app, store)
+        self.config = db.get_pool(app, store).config
+        self.pages = app.config['REPLICA_BACKUP_PAGES']
+        self.pool = None
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+        # A copy left by an earlier run is used until it is too old
+        if os.path.exists(self.path):
+            self.refreshed_at = os.path.getmtime(self.path)
+            self.pool = db.ConnectionPool(self.path, self.config, immutable=True)
+    
+    def get_pool(self, max_staleness):
+        # None when there is no copy yet or it is too old
+        if self.refreshed_at is None or time.time() - self.refreshed_at > max_staleness:
+            return None
+        return self.pool
+    
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+    
+    def refresh_in_background(self):
+        # Skipped while another refresh is running
+        if not self._lock.acquire(blocking=False):
+            return
+        
+        def run():
+            try:
+                self._refresh()
+            except Exception:
+                self.app.logger.exception('Replica refresh failed for store %s', self.store)
+            finally:
+                self._lock.release()
+        threading.Thread(target=run, name='replica-refresh', daemon=True).start()
+    
+    def _refresh(self):
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        
+        source = db.connect(self.source_path, self.config)
+        try:
+            target = sqlite3.connect(tmp_path)
+            try:
+                # Every step reads the snapshot of this transaction, so writes
+                # committed meanwhile neither block nor restart the copy
+                source.execute('BEGIN')
+                source.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchone()
+                started = time.time()
+                source.backup(target, pages=self.pages)
+                source.rollback()
+                # Immutable connections can't read a WAL database
+                target.execute('PRAGMA journal_mode = DELETE')
+            finally:
+                target.close()
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            source.close()
+        
+        os.replace(tmp_path, self.path)
+        old_pool = self.pool
+        self.pool = db.ConnectionPool(self.path, self.config, immutable=True)
+        self.refreshed_at = started
+        if old_pool is not None:
+            old_pool.close()
+
+_replicas_lock = threading.Lock()
+
+def get_replica(app=None, store=None):
+    app = app or current_app._get_current_object()
+    with _replicas_lock:
+        replicas = app.extensions.setdefault('replicas', {})
+        if store not in replicas:
+            replicas[store] = Replica(app, store)
+        return replicas[store]
+
+def get_report_connection():
+    # The replica's connection when it is enabled and fresh enough, the
+    # request's primary connection otherwise. Kept for the rest of the
+    # request so all its reads see one snapshot.
+    if 'report_db' not in g:
+        config = current_app.config
+        pool = None
+        if config['REPLICA_ENABLED']:
+            replica = get_replica(store=db.get_store())
+            pool = replica.get_pool(config['REPLICA_MAX_STALENESS'])
+            if pool is None:
+                replica.refresh_in_background()
+        if pool is None:
+            g.report_db = db.get_db_connection()
+        else:
+            g.report_pool = pool
+            g.report_db = pool.acquire()
+    return g.report_db
+
+def close_report_connection(exception=None):
+    conn = g.pop('report_db', None)
+    pool = g.pop('report_pool', None)
+    if pool is not None:
+        pool.release(conn)
+
+def start_scheduler(app):
+    # One daemon timer per app refreshing every shard's replica, re-armed after every run
+    if app.extensions.get('replica_timer') or not app.config['REPLICA_REFRESH_SECONDS']:
+        return
+    
+    def run():
+        for store in [None] + list(app.config['STORES']):
+            try:
+                get_replica(app, store).refresh()
+            except Exception:
+                app.logger.exception('Scheduled replica refresh failed for store %s', store)
+        schedule()
+    
+    def schedule():
+        timer = threading.Timer(app.config['REPLICA_REFRESH_SECONDS'], run)
+        timer.daemon = True
+        timer.start()
+        app.extensions['replica_timer'] = timer
+    
+    schedule()
@@ -0,0 +1,54 @@
+import hashlib
+from functools import wraps
+from flask import request, make_response
+from db import get_db_connection, today_day
+
+# A revision number bumped by triggers on every write to medicines and
+# transactions. Read endpoints derive a strong ETag from it, so a poll with a
+# matching If-None-Match is answered with 304 before any query runs.
+TRACKED_TABLES = ['medicines', 'transactions']
+
+def create_revision_table(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS data_revision (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        revision INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO data_revision (id, revision) VALUES (1, 0)')
+    
+    for table in TRACKED_TABLES:
+        for event in ['INSERT', 'UPDATE', 'DELETE']:
+            cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS %(table)s_revision_%(event)s
+            AFTER %(event)s ON %(table)s
+            BEGIN
+                UPDATE data_revision SET revision = revision + 1 WHERE id = 1;
+            END
+            ''' % {'table': table, 'event': event.lower()})
+
+def get_revision(conn):
+    return conn.execute('SELECT revision FROM data_revision WHERE id = 1').fetchone()[0]
+
+def compute_etag(revision):
+    # Expiry figures also change at midnight, so the day is part of the tag
+    key = '%s|%s|%d|%d' % (request.endpoint, request.query_string.decode(), revision, today_day())
+    return hashlib.blake2b(key.encode(), digest_size=12).hexdigest()
+
+def etag_cached(view=None, get_connection=get_db_connection):
+    # get_connection is what the view reads from, so a view served from the
+    # report replica is tagged with the replica's revision
+    if view is None:
+        return lambda view: etag_cached(view, get_connection)
+    
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        etag = compute_etag(get_revision(get_connection()))
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+        else:
+            response = make_response(view(*args, **kwargs))
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return wrapper
@@ -0,0 +1,304 @@
+from datetime import date, timedelta
+from db import EPOCH, EXPIRY_DAY_SQL
+
+# Inventory analytics are answered from daily rollups kept by triggers, so a
+# report over any date range reads one row per day and category (or per
+# medicine with activity) instead of the raw transactions:
+#   rollup_medicine_daily - stock received, removed and written off per medicine and day
+#   rollup_category_daily - the same per category and day
+#   rollup_category_stock - current quantity and value per category
+# Values are quantity * the medicine's price when the stock moved. Removals
+# ('remove' transactions) are stock dispensed or taken out, write-offs
+# ('write_off') expired stock written off, the two never overlap. Stock
+# value that changes without a movement (a price or category edit, a
+# deleted medicine, a quantity correction from the edit form) is recorded on
+# the day it happens as adjusted_value in rollup_category_daily, so opening
+# and closing values can be derived back from the current stock. Rollups
+# are history: archiving transactions or deleting a medicine leaves the
+# days already counted alone.
+FLOW_COLUMNS = ['added_quantity', 'added_value', 'removed_quantity', 'removed_value',
+                'written_off_quantity', 'written_off_value']
+
+DAY_SQL = EXPIRY_DAY_SQL.format('NEW.transaction_date')
+TODAY_SQL = EXPIRY_DAY_SQL.format("'now'")
+PRICE_SQL = 'COALESCE((SELECT price FROM medicines WHERE id = {row}.medicine_id), 0)'
+CATEGORY_SQL = "COALESCE((SELECT category FROM medicines WHERE id = {row}.medicine_id), '')"
+
+def create_rollup_tables(cursor):
+    flows = ',\n        '.join('%s %s NOT NULL DEFAULT 0' % (column, 'REAL' if column.endswith('value') else 'INTEGER')
+                               for column in FLOW_COLUMNS)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS rollup_medicine_daily (
+        medicine_id INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        %s,
+        PRIMARY KEY (medicine_id, day)
+    ) WITHOUT ROWID
+    ''' % flows)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_rollup_medicine_daily_day ON rollup_medicine_daily (day)')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS rollup_category_daily (
+        day INTEGER NOT NULL,
+        category TEXT NOT NULL,
+        %s,
+        PRIMARY KEY (day, category)
+    ) WITHOUT ROWID
+    ''' % flows)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS rollup_category_stock (
+        category TEXT PRIMARY KEY,
+        quantity INTEGER NOT NULL DEFAULT 0,
+        value REAL NOT NULL DEFAULT 0
+    )
+    ''')
+    
+    rebuild_rollups(cursor)
+    
+    # Stock movements, one upsert per table
+    for table, key, key_value in [('rollup_medicine_daily', 'medicine_id, day', 'NEW.medicine_id, %s' % DAY_SQL),
+                                  ('rollup_category_daily', 'day, category', '%s, %s' % (
+                                      DAY_SQL, CATEGORY_SQL.format(row='NEW')))]:
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS %(table)s_transactions_insert
+        AFTER INSERT ON transactions
+        WHEN NEW.medicine_id IS NOT NULL AND NEW.transaction_type IN ('add', 'remove')
+        BEGIN
+            INSERT INTO %(table)s (%(key)s, added_quantity, added_value, removed_quantity, removed_value)
+            SELECT %(key_value)s, quantity * is_add, quantity * is_add * price,
+                   quantity * (1 - is_add), quantity * (1 - is_add) * price
+            FROM (SELECT NEW.quantity AS quantity, NEW.transaction_type = 'add' AS is_add,
+                         %(price)s AS price)
+            WHERE 1
+            ON CONFLICT (%(key)s) DO UPDATE SET
+                added_quantity = added_quantity + excluded.added_quantity,
+                added_value = added_value + excluded.added_value,
+                removed_quantity = removed_quantity + excluded.removed_quantity,
+                removed_value = removed_value + excluded.removed_value;
+        END
+        ''' % {'table': table, 'key': key, 'key_value': key_value, 'price': PRICE_SQL.format(row='NEW')})
+        
+        # Stock leaving a batch after its expiry day is written off
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS %(table)s_batches_write_off
+        AFTER UPDATE OF quantity ON batches
+        WHEN NEW.quantity < OLD.quantity AND OLD.expiry_day < %(today)s
+        BEGIN
+            INSERT INTO %(table)s (%(key)s, written_off_quantity, written_off_value)
+            SELECT %(key_value)s, OLD.quantity - NEW.quantity, (OLD.quantity - NEW.quantity) * %(price)s
+            WHERE 1
+            ON CONFLICT (%(key)s) DO UPDATE SET
+                written_off_quantity = written_off_quantity + excluded.written_off_quantity,
+                written_off_value = written_off_value + excluded.written_off_value;
+        END
+        ''' % {'table': table, 'key': key, 'today': TODAY_SQL, 'price': PRICE_SQL.format(row='NEW'),
+               'key_value': key_value.replace(DAY_SQL, TODAY_SQL)})
+    
+    # Current stock per category, for opening and closing valuations
+    upsert = '''
+            INSERT INTO rollup_category_stock (category, quantity, value)
+            VALUES (COALESCE({row}.category, ''), {sign}{row}.quantity, {sign}{row}.quantity * COALESCE({row}.price, 0))
+            ON CONFLICT (category) DO UPDATE SET quantity = quantity + excluded.quantity,
+                value = value + excluded.value;'''
+    for event, statements in [('insert', [('NEW', '')]),
+                              ('update', [('OLD', '-'), ('NEW', '')]),
+                              ('delete', [('OLD', '-')])]:
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS rollup_category_stock_%(event)s
+        AFTER %(trigger_event)s ON medicines
+        BEGIN%(body)s
+        END
+        ''' % {'event': event,
+               'trigger_event': 'UPDATE OF quantity, price, category' if event == 'update' else event.upper(),
+               'body': ''.join(upsert.format(row=row, sign=sign) for row, sign in statements)})
+
+def track_stock_adjustments(cursor):
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(rollup_category_daily)')]
+    if 'adjusted_value' not in columns:
+        cursor.execute('ALTER TABLE rollup_category_daily ADD COLUMN adjusted_value REAL NOT NULL DEFAULT 0')
+    
+    # Movements are valued at the price when their transaction is posted,
+    # after the medicine row is updated, so a price or category edit
+    # revalues the quantity held before it
+    adjust = '''
+            INSERT INTO rollup_category_daily (day, category, adjusted_value)
+            VALUES (%s, COALESCE({row}.category, ''), {sign}OLD.quantity * COALESCE({row}.price, 0))
+            ON CONFLICT (day, category) DO UPDATE SET adjusted_value = adjusted_value + excluded.adjusted_value;''' % TODAY_SQL
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS rollup_category_daily_medicines_revalue
+    AFTER UPDATE OF price, category ON medicines
+    WHEN OLD.price IS NOT NEW.price OR OLD.category IS NOT NEW.category
+    BEGIN%s%s
+    END
+    ''' % (adjust.format(row='OLD', sign='-'), adjust.format(row='NEW', sign='')))
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS rollup_category_daily_medicines_delete
+    AFTER DELETE ON medicines
+    BEGIN%s
+    END
+    ''' % adjust.format(row='OLD', sign='-'))
+
+def track_transaction_types(cursor):
+    # Write-offs and edit corrections used to be posted as 'add' and 'remove',
+    # with write-offs picked out from the expired batch they left and also
+    # counted in the removal. They now have their own transaction types, and
+    # the removals already counted give their write-offs back.
+    for table in ['rollup_medicine_daily', 'rollup_category_daily']:
+        cursor.execute('DROP TRIGGER IF EXISTS %s_transactions_insert' % table)
+        cursor.execute('DROP TRIGGER IF EXISTS %s_batches_write_off' % table)
+        cursor.execute('''
+        UPDATE %s SET removed_quantity = removed_quantity - written_off_quantity,
+            removed_value = removed_value - written_off_value
+        ''' % table)
+    
+    for table, key, key_value in [('rollup_medicine_daily', 'medicine_id, day', 'NEW.medicine_id, %s' % DAY_SQL),
+                                  ('rollup_category_daily', 'day, category', '%s, %s' % (
+                                      DAY_SQL, CATEGORY_SQL.format(row='NEW')))]:
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS %(table)s_transactions_insert
+        AFTER INSERT ON transactions
+        WHEN NEW.medicine_id IS NOT NULL AND NEW.transaction_type IN ('add', 'remove', 'write_off')
+        BEGIN
+            INSERT INTO %(table)s (%(key)s, added_quantity, added_value, removed_quantity, removed_value,
+                                   written_off_quantity, written_off_value)
+            SELECT %(key_value)s, quantity * is_add, quantity * is_add * price,
+                   quantity * is_remove, quantity * is_remove * price,
+                   quantity * is_write_off, quantity * is_write_off * price
+            FROM (SELECT NEW.quantity AS quantity, NEW.transaction_type = 'add' AS is_add,
+                         NEW.transaction_type = 'remove' AS is_remove,
+                         NEW.transaction_type = 'write_off' AS is_write_off, %(price)s AS price)
+            WHERE 1
+            ON CONFLICT (%(key)s) DO UPDATE SET
+                added_quantity = added_quantity + excluded.added_quantity,
+                added_value = added_value + excluded.added_value,
+                removed_quantity = removed_quantity + excluded.removed_quantity,
+                removed_value = removed_value + excluded.removed_value,
+                written_off_quantity = written_off_quantity + excluded.written_off_quantity,
+                written_off_value = written_off_value + excluded.written_off_value;
+        END
+        ''' % {'table': table, 'key': key, 'key_value': key_value, 'price': PRICE_SQL.format(row='NEW')})
+    
+    # A correction's quantity is signed, it only changes the stock value
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS rollup_category_daily_transactions_correction
+    AFTER INSERT ON transactions
+    WHEN NEW.medicine_id IS NOT NULL AND NEW.transaction_type = 'correction'
+    BEGIN
+        INSERT INTO rollup_category_daily (day, category, adjusted_value)
+        VALUES (%s, %s, NEW.quantity * %s)
+        ON CONFLICT (day, category) DO UPDATE SET adjusted_value = adjusted_value + excluded.adjusted_value;
+    END
+    ''' % (DAY_SQL, CATEGORY_SQL.format(row='NEW'), PRICE_SQL.format(row='NEW')))
+
+def rebuild_rollups(cursor):
+    # Recompute the rollups from the transactions still in the main database.
+    # Adjustments and archived months can't be recovered from there, so this
+    # is only for databases whose history is all in transactions (new or bulk
+    # loaded ones).
+    for table in ['rollup_medicine_daily', 'rollup_category_daily', 'rollup_category_stock']:
+        cursor.execute('DELETE FROM %s' % table)
+    flows = '''
+        SUM(CASE WHEN t.transaction_type = 'add' THEN t.quantity ELSE 0 END),
+        SUM(CASE WHEN t.transaction_type = 'add' THEN t.quantity * COALESCE(m.price, 0) ELSE 0 END),
+        SUM(CASE WHEN t.transaction_type = 'remove' THEN t.quantity ELSE 0 END),
+        SUM(CASE WHEN t.transaction_type = 'remove' THEN t.quantity * COALESCE(m.price, 0) ELSE 0 END),
+        SUM(CASE WHEN t.transaction_type = 'write_off' THEN t.quantity ELSE 0 END),
+        SUM(CASE WHEN t.transaction_type = 'write_off' THEN t.quantity * COALESCE(m.price, 0) ELSE 0 END)'''
+    day = EXPIRY_DAY_SQL.format('t.transaction_date')
+    for table, key, key_value in [('rollup_medicine_daily', 'medicine_id, day', 't.medicine_id, %s' % day),
+                                  ('rollup_category_daily', 'day, category', "%s, COALESCE(m.category, '')" % day)]:
+        cursor.execute('''
+        INSERT INTO %s (%s, %s)
+        SELECT %s, %s
+        FROM transactions t
+        LEFT JOIN medicines m ON m.id = t.medicine_id
+        WHERE t.medicine_id IS NOT NULL AND t.transaction_type IN ('add', 'remove', 'write_off')
+        GROUP BY 1, 2
+        ''' % (table, key, ', '.join(FLOW_COLUMNS), key_value, flows))
+    cursor.execute('''
+    INSERT INTO rollup_category_stock (category, quantity, value)
+    SELECT COALESCE(category, ''), SUM(quantity), SUM(quantity * COALESCE(price, 0))
+    FROM medicines GROUP BY 1
+    ''')
+
+def parse_day(value, default):
+    # YYYY-MM-DD to a day number, ValueError when malformed
+    if not value:
+        return default
+    return (date.fromisoformat(value) - EPOCH).days
+
+def format_day(day):
+    return (EPOCH + timedelta(days=day)).isoformat()
+
+def flow_sums(prefix=''):
+    return ', '.join('SUM(%s%s) AS %s' % (prefix, column, column) for column in FLOW_COLUMNS)
+
+def add_derived(row):
+    # Consumption is what was removed, write-offs are counted apart
+    row['consumed_quantity'] = row['removed_quantity']
+    row['consumed_value'] = round(row['removed_value'], 2)
+    for column in ['added_value', 'removed_value', 'written_off_value', 'adjusted_value']:
+        if column in row:
+            row[column] = round(row[column], 2)
+    return row
+
+def get_category_report(conn, start_day, end_day):
+    # Flows and adjustments per category over the range, with the stock value
+    # at either end of it and turnover (consumption over average stock value)
+    rows = {row['category']: dict(row) for row in conn.execute('''
+    SELECT category, %s, SUM(adjusted_value) AS adjusted_value FROM rollup_category_daily
+    WHERE day BETWEEN ? AND ? GROUP BY category
+    ''' % flow_sums(), (start_day, end_day))}
+    # Closing value is today's value less every change in value since the range ended
+    later = {row['category']: row['net'] for row in conn.execute('''
+    SELECT category, SUM(added_value - removed_value - written_off_value + adjusted_value) AS net
+    FROM rollup_category_daily
+    WHERE day > ? GROUP BY category
+    ''', (end_day,))}
+    current = {row['category']: row['value'] for row in conn.execute(
+        'SELECT category, value FROM rollup_category_stock')}
+    
+    report = []
+    for category in sorted(set(rows) | set(current)):
+        row = rows.get(category) or dict.fromkeys(FLOW_COLUMNS + ['adjusted_value'], 0)
+        add_derived(row)
+        closing = current.get(category, 0) - later.get(category, 0)
+        opening = closing - (row['added_value'] - row['removed_value'] - row['written_off_value'] +
+                             row['adjusted_value'])
+        average = (opening + closing) / 2
+        row.update({
+            'category': category or None,
+            'opening_value': round(opening, 2),
+            'closing_value': round(closing, 2),
+            'turnover': round(row['consumed_value'] / average, 2) if average > 0 else None,
+        })
+        report.append(row)
+    return report
+
+def get_medicine_report(conn, start_day, end_day, category=None, limit=50):
+    # Medicines with the highest consumption value over the range
+    where, params = ['r.day BETWEEN ? AND ?'], [start_day, end_day]
+    if category is not None:
+        where.append('m.category = ?')
+        params.append(category)
+    rows = conn.execute('''
+    SELECT r.medicine_id, m.name, m.category, %s
+    FROM rollup_medicine_daily r
+    LEFT JOIN medicines m ON m.id = r.medicine_id
+    WHERE %s
+    GROUP BY r.medicine_id
+    ORDER BY SUM(r.removed_value) DESC, r.medicine_id
+    LIMIT ?
+    ''' % (flow_sums('r.'), ' AND '.join(where)), params + [limit])
+    return [add_derived(dict(row)) for row in rows]
+
+def get_daily_report(conn, start_day, end_day, category=None):
+    # One row per day with activity, for charts
+    where, params = ['day BETWEEN ? AND ?'], [start_day, end_day]
+    if category is not None:
+        where.append('category = ?')
+        params.append(category)
+    rows = conn.execute('''
+    SELECT day, %s FROM rollup_category_daily
+    WHERE %s GROUP BY day ORDER BY day
+    ''' % (flow_sums(), ' AND '.join(where)), params)
+    return [dict(add_derived(dict(row)), date=format_day(row['day'])) for row in rows]
@@ -1,9 +1,35 @@
 import sqlite3
 import os
-from datetime import datetime, timedelta
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
 import random
+import dashboard
+import batches
+import rollups
+from db import EPOCH
 DB_PATH = os.path.join('database', 'medicine_stock.db')
 
+# Preset sizes for generate_dataset: (medicines, transactions)
+SCALES = {
+    'demo': (1000, 10000),
+    '10k': (10000, 100000),
+    '100k': (100000, 1000000),
+    '1m': (1000000, 10000000),
+}
+
+GENERATOR_BATCH_SIZE = 50000
+# Suppliers in a generated dataset, each medicine is in one or two of their catalogues
+GENERATED_SUPPLIERS = 50
+
+NAME_PARTS = ['amo', 'xi', 'cil', 'lin', 'para', 'ce', 'ta', 'mol', 'ibu', 'pro', 'fen', 'met',
+              'for', 'min', 'ome', 'pra', 'zole', 'sal', 'bu', 'dia', 'ze', 'pam', 'cor', 'ti',
+              'sone', 'lo', 'ra', 'da', 'ne', 'vir', 'sta', 'tin', 'pril', 'sar', 'tan']
+STRENGTHS = ['5mg', '10mg', '20mg', '25mg', '50mg', '100mg', '250mg', '500mg', '1g', '1%', '2%']
+CATEGORIES = ['Tablet', 'Capsule', 'Syrup', 'Inhaler', 'Cream', 'Injection', 'Drops', 'Ointment']
+UNITS = {'Tablet': 'Tablets', 'Capsule': 'Capsules', 'Syrup': 'Bottles', 'Inhaler': 'Inhalers',
+         'Cream': 'Tubes', 'Injection': 'Vials', 'Drops': 'Bottles', 'Ointment': 'Tubes'}
+
 medicines = [
     {
         'name': 'Paracetamol 500mg',
@@ -13,8 +39,8 @@ medicines = [
         'unit': 'Tablets',
         'manufacturer': 'PharmaCorp',
         'batch_number': 'PCM2023-001',
-        'purchase_date': (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d'),
-        'expiry_date': (datetime.now() + timedelta(days=365)).strftime('%Y-%m-%d'),
+        'purchase_date': (datetime.now(timezone.utc) - timedelta(days=30)).strftime('%Y-%m-%d'),
+        'expiry_date': (datetime.now(timezone.utc) + timedelta(days=365)).strftime('%Y-%m-%d'),
         'price': 5.99
     },
     {
@@ -25,8 +51,8 @@ medicines = [
         'unit': 'Capsules',
         'manufacturer': 'MediPharm',
         'batch_number': 'AMX2023-002',
-        'purchase_date': (datetime.now() - timedelta(days=15)).strftime('%Y-%m-%d'),
-        'expiry_date': (datetime.now() + timedelta(days=180)).strftime('%Y-%m-%d'),
+        'purchase_date': (datetime.now(timezone.utc) - timedelta(days=15)).strftime('%Y-%m-%d'),
+        'expiry_date': (datetime.now(timezone.utc) + timedelta(days=180)).strftime('%Y-%m-%d'),
         'price': 12.50
     },
     {
@@ -37,8 +63,8 @@ medicines = [
         'unit': 'Tablets',
         'manufacturer': 'HealthMeds',
         'batch_number': 'IBU2023-003',
-        'purchase_date': (datetime.now() - timedelta(days=45)).strftime('%Y-%m-%d'),
-        'expiry_date': (datetime.now() + timedelta(days=730)).strftime('%Y-%m-%d'),
+        'purchase_date': (datetime.now(timezone.utc) - timedelta(days=45)).strftime('%Y-%m-%d'),
+        'expiry_date': (datetime.now(timezone.utc) + timedelta(days=730)).strftime('%Y-%m-%d'),
         'price': 7.25
     },
     {
@@ -49,8 +75,8 @@ medicines = [
         'unit': 'Tablets',
         'manufacturer': 'AllergyRelief',
         'batch_number': 'CET2023-004',
-        'purchase_date': (datetime.now() - timedelta(days=10)).strftime('%Y-%m-%d'),
-        'expiry_date': (datetime.now() + timedelta(days=90)).strftime('%Y-%m-%d'),
+        'purchase_date': (datetime.now(timezone.utc) - timedelta(days=10)).strftime('%Y-%m-%d'),
+        'expiry_date': (datetime.now(timezone.utc) + timedelta(days=90)).strftime('%Y-%m-%d'),
         'price': 8.99
     },
     {
@@ -61,8 +87,8 @@ medicines = [
         'unit': 'Capsules',
         'manufacturer': 'GastroHealth',
         'batch_number': 'OME2023-005',
-        'purchase_date': (datetime.now() - timedelta(days=20)).strftime('%Y-%m-%d'),
-        'expiry_date': (datetime.now() + timedelta(days=15)).strftime('%Y-%m-%d'),
+        'purchase_date': (datetime.now(timezone.utc) - timedelta(days=20)).strftime('%Y-%m-%d'),
+        'expiry_date': (datetime.now(timezone.utc) + timedelta(days=15)).strftime('%Y-%m-%d'),
         'price': 14.75
     },
     {
@@ -73,8 +99,8 @@ medicines = [
         'unit': 'Tablets',
         'manufacturer': 'DiabeCare',
         'batch_number': 'MET2023-006',
-        'purchase_date': (datetime.now() - timedelta(days=60)).strftime('%Y-%m-%d'),
-        'expiry_date': (datetime.now() + timedelta(days=450)).strftime('%Y-%m-%d'),
+        'purchase_date': (datetime.now(timezone.utc) - timedelta(days=60)).strftime('%Y-%m-%d'),
+        'expiry_date': (datetime.now(timezone.utc) + timedelta(days=450)).strftime('%Y-%m-%d'),
         'price': 9.50
     },
     {
@@ -85,8 +111,8 @@ medicines = [
         'unit': 'Inhalers',
         'manufacturer': 'RespiCare',
         'batch_number': 'SAL2023-007',
-        'purchase_date': (datetime.now() - timedelta(days=5)).strftime('%Y-%m-%d'),
-        'expiry_date': (datetime.now() + timedelta(days=300)).strftime('%Y-%m-%d'),
+        'purchase_date': (datetime.now(timezone.utc) - timedelta(days=5)).strftime('%Y-%m-%d'),
+        'expiry_date': (datetime.now(timezone.utc) + timedelta(days=300)).strftime('%Y-%m-%d'),
         'price': 22.99
     },
     {
@@ -97,8 +123,8 @@ medicines = [
         'unit': 'Tablets',
         'manufacturer': 'CardioHealth',
         'batch_number': 'ASP2023-008',
-        'purchase_date': (datetime.now() - timedelta(days=25)).strftime('%Y-%m-%d'),
-        'expiry_date': (datetime.now() + timedelta(days=5)).strftime('%Y-%m-%d'),
+        'purchase_date': (datetime.now(timezone.utc) - timedelta(days=25)).strftime('%Y-%m-%d'),
+        'expiry_date': (datetime.now(timezone.utc) + timedelta(days=5)).strftime('%Y-%m-%d'),
         'price': 4.25
     },
     {
@@ -109,8 +135,8 @@ medicines = [
         'unit': 'Tablets',
         'manufacturer': 'NeuroCare',
         'batch_number': 'DIA2023-009',
-        'purchase_date': (datetime.now() - timedelta(days=40)).strftime('%Y-%m-%d'),
-        'expiry_date': (datetime.now() + timedelta(days=270)).strftime('%Y-%m-%d'),
+        'purchase_date': (datetime.now(timezone.utc) - timedelta(days=40)).strftime('%Y-%m-%d'),
+        'expiry_date': (datetime.now(timezone.utc) + timedelta(days=270)).strftime('%Y-%m-%d'),
         'price': 18.50
     },
     {
@@ -121,8 +147,8 @@ medicines = [
         'unit': 'Tubes',
         'manufacturer': 'DermaCare',
         'batch_number': 'HYD2023-010',
-        'purchase_date': (datetime.now() - timedelta(days=15)).strftime('%Y-%m-%d'),
-        'expiry_date': (datetime.now() + timedelta(days=180)).strftime('%Y-%m-%d'),
+        'purchase_date': (datetime.now(timezone.utc) - timedelta(days=15)).strftime('%Y-%m-%d'),
+        'expiry_date': (datetime.now(timezone.utc) + timedelta(days=180)).strftime('%Y-%m-%d'),
         'price': 11.25
     }
 ]
@@ -153,7 +179,7 @@ suppliers = [
 
 def populate_sample_data():
     if not os.path.exists(DB_PATH):
-        print("Database not found. Please run the main application first to create the database.")
+        print("Database not found. Please run 'flask --app app migrate' first to create the database.")
         return
     
     conn = sqlite3.connect(DB_PATH)
@@ -183,7 +209,7 @@ def populate_sample_data():
         INSERT INTO transactions (medicine_id, transaction_type, quantity, notes, transaction_date)
         VALUES (?, ?, ?, ?, ?)
         ''', (medicine_id, 'add', medicine['quantity'], f'Initial stock of {medicine["name"]}', 
-              (datetime.now() - timedelta(days=random.randint(1, 60))).strftime('%Y-%m-%d %H:%M:%S')))
+              (datetime.now(timezone.utc) - timedelta(days=random.randint(1, 60))).strftime('%Y-%m-%d %H:%M:%S')))
     
     
     for supplier in suppliers:
@@ -199,7 +225,7 @@ def populate_sample_data():
         transaction_type = random.choice(['add', 'remove'])
         quantity = random.randint(1, 20)
         days_ago = random.randint(1, 30)
-        transaction_date = (datetime.now() - timedelta(days=days_ago)).strftime('%Y-%m-%d %H:%M:%S')
+        transaction_date = (datetime.now(timezone.utc) - timedelta(days=days_ago)).strftime('%Y-%m-%d %H:%M:%S')
         
         if transaction_type == 'add':
             notes = f'Restocked {quantity} units'
@@ -216,5 +242,136 @@ def populate_sample_data():
     
     print("Sample data has been successfully added to the database!")
 
+def generate_medicines(rng, count):
+    today = datetime.now(timezone.utc).date()
+    manufacturers = ['%s%s Pharma' % (rng.choice(NAME_PARTS).title(), rng.choice(NAME_PARTS))
+                     for _ in range(200)]
+    
+    for i in range(count):
+        stem = ''.join(rng.choice(NAME_PARTS) for _ in range(rng.randint(2, 4))).title()
+        category = rng.choice(CATEGORIES)
+        expiry = today + timedelta(days=rng.randint(-30, 900))
+        purchase = today - timedelta(days=rng.randint(1, 365))
+        # Skewed so a realistic share of the catalogue is low on stock
+        quantity = int(rng.expovariate(1 / 120))
+        yield (f'{stem} {rng.choice(STRENGTHS)}', f'{category} of {stem.lower()}', category,
+               quantity, UNITS[category], rng.choice(manufacturers), f'B{i:08d}',
+               purchase.isoformat(), expiry.isoformat(), (expiry - EPOCH).days,
+               round(rng.uniform(1, 100), 2))
+
+def generate_transactions(rng, count, medicine_count, days=365):
+    # Dates increase with the id, as they would in a real ledger
+    start = datetime.now(timezone.utc) - timedelta(days=days)
+    step = days * 86400 / max(count, 1)
+    for i in range(count):
+        transaction_type = 'remove' if rng.random() < 0.7 else 'add'
+        quantity = rng.randint(1, 20) if transaction_type == 'remove' else rng.randint(20, 200)
+        transaction_date = start + timedelta(seconds=i * step)
+        yield (rng.randint(1, medicine_count), transaction_type, quantity,
+               transaction_date.strftime('%Y-%m-%d %H:%M:%S'),
+               'Dispensed' if transaction_type == 'remove' else 'Restocked')
+
+def generate_suppliers(rng, count):
+    for i in range(count):
+        name = '%s%s Wholesale' % (rng.choice(NAME_PARTS).title(), rng.choice(NAME_PARTS))
+        yield (name, f'Contact {i}', f'555-{i:04d}', f'orders{i}@example.com', f'{i + 1} Supply Road')
+
+def generate_catalogue(rng, medicine_count, supplier_count):
+    for medicine_id in range(1, medicine_count + 1):
+        for supplier_id in rng.sample(range(1, supplier_count + 1), rng.randint(1, 2)):
+            yield (medicine_id, supplier_id, rng.randint(2, 14), rng.choice([1, 10, 20, 50, 100]),
+                   round(rng.uniform(0.5, 80), 2))
+
+def insert_batches(conn, sql, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= GENERATOR_BATCH_SIZE:
+            conn.executemany(sql, batch)
+            batch = []
+    if batch:
+        conn.executemany(sql, batch)
+
+def rebuild_derived_data(conn):
+    # Everything the triggers would have maintained row by row. Demand is
+    # folded in again from the first transaction on the next read
+    for table in ['forecast_state', 'demand_daily', 'reorder_points']:
+        conn.execute('DELETE FROM %s' % table)
+    batches.backfill_batches(conn)
+    dashboard.rebuild_summary(conn)
+    rollups.rebuild_rollups(conn)
+    if conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'medicines_fts'").fetchone()[0]:
+        conn.execute("INSERT INTO medicines_fts (medicines_fts) VALUES ('rebuild')")
+    conn.execute('UPDATE data_revision SET revision = revision + 1')
+    # Expiry tiers depend on app config, so the next read rebuilds them
+    conn.execute('DELETE FROM expiry_tiers_state')
+
+def generate_dataset(db_path, medicine_count, transaction_count, seed=0):
+    # Expects an empty database at the current schema version
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    if conn.execute('SELECT COUNT(*) FROM medicines').fetchone()[0] > 0:
+        conn.close()
+        raise RuntimeError('Database already contains data.')
+    
+    # Row-level triggers are dropped during the load and derived data is
+    # rebuilt in bulk afterwards, which is much faster than firing them per row
+    triggers = conn.execute('''
+    SELECT sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name IN ('medicines', 'transactions')
+    ''').fetchall()
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        for name, in conn.execute('''
+        SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name IN ('medicines', 'transactions')
+        ''').fetchall():
+            conn.execute('DROP TRIGGER %s' % name)
+        
+        insert_batches(conn, '''
+        INSERT INTO medicines (name, description, category, quantity, unit, manufacturer,
+                              batch_number, purchase_date, expiry_date, expiry_day, price)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', generate_medicines(rng, medicine_count))
+        insert_batches(conn, '''
+        INSERT INTO transactions (medicine_id, transaction_type, quantity, transaction_date, notes)
+        VALUES (?, ?, ?, ?, ?)
+        ''', generate_transactions(rng, transaction_count, medicine_count))
+        conn.executemany('''
+        INSERT INTO suppliers (name, contact_person, phone, email, address) VALUES (?, ?, ?, ?, ?)
+        ''', generate_suppliers(rng, GENERATED_SUPPLIERS))
+        insert_batches(conn, '''
+        INSERT INTO supplier_medicines (medicine_id, supplier_id, lead_time_days, pack_size, unit_cost)
+        VALUES (?, ?, ?, ?, ?)
+        ''', generate_catalogue(rng, medicine_count, GENERATED_SUPPLIERS))
+        
+        for sql, in triggers:
+            conn.execute(sql)
+        rebuild_derived_data(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
 if __name__ == "__main__":
-    populate_sample_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Populate the database with sample data.')
+    parser.add_argument('--scale', choices=sorted(SCALES),
+                        help='Generate a large synthetic dataset instead of the demo records.')
+    parser.add_argument('--medicines', type=int, help='Override the number of medicines for --scale.')
+    parser.add_argument('--transactions', type=int, help='Override the number of transactions for --scale.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', default=DB_PATH)
+    args = parser.parse_args()
+    
+    if args.scale:
+        medicine_count, transaction_count = SCALES[args.scale]
+        started = time.perf_counter()
+        generate_dataset(args.db, args.medicines or medicine_count,
+                         args.transactions or transaction_count, seed=args.seed)
+        print(f'Generated {args.medicines or medicine_count} medicines and '
+              f'{args.transactions or transaction_count} transactions '
+              f'in {time.perf_counter() - started:.1f}s.')
+    else:
+        populate_sample_data()
\ No newline at end of file
@@ -0,0 +1,87 @@
+import re
+import sqlite3
+from flask import current_app
+
+# Full-text search over medicines using an external-content FTS5 table kept
+# in sync by triggers. Builds of SQLite without FTS5 fall back to LIKE.
+SEARCH_COLUMNS = ['name', 'description', 'category', 'manufacturer']
+
+# bm25 weights in SEARCH_COLUMNS order, so matches on the name rank first
+BM25_WEIGHTS = '10.0, 1.0, 2.0, 2.0'
+
+def create_search_index(cursor):
+    exists = cursor.execute('''
+    SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'medicines_fts'
+    ''').fetchone()[0]
+    
+    if not exists:
+        try:
+            cursor.execute('''
+            CREATE VIRTUAL TABLE medicines_fts USING fts5(
+                name, description, category, manufacturer,
+                content='medicines', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            )
+            ''')
+        except sqlite3.OperationalError:
+            # SQLite was built without FTS5
+            return False
+        
+        # Backfill rows written before the index existed
+        cursor.execute("INSERT INTO medicines_fts (medicines_fts) VALUES ('rebuild')")
+    
+    columns = ', '.join(SEARCH_COLUMNS)
+    new_values = ', '.join('NEW.' + column for column in SEARCH_COLUMNS)
+    old_values = ', '.join('OLD.' + column for column in SEARCH_COLUMNS)
+    
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS medicines_fts_insert
+    AFTER INSERT ON medicines
+    BEGIN
+        INSERT INTO medicines_fts (rowid, %s) VALUES (NEW.id, %s);
+    END
+    ''' % (columns, new_values))
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS medicines_fts_delete
+    AFTER DELETE ON medicines
+    BEGIN
+        INSERT INTO medicines_fts (medicines_fts, rowid, %s) VALUES ('delete', OLD.id, %s);
+    END
+    ''' % (columns, old_values))
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS medicines_fts_update
+    AFTER UPDATE OF %s ON medicines
+    BEGIN
+        INSERT INTO medicines_fts (medicines_fts, rowid, %s) VALUES ('delete', OLD.id, %s);
+        INSERT INTO medicines_fts (rowid, %s) VALUES (NEW.id, %s);
+    END
+    ''' % (columns, columns, old_values, columns, new_values))
+    return True
+
+def has_search_index(conn):
+    # Checked once per app, the table only appears through init_db
+    available = current_app.extensions.get('search_fts5')
+    if available is None:
+        available = conn.execute('''
+        SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'medicines_fts'
+        ''').fetchone()[0] > 0
+        current_app.extensions['search_fts5'] = available
+    return available
+
+def build_match_query(query):
+    # Every word must match, each as a prefix ("amox" finds "Amoxicillin")
+    terms = re.findall(r'\w+', query)
+    return ' '.join('"%s"*' % term for term in terms)
+
+def ranked_search_select(today):
+    # bm25 scores are negative, lower is more relevant
+    select = '''
+    SELECT * FROM (
+        SELECT m.*, m.expiry_day - ? AS days_left,
+               bm25(medicines_fts, %s) AS score
+        FROM medicines_fts
+        JOIN medicines m ON m.id = medicines_fts.rowid
+        WHERE medicines_fts MATCH ?
+    )
+    ''' % BM25_WEIGHTS
+    return select, [today]
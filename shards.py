@@ -0,0 +1,99 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from flask import current_app, g
+
+# Chain-wide views run the same helper against the main database and every
+# branch shard in parallel and merge the results. Each call gets its own app
+# context with g.store_id set, so the normal helpers and get_db_connection()
+# work unchanged. SQLite releases the GIL while a statement runs, so a
+# fan-out takes about as long as the slowest shard as long as SHARD_WORKERS
+# is at least the number of stores. The pool is shared by concurrent chain
+# requests, so SHARD_TIMEOUT is counted from when a shard's query starts,
+# and a shard still waiting for a worker gets SHARD_TIMEOUT to start. Shards
+# that fail or miss either are reported and left out of the merge.
+
+_executor_lock = threading.Lock()
+
+def get_stores(app=None):
+    # The main database (None) and every branch shard, like migrate and the schedulers
+    app = app or current_app
+    return [None] + list(app.config['STORES'])
+
+def store_key(store):
+    # JSON keys for stores, the main database has no id
+    return 'main' if store is None else str(store)
+
+def get_executor(app):
+    executor = app.extensions.get('shard_executor')
+    if executor is None:
+        with _executor_lock:
+            executor = app.extensions.get('shard_executor')
+            if executor is None:
+                workers = app.config['SHARD_WORKERS'] or len(get_stores(app))
+                executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='shard')
+                app.extensions['shard_executor'] = executor
+    return executor
+
+def run_on_store(app, store, func, args, started):
+    started[store] = time.monotonic()
+    with app.app_context():
+        g.store_id = store
+        return func(*args)
+
+def fan_out(func, *args, timeout=None):
+    app = current_app._get_current_object()
+    timeout = app.config['SHARD_TIMEOUT'] if timeout is None else timeout
+    executor = get_executor(app)
+    submitted, started = time.monotonic(), {}
+    futures = {executor.submit(run_on_store, app, store, func, args, started): store
+               for store in get_stores(app)}
+    
+    def deadline(future):
+        return started.get(futures[future], submitted) + timeout
+    
+    pending = set(futures)
+    while pending:
+        now = time.monotonic()
+        pending = {future for future in pending if deadline(future) > now}
+        if pending:
+            pending = wait(pending, timeout=min(map(deadline, pending)) - now, return_when=FIRST_COMPLETED)[1]
+    pending = {future for future in futures if not future.done()}
+    
+    results, failed = {}, {}
+    for future in set(futures) - pending:
+        store = futures[future]
+        try:
+            results[store] = future.result()
+        except Exception as e:
+            app.logger.warning('Shard %s failed: %s', store, e)
+            failed[store] = str(e)
+    # Still running calls finish in the background, queued ones are dropped
+    for future in pending:
+        future.cancel()
+    
+    return {
+        'results': results,
+        'failed': failed,
+        'timed_out': sorted(store_key(futures[future]) for future in pending),
+    }
+
+def merge_rows(outcome, sort_key, limit=None):
+    # Rows from every shard tagged with their store, in one sorted list
+    rows = []
+    for store, items in outcome['results'].items():
+        for item in items:
+            item = dict(item)
+            item['store_id'] = store
+            rows.append(item)
+    rows.sort(key=sort_key)
+    return rows[:limit] if limit else rows
+
+def outcome_to_json(outcome, **payload):
+    payload.update({
+        'stores': len(outcome['results']),
+        'failed': {store_key(store): error for store, error in outcome['failed'].items()},
+        'timed_out': outcome['timed_out'],
+        'partial': bool(outcome['failed'] or outcome['timed_out']),
+    })
+    return payload
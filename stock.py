@@ -0,0 +1,107 @@
+import batches
+from db import today_day
+
+# Stock movements. Decrements are guarded in SQL (quantity >= ?) so two
+# tills dispensing the same medicine can never oversell or lose an update,
+# then allocated to batches first-expiry-first-out. Expired lots don't count
+# as available, they leave stock through write_off_expired as 'write_off'
+# transactions, which forecasting doesn't count as demand. Movements run
+# inside a transaction owned by the caller (see write_queue) and raise
+# InsufficientStock, after which the caller rolls them back.
+
+class InsufficientStock(Exception):
+    def __init__(self, shortages):
+        super().__init__('Insufficient stock')
+        self.shortages = shortages
+
+def adjust_stock(conn, medicine_id, transaction_type, quantity, notes, batch=None):
+    # batch optionally holds batch_number, expiry_date and purchase_date of
+    # the lot being received
+    if transaction_type not in ('add', 'remove'):
+        raise ValueError('Transaction type must be add or remove')
+    if transaction_type == 'remove':
+        cursor = conn.execute('''
+        UPDATE medicines SET quantity = quantity - ? WHERE id = ? AND quantity >= ?
+        ''', (quantity, medicine_id, quantity))
+    else:
+        cursor = conn.execute('UPDATE medicines SET quantity = quantity + ? WHERE id = ?',
+                              (quantity, medicine_id))
+    
+    if cursor.rowcount == 0:
+        row = conn.execute('SELECT quantity FROM medicines WHERE id = ?', (medicine_id,)).fetchone()
+        raise InsufficientStock([{'medicine_id': medicine_id, 'requested': quantity,
+                                  'available': row['quantity'] if row else None}])
+    
+    if transaction_type == 'remove':
+        today = today_day()
+        if batches.allocate_fefo(conn, medicine_id, quantity, today) is None:
+            raise InsufficientStock([{'medicine_id': medicine_id, 'requested': quantity,
+                                      'available': batches.get_sellable_quantity(conn, medicine_id, today)}])
+    else:
+        batches.receive(conn, medicine_id, quantity, **(batch or {}))
+    
+    conn.execute('''
+    INSERT INTO transactions (medicine_id, transaction_type, quantity, notes)
+    VALUES (?, ?, ?, ?)
+    ''', (medicine_id, transaction_type, quantity, notes))
+
+def parse_basket(payload):
+    if not isinstance(payload, dict) or not isinstance(payload.get('lines'), list) or not payload['lines']:
+        raise ValueError('Request must contain a non-empty list of lines')
+    
+    # Lines for the same medicine are merged into one decrement
+    quantities = {}
+    for line in payload['lines']:
+        try:
+            medicine_id = int(line['medicine_id'])
+            quantity = int(line['quantity'])
+        except (KeyError, ValueError, TypeError):
+            raise ValueError('Each line needs an integer medicine_id and quantity')
+        if quantity <= 0:
+            raise ValueError('Quantities must be greater than zero')
+        quantities[medicine_id] = quantities.get(medicine_id, 0) + quantity
+    
+    return sorted(quantities.items())
+
+def dispense_basket(conn, lines, notes=None):
+    # All lines succeed or none do, every short line is reported
+    today = today_day()
+    shortages = []
+    for medicine_id, quantity in lines:
+        cursor = conn.execute('''
+        UPDATE medicines SET quantity = quantity - ? WHERE id = ? AND quantity >= ?
+        ''', (quantity, medicine_id, quantity))
+        if cursor.rowcount == 0:
+            row = conn.execute('SELECT quantity FROM medicines WHERE id = ?', (medicine_id,)).fetchone()
+            available = batches.get_sellable_quantity(conn, medicine_id, today) if row else None
+            shortages.append({'medicine_id': medicine_id, 'requested': quantity, 'available': available})
+        elif batches.allocate_fefo(conn, medicine_id, quantity, today) is None:
+            shortages.append({'medicine_id': medicine_id, 'requested': quantity,
+                              'available': batches.get_sellable_quantity(conn, medicine_id, today)})
+    
+    if shortages:
+        raise InsufficientStock(shortages)
+    
+    conn.executemany('''
+    INSERT INTO transactions (medicine_id, transaction_type, quantity, notes)
+    VALUES (?, 'remove', ?, ?)
+    ''', [(medicine_id, quantity, notes) for medicine_id, quantity in lines])
+
+def write_off_expired(conn, medicine_id, notes=None):
+    # Removes the stock of every lot past its expiry day as one write_off
+    # transaction. Returns the quantity removed.
+    quantity = batches.take_expired(conn, medicine_id, today_day())
+    if quantity:
+        conn.execute('UPDATE medicines SET quantity = quantity - ? WHERE id = ?', (quantity, medicine_id))
+        conn.execute('''
+        INSERT INTO transactions (medicine_id, transaction_type, quantity, notes)
+        VALUES (?, 'write_off', ?, ?)
+        ''', (medicine_id, quantity, notes or 'Expired stock written off'))
+    return quantity
+
+def write_off_all_expired(conn, notes=None):
+    # (medicine_id, quantity) for every medicine with expired stock
+    medicine_ids = [row[0] for row in conn.execute('''
+    SELECT DISTINCT medicine_id FROM batches WHERE quantity > 0 AND expiry_day < ?
+    ''', (today_day(),))]
+    return [(medicine_id, write_off_expired(conn, medicine_id, notes)) for medicine_id in medicine_ids]
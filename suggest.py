@@ -0,0 +1,266 @@
+import threading
+from bisect import bisect_left
+from flask import current_app
+import db
+
+# Typeahead over medicine names and manufacturers, held in memory per shard.
+# Completions come from a sorted array of casefolded terms: the terms
+# starting with a prefix are one contiguous run found by bisection, which
+# is what a prefix trie gives without a node per character. Misspellings
+# ("amoxcilin") are matched through a deletion index over term prefixes of
+# SUGGEST_MIN_FUZZY to SUGGEST_PREFIX_LENGTH characters: every prefix is
+# filed under itself and each string one deletion away, so a typed prefix
+# finds everything within one edit of it, and most two-edit typos
+# (transpositions, one substitution on each side), with a few dict lookups.
+# The prefixes found are then completed and checked against the whole query.
+# Memory grows with the number of distinct names, the deletion index only
+# with the number of distinct short prefixes, however long names get.
+# The index is built in the background when the app starts serving a shard
+# and kept in step by the write routes.
+SEPARATOR = '\x00'
+
+def normalize(text):
+    return ' '.join(text.casefold().split())
+
+def deletions(text):
+    return {text[:i] + text[i + 1:] for i in range(len(text))}
+
+def edit_distance(a, b, limit, prefix=False):
+    # Optimal string alignment distance, or limit + 1 once it must exceed limit.
+    # With prefix, the distance from a to the closest of b's first
+    # len(a) - limit to len(a) + limit characters.
+    if abs(len(a) - len(b)) > limit and not prefix:
+        return limit + 1
+    previous, current = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+    if prefix:
+        return min(min(current[max(len(a) - limit, 0):len(a) + limit + 1]), limit + 1)
+    return current[-1]
+
+class TermIndex:
+    def __init__(self, prefix_length, min_fuzzy):
+        self.prefix_length = prefix_length
+        self.min_fuzzy = min_fuzzy
+        # 'casefolded term\x00term as stored', sorted
+        self.entries = []
+        # prefix, or a prefix with one character deleted -> the prefix, or a
+        # tuple of them when several share it (most keys have just one)
+        self.fuzzy = {}
+    
+    def prefixes(self, key):
+        return [key[:size] for size in range(self.min_fuzzy, min(len(key), self.prefix_length) + 1)]
+    
+    def is_used(self, prefix, index):
+        # Whether an entry next to index still starts with prefix
+        return any(0 <= i < len(self.entries) and self.entries[i].startswith(prefix)
+                   for i in (index - 1, index))
+    
+    def add(self, text):
+        key = normalize(text)
+        if not key:
+            return
+        entry = key + SEPARATOR + text
+        index = bisect_left(self.entries, entry)
+        if index < len(self.entries) and self.entries[index] == entry:
+            return
+        for prefix in self.prefixes(key):
+            if not self.is_used(prefix, index):
+                for variant in deletions(prefix) | {prefix}:
+                    filed = self.fuzzy.get(variant)
+                    if filed is None:
+                        self.fuzzy[variant] = prefix
+                    else:
+                        self.fuzzy[variant] = (filed if isinstance(filed, tuple) else (filed,)) + (prefix,)
+        self.entries.insert(index, entry)
+    
+    def extend(self, texts):
+        # Bulk load into an empty index: one sort, and each distinct prefix
+        # filed once
+        entries = {normalize(text) + SEPARATOR + text for text in texts if normalize(text)}
+        self.entries = sorted(entries)
+        prefixes = {prefix for entry in self.entries for prefix in self.prefixes(entry.split(SEPARATOR, 1)[0])}
+        for prefix in prefixes:
+            for variant in deletions(prefix) | {prefix}:
+                filed = self.fuzzy.get(variant)
+                if filed is None:
+                    self.fuzzy[variant] = prefix
+                else:
+                    self.fuzzy[variant] = (filed if isinstance(filed, tuple) else (filed,)) + (prefix,)
+    
+    def discard(self, text):
+        key = normalize(text)
+        entry = key + SEPARATOR + text
+        index = bisect_left(self.entries, entry)
+        if index == len(self.entries) or self.entries[index] != entry:
+            return
+        del self.entries[index]
+        for prefix in self.prefixes(key):
+            if not self.is_used(prefix, index):
+                for variant in deletions(prefix) | {prefix}:
+                    filed = self.fuzzy.get(variant)
+                    if filed == prefix:
+                        del self.fuzzy[variant]
+                    elif isinstance(filed, tuple) and prefix in filed:
+                        rest = tuple(other for other in filed if other != prefix)
+                        self.fuzzy[variant] = rest if len(rest) > 1 else rest[0]
+    
+    def complete(self, prefix, limit):
+        # Up to limit (key, text) pairs starting with prefix, in key order
+        index = bisect_left(self.entries, prefix)
+        matches = []
+        for entry in self.entries[index:index + limit]:
+            if not entry.startswith(prefix):
+                break
+            matches.append(tuple(entry.split(SEPARATOR, 1)))
+        return matches
+    
+    def similar_prefixes(self, typed, limit):
+        # Indexed prefixes within limit edits of typed, at most one character
+        # shorter or longer than it
+        found = set()
+        for variant in deletions(typed) | {typed}:
+            filed = self.fuzzy.get(variant)
+            if isinstance(filed, tuple):
+                found.update(filed)
+            elif filed is not None:
+                found.add(filed)
+        found.discard(typed)
+        return [prefix for prefix in found
+                if abs(len(prefix) - len(typed)) <= 1 and edit_distance(typed, prefix, limit) <= limit]
+
+class SuggestIndex:
+    FIELDS = ['name', 'manufacturer']
+    
+    def __init__(self, config):
+        self.scan = config['SUGGEST_SCAN']
+        self.max_distance = config['SUGGEST_MAX_DISTANCE']
+        self.min_fuzzy = config['SUGGEST_MIN_FUZZY']
+        self.terms = {field: TermIndex(config['SUGGEST_PREFIX_LENGTH'], self.min_fuzzy)
+                      for field in self.FIELDS}
+        self.last_id = 0
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+    
+    def load(self, conn):
+        # Medicines added since the last load, the first load reads them all
+        with self.lock:
+            rows = conn.execute('SELECT id, name, manufacturer FROM medicines WHERE id > ? ORDER BY id',
+                                (self.last_id,))
+            if self.last_id == 0:
+                rows = rows.fetchall()
+                for field in self.FIELDS:
+                    self.terms[field].extend(row[field] for row in rows if row[field])
+                if rows:
+                    self.last_id = rows[-1]['id']
+                return
+            for row in rows:
+                for field in self.FIELDS:
+                    if row[field]:
+                        self.terms[field].add(row[field])
+                self.last_id = row['id']
+    
+    def sync(self, conn, field, values):
+        # Re-check renamed or deleted values against the table
+        with self.lock:
+            for value in set(values):
+                if not value:
+                    continue
+                used = conn.execute('SELECT 1 FROM medicines WHERE %s = ? LIMIT 1' % field, (value,)).fetchone()
+                if used:
+                    self.terms[field].add(value)
+                else:
+                    self.terms[field].discard(value)
+    
+    def suggest(self, query, limit=10):
+        query = normalize(query)
+        if not query:
+            return []
+        found = {}
+        for field in self.FIELDS:
+            for key, text in self.terms[field].complete(query, limit):
+                found.setdefault((field, text), (0, key))
+        
+        # Typos: complete the prefixes near the query's first characters, then
+        # measure the query against the start of each term found, which may be
+        # up to max_distance characters longer or shorter than the query. Terms
+        # sharing their first len(query) + max_distance characters are measured once.
+        if len(found) < limit and len(query) >= self.min_fuzzy:
+            max_distance = 1 if len(query) < 6 else self.max_distance
+            for field in self.FIELDS:
+                terms = self.terms[field]
+                typed = query[:terms.prefix_length]
+                distances = {}
+                for prefix in terms.similar_prefixes(typed, max_distance):
+                    for key, text in terms.complete(prefix, self.scan):
+                        if (field, text) in found:
+                            continue
+                        start = key[:len(query) + max_distance]
+                        if start not in distances:
+                            distances[start] = edit_distance(query, start, max_distance, prefix=True)
+                        if distances[start] <= max_distance:
+                            found[(field, text)] = (distances[start], key)
+        
+        ranked = sorted(found.items(), key=lambda item: (item[1][0], self.FIELDS.index(item[0][0]),
+                                                         len(item[1][1]), item[1][1]))
+        return [{'text': text, 'field': field, 'distance': distance}
+                for (field, text), (distance, key) in ranked[:limit]]
+
+_indexes_lock = threading.Lock()
+
+def get_index(app=None, store=None):
+    # Built by the first caller, later callers wait until it is ready
+    app = app or current_app._get_current_object()
+    with _indexes_lock:
+        indexes = app.extensions.setdefault('suggest_indexes', {})
+        index = indexes.get(store)
+        building = index is None
+        if building:
+            index = indexes[store] = SuggestIndex(app.config)
+    if building:
+        pool = db.get_pool(app, store)
+        conn = pool.acquire()
+        try:
+            index.load(conn)
+        except Exception:
+            # The next caller tries again
+            with _indexes_lock:
+                indexes.pop(store, None)
+            raise
+        finally:
+            pool.release(conn)
+            index.ready.set()
+    index.ready.wait()
+    return index
+
+def start_building(app, store=None):
+    def run():
+        try:
+            get_index(app, store)
+        except Exception:
+            app.logger.exception('Suggest index build failed for store %s', store)
+    threading.Thread(target=run, name='suggest-build', daemon=True).start()
+
+def get_built_index():
+    # The request's shard index if one exists, write routes leave unbuilt ones alone
+    return current_app.extensions.get('suggest_indexes', {}).get(db.get_store())
+
+def medicines_added():
+    index = get_built_index()
+    if index is not None:
+        index.load(db.get_db_connection())
+
+def medicines_changed(names, manufacturers):
+    # Old and new values of renamed or deleted medicines
+    index = get_built_index()
+    if index is not None:
+        conn = db.get_db_connection()
+        index.sync(conn, 'name', names)
+        index.sync(conn, 'manufacturer', manufacturers)
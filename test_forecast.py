@@ -0,0 +1,41 @@
+from conftest import add_medicine
+import forecast
+
+def test_low_stock_reads_leave_forecast_to_the_job(app, conn, client):
+    medicine_id = add_medicine(conn, 'Amoxicillin 250mg', quantity=100)
+    for _ in range(3):
+        client.post('/api/dispense', json={'lines': [{'medicine_id': medicine_id, 'quantity': 10}]})
+    
+    first = client.get('/api/low_stock')
+    assert first.status_code == 200
+    assert forecast.get_progress(conn)[1] is None
+    assert conn.execute('SELECT COUNT(*) FROM reorder_points').fetchone()[0] == 0
+    
+    result = app.test_cli_runner().invoke(args=['forecast'])
+    assert result.exit_code == 0
+    assert 'Recomputed reorder points for 1 medicines.' in result.output
+    assert conn.execute('SELECT COUNT(*) FROM reorder_points').fetchone()[0] == 1
+    
+    # New reorder points change what low stock returns, so the ETag moves on
+    second = client.get('/api/low_stock', headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 200
+
+def test_low_stock_merges_reorder_points_and_threshold(conn, client):
+    with_point = add_medicine(conn, 'Amoxicillin 250mg', quantity=15)
+    add_medicine(conn, 'Paracetamol 500mg', quantity=5)
+    above_point = add_medicine(conn, 'Ibuprofen 400mg', quantity=8)
+    add_medicine(conn, 'Cetirizine 10mg', quantity=30)
+    conn.executemany('''
+    INSERT INTO reorder_points (medicine_id, daily_demand, demand_std, reorder_point) VALUES (?, 2, 0, ?)
+    ''', [(with_point, 20), (above_point, 5)])
+    conn.commit()
+    
+    names = [row['name'] for row in client.get('/api/low_stock').get_json()]
+    assert names == ['Paracetamol 500mg', 'Amoxicillin 250mg']
+    
+    # The copy of the quantity on reorder_points follows stock movements
+    conn.execute('UPDATE medicines SET quantity = 4 WHERE id = ?', (above_point,))
+    conn.commit()
+    rows = client.get('/api/low_stock').get_json()
+    assert [(row['name'], row['reorder_point']) for row in rows] == \
+           [('Ibuprofen 400mg', 5), ('Paracetamol 500mg', 10), ('Amoxicillin 250mg', 20)]
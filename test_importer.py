@@ -0,0 +1,48 @@
+import io
+import json
+import pytest
+import importer
+
+RECORDS = [
+    {'name': 'Amoxicillin 250mg', 'quantity': 10, 'expiry_date': '2030-01-01', 'price': 1.25},
+    {'name': 'Paracetamol 500mg', 'quantity': 125, 'expiry_date': '2031-06-30', 'description': 'Tablets, [500mg]'},
+    [],
+    12345,
+]
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 4096])
+def test_json_array_is_read_in_chunks(monkeypatch, chunk_size):
+    monkeypatch.setattr(importer, 'JSON_CHUNK_SIZE', chunk_size)
+    document = ' \n[ ' + ' ,\n'.join(json.dumps(record) for record in RECORDS) + ' ]\n'
+    assert list(importer.iter_json_records(io.BytesIO(document.encode()))) == RECORDS
+    assert list(importer.iter_json_records(io.BytesIO(b'[ ]'))) == []
+
+@pytest.mark.parametrize('document', [b'[{"name": "a"}', b'[{"name": "a', b'[{"name": "a"} x', b'[1, ' + b'2' * 64])
+def test_unterminated_json_array(monkeypatch, document):
+    monkeypatch.setattr(importer, 'JSON_CHUNK_SIZE', 4)
+    monkeypatch.setattr(importer, 'JSON_MAX_RECORD_SIZE', 32)
+    with pytest.raises(ValueError):
+        list(importer.iter_json_records(io.BytesIO(document)))
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 4096])
+def test_malformed_json_elements_are_skipped(monkeypatch, chunk_size):
+    monkeypatch.setattr(importer, 'JSON_CHUNK_SIZE', chunk_size)
+    document = b'[{"name": }, {"name": "a,]}\\\\"} {"name": "b"}, 1,, [2, {"c": []}], 3]'
+    records = list(importer.iter_json_records(io.BytesIO(document)))
+    assert [isinstance(record, ValueError) for record in records] == [True, True, False, True, False, False]
+    assert [record for record in records if not isinstance(record, ValueError)] == [1, [2, {'c': []}], 3]
+
+def test_import_json_array(conn):
+    document = json.dumps(RECORDS).encode()
+    result = importer.import_file(conn, io.BytesIO(document), 'json')
+    assert result == {'imported': 2, 'errors': [{'row': 3, 'error': 'Record must be a JSON object'},
+                                                {'row': 4, 'error': 'Record must be a JSON object'}]}
+    assert [row['name'] for row in conn.execute('SELECT name FROM medicines ORDER BY id')] == \
+           ['Amoxicillin 250mg', 'Paracetamol 500mg']
+
+def test_import_reports_invalid_json(conn):
+    document = b'{"name": "Amoxicillin 250mg", "quantity": 10, "expiry_date": "2030-01-01"}\n{"name": \n'
+    result = importer.import_file(conn, io.BytesIO(document), 'json')
+    assert result['imported'] == 1
+    assert [error['row'] for error in result['errors']] == [2]
+    assert result['errors'][0]['error'].startswith('Invalid JSON: Expecting value')
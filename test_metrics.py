@@ -0,0 +1,46 @@
+import time
+import jinja2
+from flask import stream_template
+import metrics
+import replica
+
+def get_queries(endpoint):
+    return metrics.REQUEST_QUERIES.values.get((endpoint,), 0)
+
+def get_seconds(endpoint, phase):
+    series = metrics.REQUEST_SECONDS.values.get((endpoint, phase))
+    return (series[1], series[2]) if series else (0.0, 0)
+
+def test_streamed_response_is_recorded_when_the_body_ends(app, client):
+    def slow_rows():
+        for row in range(3):
+            time.sleep(0.02)
+            yield row
+    
+    app.jinja_loader = jinja2.DictLoader({'rows.html': '{% for row in rows %}{{ row }}{% endfor %}'})
+    app.add_url_rule('/test/streamed', 'test_streamed', lambda: stream_template('rows.html', rows=slow_rows()))
+    
+    response = client.get('/test/streamed')
+    assert get_seconds('test_streamed', 'template') == (0.0, 0)
+    assert response.get_data() == b'012'
+    response.close()
+    template_time, count = get_seconds('test_streamed', 'template')
+    assert count == 1 and template_time >= 0.06
+    
+    queries = get_queries('export_table')
+    with client.get('/export/medicines?format=csv') as response:
+        assert response.get_data().startswith(b'id,')
+    assert get_queries('export_table') > queries
+
+def test_replica_queries_are_counted(app, client):
+    # Every statement of the request, on the primary and the replica connection
+    statements = []
+    app.config.update(REPLICA_ENABLED=True, REPLICA_REFRESH_SECONDS=0, DB_TRACE=statements.append)
+    with app.app_context():
+        replica.get_replica(app).refresh()
+    del statements[:]
+    
+    queries = get_queries('api_report_categories')
+    with client.get('/api/reports/categories') as response:
+        assert response.status_code == 200
+    assert get_queries('api_report_categories') - queries == len(statements)
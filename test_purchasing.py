@@ -0,0 +1,69 @@
+import pytest
+import batches
+from conftest import add_medicine
+
+@pytest.fixture
+def order(conn):
+    # A draft order for 10 units of a medicine whose only lot has expired
+    medicine_id = add_medicine(conn, 'Amoxicillin 250mg', quantity=2, expiry_date='2020-01-01',
+                               batch_number='OLD-1')
+    supplier_id = conn.execute("INSERT INTO suppliers (name) VALUES ('PharmaCorp')").lastrowid
+    order_id = conn.execute("INSERT INTO purchase_orders (supplier_id) VALUES (?)", (supplier_id,)).lastrowid
+    conn.execute('''
+    INSERT INTO purchase_order_lines (purchase_order_id, medicine_id, packs, quantity) VALUES (?, ?, 1, 10)
+    ''', (order_id, medicine_id))
+    conn.commit()
+    return order_id, medicine_id
+
+def get_lots(conn, medicine_id):
+    return [tuple(row) for row in conn.execute('''
+    SELECT batch_number, expiry_date, quantity FROM batches WHERE medicine_id = ? ORDER BY id
+    ''', (medicine_id,))]
+
+def test_receive_opens_a_lot_per_line(conn, client, order):
+    order_id, medicine_id = order
+    response = client.post(f'/api/purchase_orders/{order_id}/receive', json={
+        'lines': [{'medicine_id': medicine_id, 'batch_number': 'NEW-1', 'expiry_date': '2030-06-30'}]})
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'received'
+    assert get_lots(conn, medicine_id) == [('OLD-1', '2020-01-01', 2), ('NEW-1', '2030-06-30', 10)]
+    assert conn.execute('SELECT quantity FROM medicines WHERE id = ?', (medicine_id,)).fetchone()[0] == 12
+
+def test_receive_never_joins_an_expired_lot(conn, client, order):
+    order_id, medicine_id = order
+    response = client.post(f'/api/purchase_orders/{order_id}/receive', json={})
+    assert response.status_code == 409
+    assert 'expiry date is needed' in response.get_json()['error']
+    
+    response = client.post(f'/api/purchase_orders/{order_id}/receive', json={
+        'lines': [{'medicine_id': medicine_id, 'expiry_date': '2020-01-01'}]})
+    assert response.status_code == 400
+    assert get_lots(conn, medicine_id) == [('OLD-1', '2020-01-01', 2)]
+    assert conn.execute('SELECT status FROM purchase_orders WHERE id = ?', (order_id,)).fetchone()[0] == 'draft'
+
+@pytest.mark.parametrize('line', [{'expiry_date': 20300630}, {'expiry_date': '30/06/2030'},
+                                  {'expiry_date': '2030-06-30', 'batch_number': ['NEW-1']}])
+def test_receive_rejects_malformed_lines(conn, client, order, line):
+    order_id, medicine_id = order
+    response = client.post(f'/api/purchase_orders/{order_id}/receive', json={
+        'lines': [dict(line, medicine_id=medicine_id)]})
+    assert response.status_code == 400
+    assert conn.execute('SELECT status FROM purchase_orders WHERE id = ?', (order_id,)).fetchone()[0] == 'draft'
+
+def test_receive_adds_to_matching_and_current_lots(conn, client, order):
+    order_id, medicine_id = order
+    other_id = add_medicine(conn, 'Ibuprofen 400mg', quantity=5, expiry_date='2031-01-31', batch_number='IB-1')
+    conn.execute('''
+    INSERT INTO purchase_order_lines (purchase_order_id, medicine_id, packs, quantity) VALUES (?, ?, 1, 20)
+    ''', (order_id, other_id))
+    batches.receive(conn, medicine_id, 3, 'NEW-1', '2030-06-30')
+    conn.execute('UPDATE medicines SET quantity = quantity + 3 WHERE id = ?', (medicine_id,))
+    conn.commit()
+    
+    # The first line matches the NEW-1 lot, the second has no expiry and joins IB-1
+    response = client.post(f'/api/purchase_orders/{order_id}/receive', json={
+        'lines': [{'medicine_id': medicine_id, 'batch_number': 'NEW-1', 'expiry_date': '2030-06-30'}]})
+    assert response.status_code == 200
+    assert get_lots(conn, medicine_id) == [('OLD-1', '2020-01-01', 2), ('NEW-1', '2030-06-30', 13)]
+    assert get_lots(conn, other_id) == [('IB-1', '2031-01-31', 25)]
+    assert conn.execute('SELECT quantity FROM medicines WHERE id = ?', (other_id,)).fetchone()[0] == 25
@@ -0,0 +1,41 @@
+import app as medistore
+import db
+import query_plans
+
+def test_every_route_uses_indexes(tmp_path):
+    failures = query_plans.run(str(tmp_path / 'plans.db'), 'demo', medicines=300, transactions=3000, stub=True)
+    assert failures == []
+
+def test_allowed_statements_match_exactly(conn):
+    assert query_plans.get_failures(conn, 'test', 'SELECT key, value FROM dashboard_summary') == []
+    # Embedding an allowed statement doesn't allow the rest of the query
+    failures = query_plans.get_failures(conn, 'test', '''
+    SELECT COUNT(*) FROM medicines WHERE description = 'x'
+    AND price <= (SELECT value FROM dashboard_summary WHERE key = 'low_stock_threshold')
+    ''')
+    assert [bad for source, statement, bad in failures] == [['SCAN medicines']]
+
+def test_trigger_bodies_are_checked(conn):
+    statements = {name: statement for name, statement, params in query_plans.get_trigger_statements(conn)}
+    assert 'WHERE medicine_id = :old_id' in statements['batches_medicines_delete']
+    assert query_plans.get_failures(conn, 'test', 'DELETE FROM batches WHERE medicine_id = :old_id',
+                                    {'old_id': None}) == []
+    failures = query_plans.get_failures(conn, 'test', 'DELETE FROM batches WHERE batch_number = :old_batch_number',
+                                        {'old_batch_number': None})
+    assert [bad for source, statement, bad in failures] == [['SCAN batches']]
+
+def test_expiring_medicines_use_expiry_indexes(db_path):
+    statements = []
+    app = medistore.create_app({'DB_PATH': db_path, 'EXPIRY_SCHEDULER_ENABLED': False, 'DB_TRACE': statements.append})
+    indexes = {}
+    with app.app_context():
+        conn = db.get_db_connection()
+        assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_medicines_expiry_day'").fetchone() is None
+        # The tier table covers 30 days, a year falls back to the batches
+        for days in (30, 365):
+            del statements[:]
+            medistore.get_expiring_medicines(days)
+            indexes[days] = ' '.join(' '.join(query_plans.explain(conn, statement))
+                                     for statement in statements if statement.lstrip().startswith('SELECT'))
+    assert 'idx_expiry_tiers_expiry_day' in indexes[30]
+    assert 'idx_batches_expiry_day' in indexes[365]
@@ -0,0 +1,42 @@
+import rollups
+from conftest import add_medicine
+from db import today_day
+
+def get_category(conn, start_day, end_day, category='Tablet'):
+    return next(row for row in rollups.get_category_report(conn, start_day, end_day)
+                if row['category'] == category)
+
+def receive_opening_stock(conn, medicine_id, quantity):
+    conn.execute("INSERT INTO transactions (medicine_id, transaction_type, quantity) VALUES (?, 'add', ?)",
+                 (medicine_id, quantity))
+    conn.commit()
+
+def test_price_edit_and_delete_keep_opening_and_closing_values(conn):
+    today = today_day()
+    medicine_id = add_medicine(conn, 'Paracetamol 500mg', quantity=10, category='Tablet', price=2.0)
+    receive_opening_stock(conn, medicine_id, 10)
+    
+    conn.execute('UPDATE medicines SET price = 3.0 WHERE id = ?', (medicine_id,))
+    conn.commit()
+    row = get_category(conn, today, today)
+    assert (row['opening_value'], row['added_value'], row['adjusted_value'], row['closing_value']) == (0, 20, 10, 30)
+    # Nothing was in stock before today, whatever happened since
+    row = get_category(conn, today - 7, today - 1)
+    assert (row['opening_value'], row['closing_value']) == (0, 0)
+    
+    conn.execute('DELETE FROM medicines WHERE id = ?', (medicine_id,))
+    conn.commit()
+    row = get_category(conn, today, today)
+    assert (row['opening_value'], row['adjusted_value'], row['closing_value']) == (0, -20, 0)
+
+def test_category_edit_moves_value(conn):
+    today = today_day()
+    medicine_id = add_medicine(conn, 'Salbutamol 100mcg', quantity=4, category='Inhaler', price=5.0)
+    receive_opening_stock(conn, medicine_id, 4)
+    conn.execute("UPDATE medicines SET category = 'Syrup' WHERE id = ?", (medicine_id,))
+    conn.commit()
+    
+    inhaler = get_category(conn, today, today, 'Inhaler')
+    syrup = get_category(conn, today, today, 'Syrup')
+    assert (inhaler['opening_value'], inhaler['closing_value']) == (0, 0)
+    assert (syrup['opening_value'], syrup['adjusted_value'], syrup['closing_value']) == (0, 20, 20)
@@ -0,0 +1,34 @@
+import sqlite3
+import time
+import migrations
+import shards
+from conftest import add_medicine
+
+def test_chain_includes_main_database(app, client, conn, tmp_path):
+    north_path = str(tmp_path / 'north.db')
+    north = sqlite3.connect(north_path)
+    migrations.migrate(north)
+    add_medicine(north, 'Ibuprofen 400mg', quantity=3)
+    north.close()
+    add_medicine(conn, 'Amoxicillin 250mg', quantity=20)
+    app.config['STORES'] = {'north': north_path}
+    
+    response = client.get('/api/chain/summary')
+    assert response.status_code == 200
+    payload = response.get_json()
+    assert sorted(payload['by_store']) == ['main', 'north']
+    assert payload['totals']['total_medicines'] == 2
+    assert not payload['partial']
+
+def test_shard_timeout_starts_with_the_query(app):
+    # One worker runs the two shards one after the other, each within the timeout
+    app.config.update(STORES={'north': 'north.db'}, SHARD_WORKERS=1, SHARD_TIMEOUT=0.6)
+    with app.app_context():
+        outcome = shards.fan_out(lambda: time.sleep(0.4) or 'done')
+    assert outcome['results'] == {None: 'done', 'north': 'done'}
+    assert outcome['timed_out'] == []
+    
+    app.config['SHARD_TIMEOUT'] = 0.1
+    with app.app_context():
+        outcome = shards.fan_out(lambda: time.sleep(0.4))
+    assert outcome['timed_out'] == ['main', 'north']
@@ -0,0 +1,88 @@
+from conftest import add_medicine
+from db import today_day
+import forecast
+import rollups
+import stock
+
+def test_dispense_skips_expired_lots(conn, client):
+    medicine_id = add_medicine(conn, 'Amoxicillin 250mg', quantity=5, expiry_date='2020-01-01', price=2.0)
+    stock.adjust_stock(conn, medicine_id, 'add', 10, 'Fresh lot', {'batch_number': 'B2', 'expiry_date': '2030-01-01'})
+    conn.commit()
+    
+    response = client.post('/api/dispense', json={'lines': [{'medicine_id': medicine_id, 'quantity': 3}]})
+    assert response.status_code == 200
+    lots = conn.execute('SELECT expiry_date, quantity FROM batches WHERE medicine_id = ? ORDER BY expiry_day',
+                        (medicine_id,)).fetchall()
+    assert [tuple(lot) for lot in lots] == [('2020-01-01', 5), ('2030-01-01', 7)]
+    
+    # Only the fresh lot is available, the expired one is not handed out
+    response = client.post('/api/dispense', json={'lines': [{'medicine_id': medicine_id, 'quantity': 10}]})
+    assert response.status_code == 409
+    assert response.get_json()['shortages'] == [{'medicine_id': medicine_id, 'requested': 10, 'available': 7}]
+    assert conn.execute('SELECT quantity FROM medicines WHERE id = ?', (medicine_id,)).fetchone()[0] == 12
+
+def test_write_off_expired(conn):
+    medicine_id = add_medicine(conn, 'Paracetamol 500mg', quantity=4, expiry_date='2020-01-01', price=1.5)
+    stock.adjust_stock(conn, medicine_id, 'add', 6, 'Fresh lot', {'expiry_date': '2030-01-01'})
+    
+    assert stock.write_off_expired(conn, medicine_id) == 4
+    assert stock.write_off_expired(conn, medicine_id) == 0
+    conn.commit()
+    assert conn.execute('SELECT quantity FROM medicines WHERE id = ?', (medicine_id,)).fetchone()[0] == 6
+    written_off = conn.execute('SELECT SUM(written_off_quantity) FROM rollup_medicine_daily WHERE medicine_id = ?',
+                               (medicine_id,)).fetchone()[0]
+    assert written_off == 4
+
+def test_write_off_and_corrections_are_not_demand(conn):
+    medicine_id = add_medicine(conn, 'Ibuprofen 400mg', quantity=900, expiry_date='2020-01-01', price=1.0)
+    stock.adjust_stock(conn, medicine_id, 'add', 20, 'Fresh lot', {'expiry_date': '2030-01-01'})
+    stock.write_off_expired(conn, medicine_id)
+    stock.adjust_stock(conn, medicine_id, 'remove', 5, 'Dispensed')
+    conn.execute("INSERT INTO transactions (medicine_id, transaction_type, quantity) VALUES (?, 'correction', -3)",
+                 (medicine_id,))
+    conn.commit()
+    
+    forecast.update_forecast(conn)
+    assert conn.execute('SELECT SUM(quantity) FROM demand_daily WHERE medicine_id = ?',
+                        (medicine_id,)).fetchone()[0] == 5
+    row = conn.execute('''
+    SELECT removed_quantity, written_off_quantity, written_off_value FROM rollup_medicine_daily
+    WHERE medicine_id = ?
+    ''', (medicine_id,)).fetchone()
+    assert tuple(row) == (5, 900, 900)
+    report = next(row for row in rollups.get_category_report(conn, today_day(), today_day()) if row['category'] is None)
+    assert (report['consumed_quantity'], report['adjusted_value']) == (5, -3)
+
+def edit_form(batch_id, **fields):
+    return dict({'name': 'Cetirizine 10mg', 'description': '', 'category': '', 'quantity': '10', 'unit': '',
+                 'manufacturer': '', 'batch_number': 'A2', 'purchase_date': '', 'expiry_date': '2030-02-01',
+                 'price': '1.0', 'batch_id': str(batch_id)}, **fields)
+
+def test_edit_medicine_updates_the_lot_in_the_form(conn, client):
+    medicine_id = add_medicine(conn, 'Cetirizine 10mg', quantity=5, expiry_date='2030-01-01', batch_number='A')
+    form_lot = conn.execute('SELECT id FROM batches WHERE medicine_id = ?', (medicine_id,)).fetchone()[0]
+    # An earlier expiring lot arrives after the form was opened and becomes the current one
+    stock.adjust_stock(conn, medicine_id, 'add', 5, 'Fresh lot', {'batch_number': 'B', 'expiry_date': '2029-01-01'})
+    conn.commit()
+    
+    response = client.post(f'/edit_medicine/{medicine_id}', data=edit_form(form_lot))
+    assert response.status_code == 302
+    lots = conn.execute('SELECT batch_number, expiry_date, quantity FROM batches WHERE medicine_id = ? ORDER BY id',
+                        (medicine_id,)).fetchall()
+    assert [tuple(lot) for lot in lots] == [('A2', '2030-02-01', 5), ('B', '2029-01-01', 5)]
+    
+    assert client.get('/edit_medicine/999').status_code == 404
+    assert client.post('/edit_medicine/999', data=edit_form(form_lot)).status_code == 404
+
+def test_edit_medicine_flashes_short_lots(conn, client):
+    medicine_id = add_medicine(conn, 'Cetirizine 10mg', quantity=5, expiry_date='2030-01-01', batch_number='A')
+    batch_id = conn.execute('SELECT id FROM batches WHERE medicine_id = ?', (medicine_id,)).fetchone()[0]
+    conn.execute('UPDATE medicines SET quantity = 50 WHERE id = ?', (medicine_id,))
+    conn.commit()
+    
+    response = client.post(f'/edit_medicine/{medicine_id}', data=edit_form(batch_id, name='Renamed'))
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith(f'/edit_medicine/{medicine_id}')
+    with client.session_transaction() as session:
+        assert 'hold less than its stock level' in session['_flashes'][0][1]
+    assert conn.execute('SELECT name FROM medicines WHERE id = ?', (medicine_id,)).fetchone()[0] == 'Cetirizine 10mg'
@@ -0,0 +1,42 @@
+import pytest
+import suggest
+from conftest import add_medicine
+
+CONFIG = {'SUGGEST_SCAN': 20, 'SUGGEST_MAX_DISTANCE': 2, 'SUGGEST_MIN_FUZZY': 3, 'SUGGEST_PREFIX_LENGTH': 8}
+
+@pytest.fixture
+def catalogue(conn):
+    add_medicine(conn, 'Amoxicillin 250mg', manufacturer='PharmaCorp')
+    add_medicine(conn, 'Paracetamol 500mg', manufacturer='MediLabs')
+
+def texts(suggestions):
+    return [suggestion['text'] for suggestion in suggestions]
+
+def test_two_dropped_letters(catalogue, client):
+    # "amoxcilin" is two letters short of "amoxicillin"
+    response = client.get('/api/suggest?q=amoxcilin')
+    assert response.status_code == 200
+    assert response.get_json() == [{'text': 'Amoxicillin 250mg', 'field': 'name', 'distance': 2}]
+
+def test_completion_and_manufacturer(catalogue, client):
+    assert texts(client.get('/api/suggest?q=para').get_json()) == ['Paracetamol 500mg']
+    assert texts(client.get('/api/suggest?q=medilbs').get_json()) == ['MediLabs']
+
+def test_incremental_updates_match_bulk_load():
+    names = ['Amoxicillin 250mg', 'Amoxicillin 500mg', 'Amoxil 1g', 'Paracetamol 500mg', 'Panadol 1g']
+    added = suggest.TermIndex(8, 3)
+    for name in names + ['Amoxicillin Forte']:
+        added.add(name)
+    added.discard('Amoxicillin Forte')
+    loaded = suggest.TermIndex(8, 3)
+    loaded.extend(names)
+    assert added.entries == loaded.entries
+    assert {key: set(value) if isinstance(value, tuple) else {value} for key, value in added.fuzzy.items()} == \
+           {key: set(value) if isinstance(value, tuple) else {value} for key, value in loaded.fuzzy.items()}
+
+def test_short_queries_allow_one_edit():
+    index = suggest.SuggestIndex(CONFIG)
+    index.terms['name'].extend(['Ibuprofen 400mg'])
+    assert texts(index.suggest('ibup')) == ['Ibuprofen 400mg']
+    assert texts(index.suggest('ibpu')) == ['Ibuprofen 400mg']
+    assert index.suggest('bpux') == []
@@ -0,0 +1,33 @@
+import threading
+import pytest
+import write_queue
+
+def test_timed_out_movement_is_never_applied(app):
+    app.config['WRITE_QUEUE_TIMEOUT'] = 0.1
+    writes = write_queue.WriteQueue(app)
+    running, release, applied = threading.Event(), threading.Event(), []
+    
+    def slow(conn):
+        running.set()
+        release.wait()
+        return 'slow'
+    
+    thread = threading.Thread(target=lambda: applied.append(writes.submit(slow, ())))
+    thread.start()
+    assert running.wait(5)
+    with pytest.raises(write_queue.WriteTimeout):
+        writes.submit(lambda conn: applied.append('late'), ())
+    release.set()
+    thread.join(5)
+    
+    # The writer skips the cancelled movement, later ones still run
+    assert writes.submit(lambda conn: 'next', ()) == 'next'
+    assert applied == ['slow']
+
+def test_connect_failure_is_raised(app, tmp_path):
+    app.config['DB_PATH'] = str(tmp_path / 'missing' / 'medicine_stock.db')
+    writes = write_queue.WriteQueue(app)
+    for _ in range(2):
+        with pytest.raises(Exception, match='unable to open database file'):
+            writes.submit(lambda conn: None, ())
+    assert writes.failure is not None
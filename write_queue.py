@@ -0,0 +1,149 @@
+import queue
+import threading
+import time
+from flask import current_app, g
+import db
+
+# Group commit for stock movements. With WRITE_QUEUE_ENABLED, requests hand
+# their movement to a per-shard queue drained by one writer thread, which
+# applies up to WRITE_QUEUE_BATCH_SIZE movements, or whatever arrives within
+# WRITE_QUEUE_MAX_DELAY_MS of the first, in one transaction and one commit.
+# Each movement runs in its own savepoint, so one that fails is rolled back
+# alone. A request is answered only after the commit holding its movement
+# has returned, and the writer connection uses WRITE_QUEUE_SYNCHRONOUS (FULL
+# by default) so that commit is on disk. Without the queue every movement
+# is its own transaction on the request's connection. A movement still
+# waiting in the queue when WRITE_QUEUE_TIMEOUT runs out is cancelled, so a
+# timeout always means it was not applied, and one the writer has started is
+# waited for.
+
+class WriteTimeout(RuntimeError):
+    pass
+
+class Job:
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.started = False
+        self.cancelled = False
+        self.done = threading.Event()
+
+class WriteQueue:
+    def __init__(self, app, store=None):
+        self.app = app
+        self.store = store
+        self.batch_size = app.config['WRITE_QUEUE_BATCH_SIZE']
+        self.max_delay = app.config['WRITE_QUEUE_MAX_DELAY_MS'] / 1000
+        self.timeout = app.config['WRITE_QUEUE_TIMEOUT']
+        # Set when the writer thread can't open its connection
+        self.failure = None
+        self._lock = threading.Lock()
+        self._jobs = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='write-queue', daemon=True)
+        self._thread.start()
+    
+    def submit(self, func, args):
+        if self.failure is not None:
+            raise self.failure
+        job = Job(func, args)
+        self._jobs.put(job)
+        if not job.done.wait(self.timeout):
+            with self._lock:
+                if not job.started:
+                    job.cancelled = True
+                    raise WriteTimeout('Timed out waiting for the write queue, nothing was written')
+            job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+    
+    def _connect(self):
+        config = dict(db.DEFAULT_CONFIG)
+        config.update({key: self.app.config[key] for key in db.DEFAULT_CONFIG if key in self.app.config})
+        config['DB_SYNCHRONOUS'] = self.app.config['WRITE_QUEUE_SYNCHRONOUS']
+        return db.connect(db.get_db_path(self.app, self.store), config)
+    
+    def _next_batch(self):
+        batch = [self._jobs.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._jobs.get(timeout=remaining) if remaining > 0 else self._jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+    
+    def _run(self):
+        with self.app.app_context():
+            g.store_id = self.store
+            try:
+                conn = self._connect()
+            except Exception as e:
+                self.app.logger.exception('Write queue could not connect')
+                self.failure = e
+                # Jobs queued before the failure was recorded get it too
+                while True:
+                    job = self._jobs.get()
+                    job.error = e
+                    job.done.set()
+            while True:
+                batch = self._next_batch()
+                try:
+                    self._apply(conn, batch)
+                except Exception as e:
+                    self.app.logger.exception('Group commit failed')
+                    for job in batch:
+                        if job.error is None:
+                            job.error = e
+                finally:
+                    for job in batch:
+                        job.done.set()
+    
+    def _apply(self, conn, batch):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for job in batch:
+                with self._lock:
+                    if job.cancelled:
+                        continue
+                    job.started = True
+                conn.execute('SAVEPOINT movement')
+                try:
+                    job.result = job.func(conn, *job.args)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO movement')
+                    job.error = e
+                conn.execute('RELEASE movement')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+_queues_lock = threading.Lock()
+
+def get_queue(app=None, store=None):
+    app = app or current_app._get_current_object()
+    with _queues_lock:
+        queues = app.extensions.setdefault('write_queues', {})
+        # A queue that failed to connect is replaced, so the next movement retries
+        if store not in queues or queues[store].failure is not None:
+            queues[store] = WriteQueue(app, store)
+        return queues[store]
+
+def submit(func, *args):
+    # Runs func(conn, *args) in a transaction and returns once it is committed
+    if current_app.config['WRITE_QUEUE_ENABLED']:
+        return get_queue(store=db.get_store()).submit(func, args)
+    
+    conn = db.get_db_connection()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        result = func(conn, *args)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return result